@@ -5,9 +5,19 @@ pyHankoのPython APIを直接呼び出し、CLI標準出力の文字列パース
 署名・失効の検証自体はpyHankoにそのまま任せ、show-cert.py由来の追加分は
 証明書チェーン詳細(Subject/Issuer/Serial/有効期間/署名アルゴリズム)の
 日本語表示のみとする。
+
+複数のPDF(ディレクトリ指定も可)を渡すと、ファイル1件ずつをワーカープロセスに振り分けて
+並列に検証する。ValidationContextはワーカーごとに1回だけ組み立てて使い回すので、
+信頼ストアの読み込みや、取得済みの中間証明書・失効情報は以降のファイルでも再利用される。
 """
 
+import argparse
+import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator
 
 from asn1crypto import x509
 from pyhanko.pdf_utils.reader import PdfFileReader
@@ -60,6 +70,21 @@ def build_validation_context() -> ValidationContext:
     return ValidationContext(**vc_kwargs)
 
 
+# プロセスごとに1つだけ組み立てて使い回す検証コンテキスト
+_validation_context: ValidationContext | None = None
+
+
+def shared_validation_context() -> ValidationContext:
+    """このプロセスの検証コンテキストを返す(初回のみ組み立てる)。
+
+    ProcessPoolExecutorのinitializerからも呼び、ワーカーの起動時に信頼ストアを読み込んでおく。
+    """
+    global _validation_context
+    if _validation_context is None:
+        _validation_context = build_validation_context()
+    return _validation_context
+
+
 def format_cert_detail(cert: x509.Certificate, role: str) -> str:
     return "\n".join(
         [
@@ -74,46 +99,164 @@ def format_cert_detail(cert: x509.Certificate, role: str) -> str:
     )
 
 
-def show_certificate_chain(embedded_sig) -> None:
-    print(format_cert_detail(embedded_sig.signer_cert, "署名者証明書"))
-    print()
+def format_certificate_chain(embedded_sig) -> str:
+    details = [format_cert_detail(embedded_sig.signer_cert, "署名者証明書")]
     for cert in embedded_sig.other_embedded_certs:
-        print(format_cert_detail(cert, "中間/ルート証明書"))
-        print()
+        details.append(format_cert_detail(cert, "中間/ルート証明書"))
+    return "".join(f"{detail}\n\n" for detail in details)
 
 
-def main(pdf_path: str) -> int:
-    with open(pdf_path, "rb") as f:
-        reader = PdfFileReader(f, strict=False)
-        signatures = list(reader.embedded_regular_signatures)
+def validate_signature(embedded_sig, index: int) -> tuple[dict, str]:
+    """index番目(1始まり)の署名を検証し、(JSON用の結果, 日本語のレポート) を返す。"""
+    record = {"signature": index, "field": None, "error": None}
+    try:
+        # TextStringObjectは読み込み中のファイルを参照していてワーカーから返せないのでstrにする
+        record["field"] = str(embedded_sig.field_name)
+        chain = format_certificate_chain(embedded_sig)
 
-        if not signatures:
-            print("PDF内に署名が見つかりませんでした。")
-            return 1
+        status = validate_pdf_signature(
+            embedded_sig, signer_validation_context=shared_validation_context()
+        )
+    except Exception as e:  # 1件の失敗で残りの署名の検証を止めない
+        record["error"] = f"{type(e).__name__}: {e}"
+        record["valid"] = False
+        report = f"===== 署名 {index}: {record['field']} =====\n\n[エラー]\n{record['error']}\n"
+        return record, report
 
-        vc = build_validation_context()
+    signer = embedded_sig.signer_cert
+    signing_time = status.signer_reported_dt
+    record.update(
+        valid=status.bottom_line,
+        intact=status.intact,
+        signature_valid=status.valid,
+        trusted=status.trusted,
+        revoked=status.revoked,
+        coverage=status.coverage.name,
+        signing_time=signing_time.isoformat() if signing_time else None,
+        signer=signer.subject.human_friendly,
+        issuer=signer.issuer.human_friendly,
+        serial=f"{signer.serial_number:X}",
+        not_after=signer.not_valid_after.isoformat(),
+    )
+    report = "\n".join(
+        [
+            f"===== 署名 {index}: {embedded_sig.field_name} =====",
+            "",
+            "[証明書チェーン]",
+            chain + "[検証結果]",
+            format_pretty_print_details(status, []),
+        ]
+    )
+    return record, report
 
-        all_valid = True
-        for i, embedded_sig in enumerate(signatures, start=1):
-            print(f"===== 署名 {i}: {embedded_sig.field_name} =====")
-            print()
 
-            print("[証明書チェーン]")
-            show_certificate_chain(embedded_sig)
+def validate_file(pdf_path: Path) -> tuple[list[dict], str | None]:
+    """pdf_pathの署名をすべて検証し、(署名ごとのJSON用の結果, 日本語のレポート) を返す。
+
+    ワーカープロセスで実行するので、PDFはここで1回だけ開き、pyHankoのオブジェクトは返さない。
+    読み込めない・署名が無いときは、署名番号がNoneの結果1件とレポートNoneを返す。
+    """
+    try:
+        with open(pdf_path, "rb") as f:
+            reader = PdfFileReader(f, strict=False)
+            signatures = list(reader.embedded_regular_signatures)
+            results = [validate_signature(sig, i) for i, sig in enumerate(signatures, 1)]
+    except Exception as e:  # 1ファイルの失敗でバッチ全体を止めない
+        error = f"{type(e).__name__}: {e}"
+        return [{"file": str(pdf_path), "signature": None, "valid": False, "error": error}], None
+
+    if not results:
+        return [{"file": str(pdf_path), "signature": None, "valid": False, "error": "署名なし"}], None
+    records = [{"file": str(pdf_path), **record} for record, _ in results]
+    return records, "\n".join(report for _, report in results)
+
+
+def expand_inputs(inputs: list[str]) -> list[Path]:
+    """入力のファイルとディレクトリ(配下の*.pdfを再帰的に探す)を重複なく並べる。"""
+    files = []
+    for name in inputs:
+        path = Path(name)
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob("*") if p.suffix.lower() == ".pdf"))
+        else:
+            files.append(path)
+    return list(dict.fromkeys(files))
+
+
+def run_validation(files: list[Path], jobs: int) -> Iterator[tuple[list[dict], str | None]]:
+    """PDFを1ファイル1タスクで検証し、入力の順に結果を返す。jobsが1ならこのプロセスで順に処理する。"""
+    if jobs <= 1:
+        for pdf_path in files:
+            yield validate_file(pdf_path)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=shared_validation_context) as executor:
+        yield from executor.map(validate_file, files)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="PDFのデジタル署名を検証し、証明書チェーンの詳細を表示する。"
+    )
+    parser.add_argument(
+        "inputs", nargs="+", metavar="pdf",
+        help="検証するPDFファイル。ディレクトリを指定すると配下のPDFをすべて検証する",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="並列に検証するプロセス数(既定: CPUコア数。1ファイルのときは使わない)",
+    )
+    parser.add_argument(
+        "--json", type=Path, metavar="FILE",
+        help="署名ごとの検証結果をJSON配列でFILEに書き出す",
+    )
+    parser.add_argument(
+        "--jsonl", type=Path, metavar="FILE",
+        help="署名ごとの検証結果を1行1件のJSONでFILEに書き出す(ファイルの検証が終わるたびに追記)",
+    )
+    args = parser.parse_args()
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        print("検証するPDFが見つかりませんでした。", file=sys.stderr)
+        return 1
+    batch = len(files) > 1
 
-            status = validate_pdf_signature(
-                embedded_sig, signer_validation_context=vc
-            )
-            print("[検証結果]")
-            print(format_pretty_print_details(status, []))
+    records = []
+    jsonl = open(args.jsonl, "w", encoding="utf-8") if args.jsonl else None
+    try:
+        for file_records, report in run_validation(files, min(args.jobs, len(files))):
+            record = file_records[0]
+            if report is not None:
+                if batch:
+                    print(f"##### {record['file']} #####")
+                    print()
+                print(report)
+            elif record["error"] == "署名なし":
+                print(f"{record['file']}: PDF内に署名が見つかりませんでした。" if batch
+                      else "PDF内に署名が見つかりませんでした。")
+            else:
+                print(f"{record['file']}: 読み込めませんでした: {record['error']}", file=sys.stderr)
+            records.extend(file_records)
+            if jsonl:
+                jsonl.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in file_records)
+                jsonl.flush()
+    finally:
+        if jsonl:
+            jsonl.close()
 
-            all_valid &= status.bottom_line
+    if args.json:
+        args.json.write_text(json.dumps(records, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
 
-        return 0 if all_valid else 1
+    valid = sum(1 for record in records if record["valid"])
+    if batch:
+        signatures = sum(1 for record in records if record["signature"] is not None)
+        print(
+            f"ファイル {len(files)} 件・署名 {signatures} 件: "
+            f"有効 {valid} 件、無効またはエラー {len(records) - valid} 件"
+        )
+    return 0 if records and valid == len(records) else 1
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"使い方: {sys.argv[0]} <PDFファイル>", file=sys.stderr)
-        sys.exit(1)
-    sys.exit(main(sys.argv[1]))
+    sys.exit(main())
@@ -1,7 +1,8 @@
 #!/usr/bin/env bash
-# Validate digital signatures in a PDF file using pyHanko, and show the
+# Validate digital signatures in PDF files using pyHanko, and show the
 # certificate chain details (Subject/Issuer/Serial/validity/signature
-# algorithm) in Japanese.
+# algorithm) in Japanese. Multiple files or directories are validated in
+# parallel, optionally writing JSON/JSONL results.
 # Requires pyHanko installed in $HOME/Scripts/.venv.
 
 set -euo pipefail
@@ -11,26 +12,34 @@ readonly SCRIPT="$HOME/Dev/util-scripts/check-sign.py"
 
 print_help() {
     cat << EOF
-Usage: $(basename "$0") [OPTIONS] <pdf_file>
+Usage: $(basename "$0") [OPTIONS] <pdf_file|directory>...
 
-Validate digital signatures in a PDF file using pyHanko, and show the
-certificate chain details in Japanese.
+Validate digital signatures in PDF files using pyHanko, and show the
+certificate chain details in Japanese. With several files or a directory,
+signatures are validated in parallel and the trust store is loaded once
+per worker.
 
 Arguments:
-  pdf_file    Path to the PDF file to validate (required)
+  pdf_file    PDF file to validate (required, may be repeated)
+  directory   Validate every PDF under this directory
 
 Options:
-  --help, -h  Show this help message
+  -j, --jobs N    Number of worker processes (default: CPU cores)
+  --json FILE     Write per-signature results as a JSON array
+  --jsonl FILE    Write per-signature results as JSON Lines
+  --help, -h      Show this help message
 
 Examples:
   $(basename "$0") document.pdf
   $(basename "$0") ~/Documents/signed.pdf
+  $(basename "$0") --jsonl results.jsonl ~/Documents/contracts
 
 EOF
 }
 
 # Parse arguments
-PDF_FILE=""
+OPTIONS=()
+INPUTS=()
 
 while [[ $# -gt 0 ]]; do
     case "$1" in
@@ -38,27 +47,34 @@ while [[ $# -gt 0 ]]; do
             print_help
             exit 0
             ;;
+        -j|--jobs|--json|--jsonl)
+            if [[ $# -lt 2 ]]; then
+                echo "Error: $1 requires a value" >&2
+                exit 1
+            fi
+            OPTIONS+=("$1" "$2")
+            shift 2
+            ;;
         -*)
             echo "Unknown option: $1" >&2
             exit 1
             ;;
         *)
-            PDF_FILE="$1"
+            if [[ ! -e "$1" ]]; then
+                echo "Error: File not found: $1" >&2
+                exit 1
+            fi
+            INPUTS+=("$1")
             shift
             ;;
     esac
 done
 
-if [[ -z "$PDF_FILE" ]]; then
+if [[ ${#INPUTS[@]} -eq 0 ]]; then
     echo "Error: PDF file is required" >&2
     echo
     print_help
     exit 1
 fi
 
-if [[ ! -f "$PDF_FILE" ]]; then
-    echo "Error: File not found: $PDF_FILE" >&2
-    exit 1
-fi
-
-exec "$PYTHON" "$SCRIPT" "$PDF_FILE"
+exec "$PYTHON" "$SCRIPT" ${OPTIONS[@]+"${OPTIONS[@]}"} -- "${INPUTS[@]}"
@@ -5,11 +5,100 @@ OpenAI準拠のAPIでアクセスできるLLMのトークン/秒を評価する
 
 import time
 import json
-import statistics
+import math
+import os
+import random
+import socket
+import sys
 import argparse
-from typing import List, Dict, Any, Optional
-from dataclasses import dataclass
+import contextlib
+import csv
+import email.utils
+import fnmatch
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional, Tuple
+from dataclasses import asdict, dataclass, field, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+# オープンループモードで同時に処理中にできるリクエスト数の既定値
+DEFAULT_OPEN_LOOP_MAX_IN_FLIGHT = 256
+# 統計情報に表示するパーセンタイル
+REPORT_PERCENTILES = [50, 90, 95, 99, 99.9]
+# ベースライン比較で回帰とみなす変化率の既定値
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+# スイープで飽和点とみなす、同時実行数の伸びに対する合計トークン/秒の伸びの比率
+DEFAULT_KNEE_EFFICIENCY = 0.25
+# 飽和点とみなすのに必要なp99レイテンシの悪化率
+KNEE_LATENCY_GROWTH = 0.1
+# トークン数を数えた結果をキャッシュする件数（同じプロンプトは2回目以降エンコードしない）
+TOKEN_COUNT_CACHE_SIZE = 4096
+# ライブ表示で移動平均をとる期間（秒）と再描画の間隔（秒）
+DEFAULT_LIVE_WINDOW = 30.0
+LIVE_REFRESH_INTERVAL = 1.0
+# 端末でない出力先（ログファイルなど）にライブ表示の要約を書き出す間隔（秒）
+LIVE_LOG_INTERVAL = 10.0
+# Prometheusに公開するヒストグラムのバケット上限（ヒストグラム名 → le）
+PROMETHEUS_BUCKETS = {
+    'response_time': [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120],
+    'ttft': [0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    'inter_token_latency': [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1],
+    'tokens_per_second': [1, 5, 10, 25, 50, 100, 250, 500, 1000],
+}
+HISTOGRAM_HELP = {
+    'response_time': 'Time from sending a request to receiving the whole response.',
+    'ttft': 'Time to first token of streamed responses.',
+    'inter_token_latency': 'Gap between consecutive streamed tokens.',
+    'tokens_per_second': 'Completion tokens per second of each request.',
+}
+# 待ってから再送するHTTPステータス（レート制限・一時的な過負荷）
+RETRYABLE_STATUS = {429, 503}
+# 再送の既定回数と、Retry-Afterが無い場合の指数バックオフの初期値・上限（秒）
+DEFAULT_MAX_RETRIES = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Retry-Afterに足す揺らぎの上限（指定された待ち時間に対する比率）
+RETRY_AFTER_JITTER = 0.1
+# --target-ciで信頼区間を求める前に、プロンプトごとに最低限集めるサンプル数
+MIN_CI_SAMPLES = 3
+# --target-ciで連続してこの回数失敗した（出力が0トークンだった場合を含む）プロンプトは
+# 追加の計測対象から外す
+MAX_CONSECUTIVE_FAILURES = 3
+# 両側95%信頼区間のt分布の臨界値（自由度 → 値）。表に無い自由度はそれ以下で最大の自由度の値を使う
+T_CRITICAL_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306,
+    9: 2.262, 10: 2.228, 11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131,
+    16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093, 20: 2.086, 21: 2.080, 22: 2.074,
+    23: 2.069, 24: 2.064, 25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048, 29: 2.045,
+    30: 2.042, 40: 2.021, 60: 2.000, 120: 1.980
+}
+# コンテキスト長スケーリングで計測する入力トークン数の既定値
+DEFAULT_CONTEXT_LENGTHS = [1024, 4096, 16384, 65536, 131072]
+# プレフィックスキャッシュ計測で共通プレフィックスの後ろに付ける質問（会話モードでは各ターンの発言）
+PREFIX_QUESTIONS = [
+    "What is the main topic of the text above?",
+    "List three keywords that appear in the text above.",
+    "Summarize the text above in one sentence.",
+    "Who reviews the quarterly results in the text above?",
+    "What does the fox do in the text above?",
+    "Rewrite the first sentence of the text above in plain language.",
+    "How many times is the release mentioned in the text above?",
+    "Suggest a title for the text above.",
+]
+# 合成プロンプトの冒頭に置く指示文
+PROMPT_INSTRUCTION = "Summarize the following text in a few sentences.\n\n"
+# 合成プロンプトの本文に繰り返し使う文章
+FILLER_TEXT = (
+    "The quick brown fox jumps over the lazy dog while the committee reviews "
+    "quarterly results, network latency reports, and plans for the next release. "
+)
 
 @dataclass
 class TestResult:
@@ -21,12 +110,735 @@ class TestResult:
     tokens_per_second: float
     model: str
     prompt_length: int
+    start_time: float = 0.0  # リクエスト送信時刻（エポック秒）
+    end_time: float = 0.0    # レスポンス受信完了時刻（エポック秒）
+    # ストリーミングモードでのみ記録される指標
+    ttft: Optional[float] = None  # 最初のトークン受信までの時間（秒）
+    inter_token_latencies: List[float] = field(default_factory=list)  # チャンク間の受信間隔（秒）
+    decode_tokens_per_second: float = 0.0  # 最初のトークン以降のデコード速度
+    prefill_tokens_per_second: float = 0.0  # プロンプト処理（プレフィル）の速度
+    cached_tokens: Optional[int] = None  # サーバーのプレフィックスキャッシュに当たったトークン数（報告された場合）
+    target: Optional[str] = None  # 複数ターゲットを比較する場合のターゲット名
+    # Ollamaのサーバー側タイマー（秒）。Ollama以外ではNone
+    load_duration: Optional[float] = None         # モデルのロード時間
+    prompt_eval_duration: Optional[float] = None  # プロンプト処理時間
+    eval_duration: Optional[float] = None         # トークン生成時間
+    # 通信フェーズ別の時間（秒）。接続を再利用した場合、DNS/接続/TLSは0になる
+    dns_time: float = 0.0
+    connect_time: float = 0.0
+    tls_time: float = 0.0
+    ttfb: float = 0.0           # リクエスト送信からレスポンスヘッダー受信まで（接続確立を除く）
+    transfer_time: float = 0.0  # レスポンスヘッダー受信からボディ受信完了まで
+    # オープンループモードでのみ記録される指標
+    scheduled_time: Optional[float] = None     # 本来送信すべきだった時刻（エポック秒）
+    corrected_latency: Optional[float] = None  # 予定送信時刻から受信完了までの時間（待ち行列の遅延を含む）
+
+class APIError(Exception):
+    """APIが200以外を返したときの例外（ステータスコードとRetry-Afterの秒数を持つ）"""
+    
+    def __init__(self, status_code: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+    
+    @property
+    def retryable(self) -> bool:
+        return self.status_code in RETRYABLE_STATUS
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-Afterヘッダー（秒数またはHTTP日付）を待ち時間の秒数に変換"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """1分あたりの上限をならして補充するトークンバケット（複数スレッドから呼び出し可能）"""
+    
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self, amount: float) -> float:
+        """amountを確保し、使えるようになるまで待つべき秒数を返す（残量は負になり得る）"""
+        # 1回で上限を超える量はバケットが満杯になった時点で通す
+        amount = min(amount, self.capacity)
+        self._refill(time.monotonic())
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class RateLimiter:
+    """
+    リクエスト数/分（RPM）とトークン数/分（TPM）のトークンバケットで送信ペースを制御
+    
+    429/503を受けたときはpauseで全スレッドの送信をまとめて止める。
+    """
+    
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def acquire(self, tokens: int) -> float:
+        """1リクエスト分（tokensトークン）の枠を確保するまで待ち、待った秒数を返す"""
+        with self._lock:
+            wait = max(0.0, self.paused_until - time.monotonic())
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1))
+            if self.tokens:
+                wait = max(wait, self.tokens.reserve(tokens))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+    
+    def pause(self, seconds: float):
+        """seconds秒間、新しいリクエストの送信を止める"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+@dataclass
+class Target:
+    """比較対象のエンドポイントとモデルの組"""
+    name: str
+    base_url: str
+    api_type: str
+    model: str
+    api_key: str = ""
+
+def load_targets(filename: str, defaults: Target) -> List[Target]:
+    """
+    比較するターゲットの一覧をJSONファイルから読み込む
+    
+    各要素は name / base_url / api_type / model / api_key（または環境変数名のapi_key_env）を持ち、
+    省略した項目はコマンドラインの値（defaults）を使う。
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{filename} must contain a non-empty JSON list of targets")
+    
+    targets = []
+    for entry in entries:
+        api_key = entry.get('api_key')
+        if api_key is None and entry.get('api_key_env'):
+            api_key = os.environ.get(entry['api_key_env'], '')
+        target = Target(
+            name=entry.get('name', ''),
+            base_url=entry.get('base_url', defaults.base_url),
+            api_type=entry.get('api_type', defaults.api_type),
+            model=entry.get('model', defaults.model),
+            api_key=api_key if api_key is not None else defaults.api_key
+        )
+        target.name = target.name or f"{target.model}@{target.base_url}"
+        targets.append(target)
+    
+    names = [target.name for target in targets]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Target names must be unique: {names}")
+    return targets
+
+@dataclass
+class BenchmarkTask:
+    """送信するリクエスト1件分の情報"""
+    prompt_index: int
+    iteration: int
+    prompt: str
+    max_tokens: Optional[int] = None  # 指定時は実行全体のmax_tokensより優先
+    offset: Optional[float] = None    # トレース再生時の開始からの送信時刻（秒）
+    
+    @property
+    def key(self) -> str:
+        """中断後の再開時に完了済みかを判定するためのキー"""
+        return f"{self.prompt_index}:{self.iteration}"
+    
+    @property
+    def label(self) -> str:
+        return f"Prompt {self.prompt_index+1} iteration {self.iteration+1}"
+
+def result_to_dict(result: TestResult) -> Dict[str, Any]:
+    """保存用の辞書に変換（timestampは各リクエストの受信完了時刻）"""
+    data = asdict(result)
+    data['timestamp'] = result.end_time
+    return data
+
+def result_from_dict(data: Dict[str, Any]) -> TestResult:
+    """保存済みの辞書からTestResultを復元（未知のキーは無視）"""
+    names = {f.name for f in fields(TestResult)}
+    return TestResult(**{k: v for k, v in data.items() if k in names})
+
+def load_records(filename: str) -> List[Dict[str, Any]]:
+    """
+    保存済みの結果を読み込む
+    
+    --outputのJSON配列とResultStoreのJSONLの両方に対応する。
+    JSONLの途中で書き込みが中断された行は読み飛ばす。
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    
+    records = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            print(f"⚠ Skipping incomplete record in {filename}")
+    return records
+
+class ResultStore:
+    """
+    テスト結果を完了するたびに1行ずつ追記するJSONL形式の結果ストア
+    
+    実行が中断されてもそれまでの結果は失われず、resume=Trueで開けば
+    完了済みのタスクを飛ばして続きから実行できる。
+    """
+    
+    def __init__(self, filename: str, resume: bool = False):
+        self.filename = filename
+        self.completed: Dict[str, TestResult] = {}
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            if not resume:
+                raise FileExistsError(f"Result store already exists: {filename} (use --resume to continue it)")
+            self._truncate_partial_line()
+            for record in load_records(filename):
+                if 'task' in record:
+                    self.completed[record['task']] = result_from_dict(record)
+        self._file = open(filename, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+    
+    def _truncate_partial_line(self):
+        """中断で書きかけになった最終行を取り除き、追記が次の行から始まるようにする"""
+        with open(self.filename, 'rb+') as f:
+            data = f.read()
+            if not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+    
+    def append(self, result: TestResult, task: BenchmarkTask):
+        """結果を1件追記して即座にフラッシュ"""
+        line = json.dumps({**result_to_dict(result), 'task': task.key}, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+    
+    def close(self):
+        self._file.close()
+
+# 接続確立時のフェーズ別時間をリクエストを送ったスレッドごとに記録する
+_phase_local = threading.local()
+
+def _reset_phases() -> Dict[str, float]:
+    """現在のスレッドのフェーズ計測をリセット"""
+    _phase_local.phases = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+    return _phase_local.phases
+
+def _current_phases() -> Dict[str, float]:
+    """現在のスレッドで計測中のフェーズ別時間を取得"""
+    phases = getattr(_phase_local, 'phases', None)
+    return phases if phases is not None else _reset_phases()
+
+class _TimedConnectionMixin:
+    """名前解決とTCP接続を分けて計測するurllib3コネクション"""
+    
+    def _new_conn(self):
+        phases = _current_phases()
+        dns_start = time.perf_counter()
+        try:
+            addrinfo = socket.getaddrinfo(self._dns_host, self.port, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise NewConnectionError(self, f"Failed to resolve '{self.host}': {e}") from e
+        connect_start = time.perf_counter()
+        phases['dns'] += connect_start - dns_start
+        
+        # 解決済みのアドレスに接続させ、接続時間に名前解決が混ざらないようにする
+        dns_host = self._dns_host
+        self._dns_host = addrinfo[0][4][0]
+        try:
+            sock = super()._new_conn()
+        finally:
+            self._dns_host = dns_host
+        phases['connect'] += time.perf_counter() - connect_start
+        return sock
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    """TLSハンドシェイクの時間も計測するHTTPSコネクション"""
+    
+    def connect(self):
+        phases = _current_phases()
+        before = phases['dns'] + phases['connect']
+        start = time.perf_counter()
+        super().connect()
+        elapsed = time.perf_counter() - start
+        phases['tls'] += elapsed - (phases['dns'] + phases['connect'] - before)
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """フェーズ計測付きのコネクションプールを使うrequestsアダプター"""
+    
+    pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.pool_classes_by_scheme
+    
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKSプロキシは専用のコネクションクラスを使うため差し替えない
+        if not proxy.lower().startswith('socks'):
+            manager.pool_classes_by_scheme = self.pool_classes_by_scheme
+        return manager
+
+def t_critical(df: int) -> float:
+    """自由度dfの両側95%信頼区間のt値（120を超える場合は正規分布の1.96）"""
+    if df > 120:
+        return 1.96
+    return T_CRITICAL_95[max(k for k in T_CRITICAL_95 if k <= df)]
+
+class RunningStats:
+    """Welford法で平均と分散を逐次更新し、平均の95%信頼区間を求める"""
+    
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+    
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+    
+    @property
+    def stdev(self) -> float:
+        """標本標準偏差"""
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+    
+    def ci_half_width(self) -> float:
+        """平均の95%信頼区間の半幅（サンプルが2件未満なら無限大）"""
+        if self.count < 2:
+            return math.inf
+        return t_critical(self.count - 1) * self.stdev / math.sqrt(self.count)
+    
+    def relative_ci(self) -> float:
+        """信頼区間の半幅を平均に対する比率で返す（±この比率）"""
+        return self.ci_half_width() / self.mean if self.mean > 0 else math.inf
+
+class LogHistogram:
+    """
+    対数バケットで値の分布を固定メモリに保持するヒストグラム（HDR Histogram風）
+    
+    値域[min_value, max_value]を相対誤差precisionのバケットに分割し、
+    記録する値の個数に関係なくメモリ使用量は一定。パーセンタイルは
+    バケットの代表値で返すため、誤差は相対でprecision/2以内に収まる。
+    """
+    
+    def __init__(self, min_value: float = 1e-6, max_value: float = 1e7,
+                 precision: float = 0.01):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        self.counts = [0] * (self._index(max_value) + 1)
+        self.zero_count = 0  # 0以下の値（失敗したリクエストのトークン/秒など）
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+    
+    def _index(self, value: float) -> int:
+        value = min(max(value, self.min_value), self.max_value)
+        return int(math.log(value / self.min_value) / self._log_base)
+    
+    def _bucket_value(self, index: int) -> float:
+        """バケットの代表値（上下限の幾何平均）"""
+        return self.min_value * math.exp((index + 0.5) * self._log_base)
+    
+    def record(self, value: float):
+        """値を1件記録"""
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+    
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+    
+    @property
+    def stdev(self) -> float:
+        """標本標準偏差"""
+        if self.count < 2:
+            return 0.0
+        variance = (self.total_squares - self.total * self.total / self.count) / (self.count - 1)
+        return math.sqrt(max(variance, 0.0))
+    
+    def percentile(self, percent: float) -> float:
+        """指定したパーセンタイル（0-100）の値を返す"""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(percent / 100 * self.count))
+        seen = self.zero_count
+        if seen >= rank:
+            return min(0.0, self.max)
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(max(self._bucket_value(index), self.min), self.max)
+        return self.max
+    
+    def cumulative_counts(self, bounds: List[float]) -> List[int]:
+        """
+        昇順に並んだboundsの各値以下の件数（Prometheusのヒストグラムのbucket用）
+        
+        boundを含むバケットはbound以下として数えるため、誤差はバケット幅（precision）以内。
+        """
+        result = []
+        seen = self.zero_count
+        index = 0
+        for bound in bounds:
+            limit = self._index(bound) if bound > 0 else -1
+            while index <= limit:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+    
+    def merge(self, other: 'LogHistogram'):
+        """別のヒストグラム（並列ワーカーや保存済みの実行結果）を合算"""
+        if (other.min_value, other.max_value, other.precision) != (self.min_value, self.max_value, self.precision):
+            raise ValueError("Cannot merge histograms with different bucket layouts")
+        for index, bucket_count in enumerate(other.counts):
+            self.counts[index] += bucket_count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON保存用の辞書に変換（空のバケットは省略）"""
+        return {
+            'min_value': self.min_value,
+            'max_value': self.max_value,
+            'precision': self.precision,
+            'buckets': {str(i): c for i, c in enumerate(self.counts) if c},
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'total': self.total,
+            'total_squares': self.total_squares,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'LogHistogram':
+        hist = cls(data['min_value'], data['max_value'], data['precision'])
+        for index, bucket_count in data['buckets'].items():
+            hist.counts[int(index)] = bucket_count
+        hist.zero_count = data['zero_count']
+        hist.count = data['count']
+        hist.total = data['total']
+        hist.total_squares = data['total_squares']
+        if hist.count:
+            hist.min = data['min']
+            hist.max = data['max']
+        return hist
+
+class MetricsCollector:
+    """結果が届くたびに各指標のヒストグラムと集計値を更新する"""
+    
+    # TestResultの属性名 → ヒストグラム名（Noneの値は記録しない）
+    RESULT_METRICS = [
+        'tokens_per_second', 'response_time', 'completion_tokens', 'ttft',
+        'corrected_latency', 'load_duration', 'prompt_eval_duration', 'eval_duration',
+        'dns_time', 'connect_time', 'tls_time', 'ttfb', 'transfer_time'
+    ]
+    
+    # レート制限と失敗の件数
+    # throttled: クライアント側のリミッターで待たされたリクエスト数（throttle_waitは待ち時間の合計秒）
+    # rate_limited: 429/503を受けた回数、retried: 再送した回数、failed: 最終的に失敗したリクエスト数
+    COUNTERS = ['throttled', 'throttle_wait', 'rate_limited', 'retried', 'failed']
+    
+    def __init__(self):
+        self.histograms: Dict[str, LogHistogram] = {}
+        self.counters: Dict[str, float] = {name: 0 for name in self.COUNTERS}
+        self.total_completion_tokens = 0
+        self.new_connections = 0
+        self.first_start: Optional[float] = None
+        self.last_end: Optional[float] = None
+        self._lock = threading.Lock()
+    
+    def _histogram(self, name: str) -> LogHistogram:
+        if name not in self.histograms:
+            self.histograms[name] = LogHistogram()
+        return self.histograms[name]
+    
+    def record(self, result: TestResult):
+        """テスト結果を1件反映（複数スレッドから呼び出し可能）"""
+        with self._lock:
+            for name in self.RESULT_METRICS:
+                value = getattr(result, name)
+                if value is not None:
+                    self._histogram(name).record(value)
+            if result.decode_tokens_per_second > 0:
+                self._histogram('decode_tokens_per_second').record(result.decode_tokens_per_second)
+            if result.prefill_tokens_per_second > 0:
+                self._histogram('prefill_tokens_per_second').record(result.prefill_tokens_per_second)
+            for gap in result.inter_token_latencies:
+                self._histogram('inter_token_latency').record(gap)
+            if result.scheduled_time is not None:
+                self._histogram('queue_delay').record(result.start_time - result.scheduled_time)
+            self.total_completion_tokens += result.completion_tokens
+            if result.connect_time > 0:
+                self.new_connections += 1
+            self.first_start = result.start_time if self.first_start is None else min(self.first_start, result.start_time)
+            self.last_end = result.end_time if self.last_end is None else max(self.last_end, result.end_time)
+    
+    def count_event(self, name: str, amount: float = 1):
+        """レート制限・失敗の件数を加算（複数スレッドから呼び出し可能）"""
+        with self._lock:
+            self.counters[name] += amount
+    
+    def get(self, name: str) -> Optional[LogHistogram]:
+        hist = self.histograms.get(name)
+        return hist if hist is not None and hist.count else None
+    
+    @property
+    def count(self) -> int:
+        hist = self.histograms.get('response_time')
+        return hist.count if hist else 0
+    
+    def merge(self, other: 'MetricsCollector'):
+        """別のコレクターの内容を合算"""
+        with self._lock:
+            for name, hist in other.histograms.items():
+                self._histogram(name).merge(hist)
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.total_completion_tokens += other.total_completion_tokens
+            self.new_connections += other.new_connections
+            if other.first_start is not None:
+                self.first_start = other.first_start if self.first_start is None else min(self.first_start, other.first_start)
+            if other.last_end is not None:
+                self.last_end = other.last_end if self.last_end is None else max(self.last_end, other.last_end)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'histograms': {name: hist.to_dict() for name, hist in self.histograms.items()},
+            'counters': self.counters,
+            'total_completion_tokens': self.total_completion_tokens,
+            'new_connections': self.new_connections,
+            'first_start': self.first_start,
+            'last_end': self.last_end
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'MetricsCollector':
+        collector = cls()
+        collector.histograms = {name: LogHistogram.from_dict(h) for name, h in data['histograms'].items()}
+        collector.counters.update(data.get('counters', {}))
+        collector.total_completion_tokens = data['total_completion_tokens']
+        collector.new_connections = data['new_connections']
+        collector.first_start = data['first_start']
+        collector.last_end = data['last_end']
+        return collector
+    
+    def snapshot(self) -> 'MetricsCollector':
+        """実行中に別スレッドから読むための複製（記録中のヒストグラムを直接読まない）"""
+        with self._lock:
+            return MetricsCollector.from_dict(self.to_dict())
+
+def nearest_rank(sorted_values: List[float], percent: float) -> Optional[float]:
+    """昇順に並んだ値のパーセンタイル（最近傍順位法）"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class RollingWindow:
+    """
+    直近window秒に終わったリクエストを保持し、ライブ表示用の移動平均を求める
+    
+    累積の統計（MetricsCollector）と違い、実行途中の速度低下やエラーの増加がすぐ見える。
+    """
+    
+    def __init__(self, window: float = DEFAULT_LIVE_WINDOW):
+        self.window = window
+        self.started = time.monotonic()
+        # (終了時刻, 生成トークン数, レスポンス時間, TTFT) 失敗はレスポンス時間がNone
+        self.events: deque = deque()
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+    
+    def record(self, result: Optional[TestResult], error: Optional[str] = None):
+        """終わったリクエストを1件追加（失敗はresultをNoneにしてerrorを渡す）"""
+        now = time.monotonic()
+        with self._lock:
+            if result is None:
+                self.events.append((now, 0, None, None))
+                self.last_error = error
+            else:
+                self.events.append((now, result.completion_tokens, result.response_time, result.ttft))
+            self._prune(now)
+    
+    def _prune(self, now: float):
+        while self.events and self.events[0][0] < now - self.window:
+            self.events.popleft()
+    
+    def summary(self) -> Dict[str, Any]:
+        """直近window秒のトークン/秒・リクエスト/秒・エラー率・レイテンシのパーセンタイル"""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            events = list(self.events)
+        span = max(min(self.window, now - self.started), 1e-9)
+        succeeded = [event for event in events if event[2] is not None]
+        latencies = sorted(event[2] for event in succeeded)
+        ttfts = sorted(event[3] for event in succeeded if event[3] is not None)
+        return {
+            'tokens_per_second': sum(event[1] for event in succeeded) / span,
+            'requests_per_second': len(succeeded) / span,
+            'error_rate': (len(events) - len(succeeded)) / len(events) if events else 0.0,
+            'p50': nearest_rank(latencies, 50),
+            'p95': nearest_rank(latencies, 95),
+            'p99': nearest_rank(latencies, 99),
+            'ttft_p50': nearest_rank(ttfts, 50),
+            'ttft_p99': nearest_rank(ttfts, 99),
+        }
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を大まかに推定
+    （実際のトークナイザーがない場合の代替手段）
+    """
+    # 単語数の約1.3倍をトークン数として推定（英語の場合）
+    # 日本語の場合はより複雑だが、文字数/2程度で推定
+    words = text.split()
+    if any(ord(char) > 127 for char in text):  # 日本語文字が含まれる場合
+        return len(text) // 2
+    else:
+        return int(len(words) * 1.3)
+
+class Tokenizer:
+    """
+    サーバーがusageを返さない場合にトークン数を数えるオフラインのトークナイザー
+    
+    この基底クラスはestimate_tokensによる推定を使い、countだけを提供する。encode/decodeは
+    exactがTrueのサブクラスだけが持つ。countの結果はLRUキャッシュし、
+    同じプロンプトを何度送っても2回目以降はエンコードしない（文字列のハッシュは
+    文字列オブジェクト側にキャッシュされるので、長いプロンプトでも検索は安い）。
+    """
+    name = "heuristic"
+    # encode/decodeでトークン列を直接扱えるか（合成プロンプトを正確な長さで作れるか）
+    exact = False
+    
+    def __init__(self):
+        self.count = functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(self._count)
+    
+    def _count(self, text: str) -> int:
+        return estimate_tokens(text)
+
+class TiktokenTokenizer(Tokenizer):
+    """tiktokenのBPEエンコーディング（cl100k_baseなどのエンコーディング名、またはモデル名で指定）"""
+    exact = True
+    
+    def __init__(self, encoding: str):
+        try:
+            import tiktoken
+        except ImportError:
+            raise ImportError("tiktoken is not installed (pip install tiktoken)")
+        try:
+            self._encoding = tiktoken.get_encoding(encoding)
+        except ValueError:
+            self._encoding = tiktoken.encoding_for_model(encoding)
+        self.name = f"tiktoken:{self._encoding.name}"
+        super().__init__()
+    
+    def _count(self, text: str) -> int:
+        return len(self.encode(text))
+    
+    def encode(self, text: str) -> List[int]:
+        # 特殊トークンと同じ文字列もプロンプトの一部として数える
+        return self._encoding.encode(text, disallowed_special=())
+    
+    def decode(self, ids: List[int]) -> str:
+        return self._encoding.decode(ids)
+
+class HFTokenizer(Tokenizer):
+    """Hugging Faceのtokenizer.json（ローカルファイル）"""
+    exact = True
+    
+    def __init__(self, path: str):
+        try:
+            from tokenizers import Tokenizer as HFTokenizerModel
+        except ImportError:
+            raise ImportError("tokenizers is not installed (pip install tokenizers)")
+        self._tokenizer = HFTokenizerModel.from_file(path)
+        self.name = f"hf:{path}"
+        super().__init__()
+    
+    def _count(self, text: str) -> int:
+        return len(self.encode(text))
+    
+    def encode(self, text: str) -> List[int]:
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+    
+    def decode(self, ids: List[int]) -> str:
+        return self._tokenizer.decode(ids, skip_special_tokens=False)
+
+def load_tokenizer(spec: str) -> Tokenizer:
+    """
+    指定文字列からトークナイザーを作成
+    
+    "heuristic" / "tiktoken:<エンコーディング名またはモデル名>" /
+    "hf:<tokenizer.jsonのパス>"（.jsonで終わるパスはそのままHFとみなす）
+    """
+    kind, _, arg = spec.partition(':')
+    if spec == 'heuristic':
+        return Tokenizer()
+    if kind == 'tiktoken' and arg:
+        return TiktokenTokenizer(arg)
+    if kind == 'hf' and arg:
+        return HFTokenizer(arg)
+    if spec.endswith('.json'):
+        return HFTokenizer(spec)
+    raise ValueError(f"Unknown tokenizer: {spec} (use heuristic, tiktoken:NAME or hf:PATH)")
 
 class LLMSpeedEvaluator:
     """LLMの速度評価を行うクラス"""
     
     def __init__(self, api_key: str, base_url: str = "https://api.openai.com/v1", 
-                 api_type: str = "openai"):
+                 api_type: str = "openai", stream: bool = False, pool_size: int = 10):
         """
         初期化
         
@@ -34,11 +846,39 @@ class LLMSpeedEvaluator:
             api_key: APIキー
             base_url: APIのベースURL
             api_type: API種別 ("openai", "litellm", "ollama")
+            stream: ストリーミングで受信し、TTFTとトークン間隔を計測するか
+            pool_size: Keep-Aliveで保持する接続数の上限
         """
         self.api_key = api_key
         # localhostを127.0.0.1に自動変換（IPv4/IPv6問題の回避）
         self.base_url = self._normalize_localhost(base_url.rstrip('/'))
         self.api_type = api_type.lower()
+        self.stream = stream
+        # 結果が届くたびに更新する統計（長時間の実行でもメモリ使用量は一定）
+        self.metrics = MetricsCollector()
+        # 設定されている場合、結果を完了するたびに追記する
+        self.store: Optional[ResultStore] = None
+        # 設定されている場合、RPM/TPMの上限に合わせて送信ペースを抑える
+        self.rate_limiter: Optional[RateLimiter] = None
+        # 429/503を受けたときに再送する回数
+        self.max_retries = DEFAULT_MAX_RETRIES
+        # 複数ターゲットを比較する場合、結果に記録するターゲット名
+        self.target: Optional[str] = None
+        # 送信中のリクエスト数と、設定されている場合はライブ表示用の直近の結果
+        self.in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self.live: Optional[RollingWindow] = None
+        # 合成プロンプトのキャッシュ（(トークナイザー名, 入力トークン数) → プロンプト）
+        self._prompt_cache: Dict[Tuple[str, int], str] = {}
+        # usageが無い場合のトークン数の数え方（モデル名またはパターン → トークナイザー）
+        self.tokenizer = Tokenizer()
+        self.model_tokenizers: Dict[str, Tokenizer] = {}
+        
+        # 接続を使い回し、TCP接続やTLSハンドシェイクのコストをトークン/秒に含めない
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
@@ -61,16 +901,24 @@ class LLMSpeedEvaluator:
         テキストのトークン数を大まかに推定
         （実際のトークナイザーがない場合の代替手段）
         """
-        # 単語数の約1.3倍をトークン数として推定（英語の場合）
-        # 日本語の場合はより複雑だが、文字数/2程度で推定
-        words = text.split()
-        if any(ord(char) > 127 for char in text):  # 日本語文字が含まれる場合
-            return len(text) // 2
-        else:
-            return int(len(words) * 1.3)
+        return estimate_tokens(text)
+    
+    def tokenizer_for(self, model: str) -> Tokenizer:
+        """モデルに対応するトークナイザー（完全一致、パターンの順に探し、無ければ既定）"""
+        if model in self.model_tokenizers:
+            return self.model_tokenizers[model]
+        for pattern, tokenizer in self.model_tokenizers.items():
+            if fnmatch.fnmatchcase(model, pattern):
+                return tokenizer
+        return self.tokenizer
+    
+    def count_tokens(self, text: str, model: str) -> int:
+        """モデルのトークナイザーでトークン数を数える（結果はキャッシュされる）"""
+        return self.tokenizer_for(model).count(text)
     
     def send_request(self, prompt: str, model: str, max_tokens: int = 500, 
-                    temperature: float = 0.7) -> Dict[str, Any]:
+                    temperature: float = 0.7,
+                    messages: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
         """
         APIリクエストを送信
         
@@ -79,53 +927,109 @@ class LLMSpeedEvaluator:
             model: モデル名
             max_tokens: 最大トークン数
             temperature: 温度パラメータ
-            
+            messages: 会話履歴（指定時はpromptの代わりにこのmessagesを送る）
+        
         Returns:
             APIレスポンス
         """
-        # API種別に応じてペイロードとエンドポイントを設定
-        if self.api_type == "ollama":
-            return self._send_ollama_request(prompt, model, max_tokens, temperature)
-        else:
-            return self._send_openai_request(prompt, model, max_tokens, temperature)
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                # TPMはプロンプトと最大トークン数の合計で見積もる（APIの制限と同じ数え方）
+                waited = self.rate_limiter.acquire(self.count_tokens(prompt, model) + max_tokens)
+                if waited > 0:
+                    self.metrics.count_event('throttled')
+                    self.metrics.count_event('throttle_wait', waited)
+            try:
+                # API種別に応じてペイロードとエンドポイントを設定
+                if self.api_type == "ollama":
+                    return self._send_ollama_request(prompt, model, max_tokens, temperature, messages)
+                else:
+                    return self._send_openai_request(prompt, model, max_tokens, temperature, messages)
+            except APIError as e:
+                if not e.retryable:
+                    raise
+                self.metrics.count_event('rate_limited')
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(e, attempt)
+                self.metrics.count_event('retried')
+                print(f"    ↻ {e.status_code} received, retrying in {delay:.1f}s "
+                      f"(retry {attempt+1}/{self.max_retries})")
+                if self.rate_limiter:
+                    # 他のスレッドも同じ上限に当たるので、送信をまとめて止める
+                    self.rate_limiter.pause(delay)
+                time.sleep(delay)
+    
+    def _retry_delay(self, error: APIError, attempt: int) -> float:
+        """
+        再送までの待ち時間
+        
+        Retry-Afterがあればその最大RETRY_AFTER_JITTER倍の揺らぎを足し、無ければ指数バックオフの
+        範囲からランダムに選ぶ（同時に429を受けたリクエストの再送がそろわないようにする）。
+        """
+        if error.retry_after is not None:
+            return error.retry_after * (1 + random.uniform(0, RETRY_AFTER_JITTER))
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
     
     def _send_ollama_request(self, prompt: str, model: str, max_tokens: int, 
-                           temperature: float) -> Dict[str, Any]:
-        """Ollama API用のリクエスト送信"""
+                           temperature: float,
+                           messages: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
+        """Ollama API用のリクエスト送信（会話履歴がある場合は /api/chat を使う）"""
         payload = {
             "model": model,
-            "prompt": prompt,
-            "stream": False,
+            "stream": self.stream,
             "options": {
                 "num_predict": max_tokens,
                 "temperature": temperature
             }
         }
+        if messages:
+            payload["messages"] = messages
+            endpoint = "/api/chat"
+        else:
+            payload["prompt"] = prompt
+            endpoint = "/api/generate"
         
         headers = {"Content-Type": "application/json"}
-        url = f"{self.base_url}/api/generate"
+        url = f"{self.base_url}{endpoint}"
         
+        phases = _reset_phases()
         start_time = time.time()
-        response = requests.post(url, headers=headers, json=payload, timeout=120)
-        end_time = time.time()
+        # ヘッダー受信とボディ受信を分けて計測するため常にstream=Trueで受け取る
+        response = self.session.post(url, headers=headers, json=payload, timeout=120,
+                                     stream=True)
+        headers_time = time.time()
         
         if response.status_code != 200:
-            raise Exception(f"Ollama API request failed: {response.status_code} - {response.text}")
+            raise APIError(response.status_code,
+                           f"Ollama API request failed: {response.status_code} - {response.text}",
+                           parse_retry_after(response.headers.get('Retry-After')))
         
-        result = response.json()
+        if self.stream:
+            result = self._read_ollama_stream(response)
+        else:
+            result = response.json()
+        end_time = time.time()
         result['response_time'] = end_time - start_time
+        result['start_time'] = start_time
+        result['end_time'] = end_time
+        result['phases'] = self._phase_breakdown(phases, start_time, headers_time, end_time)
         return result
     
     def _send_openai_request(self, prompt: str, model: str, max_tokens: int, 
-                           temperature: float) -> Dict[str, Any]:
+                           temperature: float,
+                           messages: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
         """OpenAI/LiteLLM API用のリクエスト送信"""
         payload = {
             "model": model,
-            "messages": [{"role": "user", "content": prompt}],
+            "messages": messages or [{"role": "user", "content": prompt}],
             "max_tokens": max_tokens,
             "temperature": temperature,
-            "stream": False
+            "stream": self.stream
         }
+        if self.stream:
+            # 最終チャンクでトークン使用量を返してもらう
+            payload["stream_options"] = {"include_usage": True}
         
         # クエリパラメータとしてAPIキーを追加（LiteLLMの特殊設定対応）
         if self.api_type == "litellm" or ("localhost" in self.base_url and not self.base_url.endswith("/v1")):
@@ -135,49 +1039,188 @@ class LLMSpeedEvaluator:
             url = f"{self.base_url}/chat/completions"
             headers = self.headers
         
+        phases = _reset_phases()
         start_time = time.time()
-        response = requests.post(url, headers=headers, json=payload, timeout=120)
-        end_time = time.time()
+        # ヘッダー受信とボディ受信を分けて計測するため常にstream=Trueで受け取る
+        response = self.session.post(url, headers=headers, json=payload, timeout=120,
+                                     stream=True)
+        headers_time = time.time()
         
         if response.status_code != 200:
-            raise Exception(f"API request failed: {response.status_code} - {response.text}")
+            raise APIError(response.status_code,
+                           f"API request failed: {response.status_code} - {response.text}",
+                           parse_retry_after(response.headers.get('Retry-After')))
         
-        result = response.json()
+        if self.stream:
+            result = self._read_openai_stream(response)
+        else:
+            result = response.json()
+        end_time = time.time()
         result['response_time'] = end_time - start_time
+        result['start_time'] = start_time
+        result['end_time'] = end_time
+        result['phases'] = self._phase_breakdown(phases, start_time, headers_time, end_time)
         
         if 'choices' not in result or not result['choices']:
             print(f"DEBUG: Unexpected API response structure: {result}")
         
         return result
     
+    def _phase_breakdown(self, phases: Dict[str, float], start_time: float,
+                         headers_time: float, end_time: float) -> Dict[str, float]:
+        """接続確立・ヘッダー待ち・ボディ受信の時間を通信フェーズ別にまとめる"""
+        setup_time = phases['dns'] + phases['connect'] + phases['tls']
+        return {
+            'dns_time': phases['dns'],
+            'connect_time': phases['connect'],
+            'tls_time': phases['tls'],
+            'ttfb': max(0.0, headers_time - start_time - setup_time),
+            'transfer_time': end_time - headers_time
+        }
+    
+    def _read_openai_stream(self, response: requests.Response) -> Dict[str, Any]:
+        """
+        OpenAI形式のSSEストリームを読み取り、非ストリーミング時と同じ形のレスポンスに組み立てる
+        
+        コンテンツを含むチャンクの受信時刻を 'token_times' に記録する。
+        """
+        content_parts = []
+        token_times = []
+        finish_reason = None
+        usage = {}
+        
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                # 接続をプールに戻せるよう、ストリームの終端まで読み切る
+                continue
+            chunk = json.loads(data)
+            if chunk.get('usage'):
+                usage = chunk['usage']
+            for choice in chunk.get('choices') or []:
+                delta = choice.get('delta') or {}
+                text = delta.get('content') or choice.get('text')
+                if text:
+                    token_times.append(time.time())
+                    content_parts.append(text)
+                if choice.get('finish_reason'):
+                    finish_reason = choice['finish_reason']
+        
+        return {
+            'choices': [{
+                'message': {'role': 'assistant', 'content': ''.join(content_parts)},
+                'finish_reason': finish_reason
+            }],
+            'usage': usage,
+            'token_times': token_times
+        }
+    
+    def _read_ollama_stream(self, response: requests.Response) -> Dict[str, Any]:
+        """
+        OllamaのNDJSONストリームを読み取り、非ストリーミング時と同じ形のレスポンスに組み立てる
+        
+        コンテンツを含む行の受信時刻を 'token_times' に記録する。
+        """
+        content_parts = []
+        token_times = []
+        result = {}
+        
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line:
+                continue
+            chunk = json.loads(line)
+            # /api/generate は 'response'、/api/chat は 'message' にテキストが入る
+            text = chunk.get('response') or (chunk.get('message') or {}).get('content')
+            if text:
+                token_times.append(time.time())
+                content_parts.append(text)
+            if chunk.get('done'):
+                # 最終行にはeval_countなどの統計情報が含まれる
+                result = chunk
+        
+        result['response'] = ''.join(content_parts)
+        result['token_times'] = token_times
+        return result
+    
+    def _stream_metrics(self, response: Dict[str, Any], prompt_tokens: int,
+                        completion_tokens: int) -> Dict[str, Any]:
+        """ストリーミングで記録した受信時刻からTTFT・トークン間隔・プレフィル/デコード速度を算出"""
+        token_times = response.get('token_times')
+        if not token_times:
+            return {}
+        
+        first_token_time = token_times[0]
+        gaps = [b - a for a, b in zip(token_times, token_times[1:])]
+        decode_time = response['end_time'] - first_token_time
+        # 最初のトークンはプレフィル側に含め、残りのトークンでデコード速度を求める
+        decode_tokens_per_second = (completion_tokens - 1) / decode_time if decode_time > 0 and completion_tokens > 1 else 0
+        # サーバー側の計測が無い場合は、TTFTをプロンプト処理時間とみなす（通信時間を含む概算）
+        ttft = first_token_time - response['start_time']
+        prefill_tokens_per_second = prompt_tokens / ttft if ttft > 0 and prompt_tokens > 0 else 0
+        
+        return {
+            'ttft': ttft,
+            'inter_token_latencies': gaps,
+            'decode_tokens_per_second': decode_tokens_per_second,
+            'prefill_tokens_per_second': prefill_tokens_per_second
+        }
+    
     def evaluate_single_prompt(self, prompt: str, model: str, 
-                             max_tokens: int = 500) -> TestResult:
+                             max_tokens: int = 500,
+                             messages: Optional[List[Dict[str, str]]] = None) -> TestResult:
         """
         単一のプロンプトで評価を実行
         
         Args:
-            prompt: テストプロンプト
+            prompt: テストプロンプト（messages指定時はトークン数の推定にのみ使う）
             model: モデル名
             max_tokens: 最大トークン数
-            
+            messages: 会話履歴（指定時はpromptの代わりに送る）
+        
         Returns:
             テスト結果
         """
+        return self._evaluate(prompt, model, max_tokens, messages)[0]
+    
+    def _evaluate(self, prompt: str, model: str, max_tokens: int,
+                  messages: Optional[List[Dict[str, str]]] = None) -> Tuple[TestResult, str]:
+        """評価を1件実行し、結果と応答本文（会話履歴に追加する用）を返す"""
         print(f"Testing prompt (length: {len(prompt)} chars)...")
         
-        response = self.send_request(prompt, model, max_tokens)
-        
-        # API種別に応じてレスポンスを解析
-        if self.api_type == "ollama":
-            return self._parse_ollama_response(response, prompt, model)
-        else:
-            return self._parse_openai_response(response, prompt, model)
+        with self._in_flight_lock:
+            self.in_flight += 1
+        try:
+            response = self.send_request(prompt, model, max_tokens, messages=messages)
+            
+            # API種別に応じてレスポンスを解析
+            if self.api_type == "ollama":
+                result = self._parse_ollama_response(response, prompt, model)
+                content = response.get('response') or (response.get('message') or {}).get('content', '')
+            else:
+                result = self._parse_openai_response(response, prompt, model)
+                choice = (response.get('choices') or [{}])[0]
+                content = (choice.get('message') or {}).get('content') or choice.get('text') or ''
+        except Exception as e:
+            self.metrics.count_event('failed')
+            if self.live:
+                self.live.record(None, str(e))
+            raise
+        finally:
+            with self._in_flight_lock:
+                self.in_flight -= 1
+        result.target = self.target
+        if self.live:
+            self.live.record(result)
+        return result, content
     
     def _parse_ollama_response(self, response: Dict[str, Any], prompt: str, 
                              model: str) -> TestResult:
         """Ollamaレスポンスの解析"""
         # Ollamaのレスポンス構造: {"response": "text", "done": true, ...}
-        content = response.get('response', '')
+        # （/api/chat の場合は {"message": {"content": "text"}, ...}）
+        content = response.get('response') or (response.get('message') or {}).get('content', '')
         
         if not content:
             print(f"    ⚠ Warning: No response content from Ollama")
@@ -188,18 +1231,31 @@ class LLMSpeedEvaluator:
         eval_count = response.get('eval_count', 0)
         
         # トークン数が提供されない場合は推定
-        prompt_tokens = prompt_eval_count if prompt_eval_count > 0 else self.count_tokens_estimate(prompt)
-        completion_tokens = eval_count if eval_count > 0 else self.count_tokens_estimate(content)
+        prompt_tokens = prompt_eval_count if prompt_eval_count > 0 else self.count_tokens(prompt, model)
+        completion_tokens = eval_count if eval_count > 0 else self.count_tokens(content, model)
         total_tokens = prompt_tokens + completion_tokens
         
         response_time = response['response_time']
         tokens_per_second = completion_tokens / response_time if response_time > 0 and completion_tokens > 0 else 0
         
+        stream_metrics = self._stream_metrics(response, prompt_tokens, completion_tokens)
+        
+        # Ollamaのサーバー側タイマー（ナノ秒から秒に変換）。ロード時間を除いた
+        # プレフィル/デコード速度を求め、受信時刻からの概算より優先する
+        timers = {name: response[name] / 1e9
+                  for name in ('load_duration', 'prompt_eval_duration', 'eval_duration')
+                  if response.get(name) is not None}
+        if timers.get('prompt_eval_duration') and prompt_eval_count > 0:
+            stream_metrics['prefill_tokens_per_second'] = prompt_eval_count / timers['prompt_eval_duration']
+        if timers.get('eval_duration') and eval_count > 0:
+            stream_metrics['decode_tokens_per_second'] = eval_count / timers['eval_duration']
+        
         # Ollamaの追加情報を表示
         if 'total_duration' in response:
             total_duration_sec = response['total_duration'] / 1e9  # ナノ秒から秒に変換
             print(f"    📊 Ollama stats - Prompt tokens: {prompt_tokens}, Eval tokens: {completion_tokens}")
-            print(f"    ⏱  Total duration: {total_duration_sec:.2f}s, Eval duration: {response.get('eval_duration', 0) / 1e9:.2f}s")
+            print(f"    ⏱  Total duration: {total_duration_sec:.2f}s, Load: {timers.get('load_duration', 0):.2f}s, "
+                  f"Prompt eval: {timers.get('prompt_eval_duration', 0):.2f}s, Eval: {timers.get('eval_duration', 0):.2f}s")
         
         return TestResult(
             prompt_tokens=prompt_tokens,
@@ -208,7 +1264,12 @@ class LLMSpeedEvaluator:
             response_time=response_time,
             tokens_per_second=tokens_per_second,
             model=model,
-            prompt_length=len(prompt)
+            prompt_length=len(prompt),
+            start_time=response['start_time'],
+            end_time=response['end_time'],
+            **stream_metrics,
+            **timers,
+            **response.get('phases', {})
         )
     
     def _parse_openai_response(self, response: Dict[str, Any], prompt: str, 
@@ -239,7 +1300,7 @@ class LLMSpeedEvaluator:
         
         # トークン使用量を取得
         usage = response.get('usage', {})
-        prompt_tokens = usage.get('prompt_tokens', self.count_tokens_estimate(prompt))
+        prompt_tokens = usage['prompt_tokens'] if 'prompt_tokens' in usage else self.count_tokens(prompt, model)
         
         # Gemini特有の処理：text_tokensがある場合はそれを、なければcompletion_tokensを使用
         if 'completion_tokens_details' in usage and 'text_tokens' in usage['completion_tokens_details']:
@@ -247,7 +1308,8 @@ class LLMSpeedEvaluator:
             reasoning_tokens = usage['completion_tokens_details'].get('reasoning_tokens', 0)
             print(f"    📊 Tokens - Text: {completion_tokens}, Reasoning: {reasoning_tokens}")
         else:
-            completion_tokens = usage.get('completion_tokens', self.count_tokens_estimate(content))
+            completion_tokens = (usage['completion_tokens'] if 'completion_tokens' in usage
+                                 else self.count_tokens(content, model))
         
         # テキストトークンが0の場合の特別処理
         if completion_tokens == 0:
@@ -258,6 +1320,8 @@ class LLMSpeedEvaluator:
                 print(f"    📊 Using total completion tokens for calculation: {completion_tokens}")
         
         total_tokens = usage.get('total_tokens', prompt_tokens + completion_tokens)
+        # プレフィックスキャッシュに当たったトークン数（vLLMやOpenAIが返す場合のみ）
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
         
         response_time = response['response_time']
         tokens_per_second = completion_tokens / response_time if response_time > 0 and completion_tokens > 0 else 0
@@ -269,11 +1333,18 @@ class LLMSpeedEvaluator:
             response_time=response_time,
             tokens_per_second=tokens_per_second,
             model=model,
-            prompt_length=len(prompt)
+            prompt_length=len(prompt),
+            start_time=response['start_time'],
+            end_time=response['end_time'],
+            cached_tokens=cached_tokens,
+            **self._stream_metrics(response, prompt_tokens, completion_tokens),
+            **response.get('phases', {})
         )
     
     def run_evaluation(self, model: str, test_prompts: Optional[List[str]] = None, 
-                      max_tokens: int = 500, iterations: int = 1) -> List[TestResult]:
+                      max_tokens: int = 500, iterations: int = 1,
+                      concurrency: int = 1, rate: Optional[float] = None,
+                      arrival: str = "constant") -> List[TestResult]:
         """
         評価を実行
         
@@ -282,6 +1353,10 @@ class LLMSpeedEvaluator:
             test_prompts: テストプロンプトのリスト
             max_tokens: 最大トークン数
             iterations: 各プロンプトの実行回数
+            concurrency: 同時に送信するリクエスト数（1の場合は逐次実行）。
+                rate指定時は同時に処理中にできるリクエスト数の上限
+            rate: 指定した場合、毎秒rate件のペースで送信するオープンループで実行
+            arrival: オープンループでの到着間隔 ("constant" または "poisson")
             
         Returns:
             テスト結果のリスト
@@ -289,35 +1364,366 @@ class LLMSpeedEvaluator:
         if test_prompts is None:
             test_prompts = self.get_default_prompts()
         
-        results = []
         total_tests = len(test_prompts) * iterations
         current_test = 0
+        tasks = [BenchmarkTask(i, iteration, prompt)
+                 for i, prompt in enumerate(test_prompts)
+                 for iteration in range(iterations)]
         
         print(f"Starting evaluation for model: {model}")
         print(f"Total tests to run: {total_tests}")
+        results, tasks = self._resume_tasks(tasks)
+        
+        if rate:
+            print(f"Open-loop rate: {rate} req/s ({arrival} arrivals, max in flight: {concurrency})")
+        elif concurrency > 1:
+            print(f"Concurrency: {concurrency}")
         print("-" * 50)
         
-        for i, prompt in enumerate(test_prompts):
-            print(f"\nPrompt {i+1}/{len(test_prompts)}:")
+        if rate:
+            return results + self._run_open_loop(model, tasks, max_tokens, rate, arrival, concurrency)
+        if concurrency > 1:
+            return results + self._run_concurrent(model, tasks, max_tokens, concurrency)
+        
+        current_prompt = None
+        for task in tasks:
+            if task.prompt_index != current_prompt:
+                current_prompt = task.prompt_index
+                print(f"\nPrompt {task.prompt_index+1}/{len(test_prompts)}:")
             
-            for iteration in range(iterations):
-                current_test += 1
-                print(f"  Iteration {iteration+1}/{iterations} (Test {current_test}/{total_tests})")
+            current_test += 1
+            print(f"  Iteration {task.iteration+1}/{iterations} (Test {current_test}/{len(tasks)})")
+            
+            try:
+                result = self.evaluate_single_prompt(task.prompt, model, max_tokens)
+                results.append(result)
+                self._record_result(result, task)
+                print(f"    ✓ {result.completion_tokens} tokens in {result.response_time:.2f}s "
+                      f"({result.tokens_per_second:.2f} tokens/sec)")
                 
+                # リミッターが無い場合は、APIレート制限を考慮して少し待機
+                if not self.rate_limiter:
+                    time.sleep(0.5)
+            
+            except Exception as e:
+                print(f"    ✗ Error: {str(e)}")
+        
+        return results
+    
+    def run_adaptive(self, model: str, test_prompts: Optional[List[str]] = None,
+                     max_tokens: int = 500, target_ci: float = 0.05, warmup: int = 1,
+                     min_iterations: int = MIN_CI_SAMPLES, max_requests: Optional[int] = None,
+                     max_time: Optional[float] = None) -> List[TestResult]:
+        """
+        平均トークン/秒の95%信頼区間が目標の幅に収まるまで、プロンプトごとに繰り返し実行
+        
+        各プロンプトのウォームアップを捨て、最低min_iterations件ずつ計測したあとは、
+        信頼区間の相対幅が最も広い（ばらつきが大きい）プロンプトに1件ずつ予算を割り当てる。
+        全プロンプトが目標に収まるか、リクエスト数・時間の予算を使い切ると終了する。
+        
+        Args:
+            model: モデル名
+            test_prompts: テストプロンプトのリスト
+            max_tokens: 最大トークン数
+            target_ci: 目標とする信頼区間の半幅（平均に対する比率、0.05なら±5%）
+            warmup: 結果に含めないプロンプトごとのウォームアップ回数
+            min_iterations: 信頼区間を求める前に集めるプロンプトごとの件数
+            max_requests: 計測するリクエスト数の上限（ウォームアップを除く）
+            max_time: 実行時間の上限（秒）
+        
+        Returns:
+            テスト結果のリスト（ウォームアップを除く）
+        """
+        if test_prompts is None:
+            test_prompts = self.get_default_prompts()
+        
+        stats = [RunningStats() for _ in test_prompts]
+        next_iteration = [0] * len(test_prompts)
+        failures = [0] * len(test_prompts)
+        results = []
+        
+        print(f"Starting adaptive evaluation for model: {model}")
+        print(f"Target: 95% CI of mean tokens/sec within ±{target_ci:.1%} for each of {len(test_prompts)} prompts")
+        budget = [f"{max_requests} requests" if max_requests else None,
+                  f"{max_time:.0f}s" if max_time else None]
+        print(f"Budget: {', '.join(b for b in budget if b) or 'unlimited'}")
+        
+        # 再開時は完了済みの結果をサンプルとして引き継ぐ（ウォームアップは保存されていない）
+        if self.store and self.store.completed:
+            for key, result in self.store.completed.items():
+                i, iteration = (int(part) for part in key.split(':'))
+                if i < len(test_prompts):
+                    stats[i].add(result.tokens_per_second)
+                    results.append(result)
+                    self.metrics.record(result)
+                    next_iteration[i] = max(next_iteration[i], iteration + 1)
+            print(f"Resuming: {len(results)} tests already completed")
+        print("-" * 50)
+        
+        start = time.perf_counter()
+        measured = 0
+        
+        def budget_left() -> bool:
+            return ((max_requests is None or measured < max_requests)
+                    and (max_time is None or time.perf_counter() - start < max_time))
+        
+        def run_one(i: int):
+            nonlocal measured
+            task = BenchmarkTask(i, next_iteration[i], test_prompts[i])
+            next_iteration[i] += 1
+            measured += 1
+            try:
+                result = self.evaluate_single_prompt(task.prompt, model, max_tokens)
+            except Exception as e:
+                failures[i] += 1
+                print(f"    ✗ {task.label}: Error: {str(e)}")
+                return
+            results.append(result)
+            self._record_result(result, task)
+            if result.tokens_per_second <= 0:
+                # 平均が0のままでは信頼区間が決まらず収束しないので、失敗として数える
+                failures[i] += 1
+                print(f"    ✗ {task.label}: no output tokens")
+                return
+            failures[i] = 0
+            stats[i].add(result.tokens_per_second)
+            ci = stats[i].relative_ci()
+            ci_text = f"±{ci:.1%}" if math.isfinite(ci) else "-"
+            print(f"    ✓ {task.label}: {result.tokens_per_second:.2f} tokens/sec (n={stats[i].count}, CI {ci_text})")
+        
+        # ウォームアップ（接続確立やモデルのロードを含むので結果に入れない）
+        for i, prompt in enumerate(test_prompts):
+            if stats[i].count:
+                continue
+            for w in range(warmup):
+                print(f"  Warm-up {w+1}/{warmup} for prompt {i+1}")
                 try:
-                    result = self.evaluate_single_prompt(prompt, model, max_tokens)
+                    self.evaluate_single_prompt(prompt, model, max_tokens)
+                except Exception as e:
+                    print(f"    ✗ Warm-up error: {str(e)}")
+        
+        # 信頼区間を求めるための最低件数
+        for i in range(len(test_prompts)):
+            while (stats[i].count < min_iterations and failures[i] < MAX_CONSECUTIVE_FAILURES
+                   and budget_left()):
+                run_one(i)
+        
+        # 信頼区間が最も広いプロンプトから順に予算を使う
+        while budget_left():
+            pending = [i for i in range(len(test_prompts))
+                       if failures[i] < MAX_CONSECUTIVE_FAILURES and stats[i].relative_ci() > target_ci]
+            if not pending:
+                break
+            run_one(max(pending, key=lambda i: stats[i].relative_ci()))
+        
+        self._print_ci_summary(stats, failures, target_ci, measured, time.perf_counter() - start)
+        return results
+    
+    def _print_ci_summary(self, stats: List[RunningStats], failures: List[int], target_ci: float,
+                          measured: int, elapsed: float):
+        """--target-ciのプロンプトごとのサンプル数・平均・信頼区間を出力"""
+        print("\n" + "="*60)
+        print("ADAPTIVE SAMPLING")
+        print("="*60)
+        print(f"{'prompt':>6} {'n':>4} {'mean tok/s':>11} {'95% CI':>8}  status")
+        converged = 0
+        for i, stat in enumerate(stats):
+            ci = stat.relative_ci()
+            if ci <= target_ci:
+                status = "✓ converged"
+                converged += 1
+            elif failures[i] >= MAX_CONSECUTIVE_FAILURES:
+                status = "✗ failing"
+            else:
+                status = "budget exhausted"
+            ci_text = f"±{ci:.1%}" if math.isfinite(ci) else "-"
+            print(f"{i+1:>6} {stat.count:>4} {stat.mean:>11.2f} {ci_text:>8}  {status}")
+        print(f"\n{converged}/{len(stats)} prompts within ±{target_ci:.1%}; "
+              f"{measured} requests in {elapsed:.1f}s (warm-up excluded)")
+    
+    def _resume_tasks(self, tasks: List[BenchmarkTask]) -> Tuple[List[TestResult], List[BenchmarkTask]]:
+        """
+        再開時は完了済みの結果を引き継ぎ、残りのタスクだけを返す
+        
+        Returns:
+            (完了済みの結果のリスト, 未実行のタスクのリスト)
+        """
+        results = []
+        if not (self.store and self.store.completed):
+            return results, tasks
+        
+        for task in tasks:
+            if task.key in self.store.completed:
+                result = self.store.completed[task.key]
+                results.append(result)
+                self.metrics.record(result)
+        tasks = [task for task in tasks if task.key not in self.store.completed]
+        print(f"Resuming: {len(results)} tests already completed, {len(tasks)} remaining")
+        return results, tasks
+    
+    def _record_result(self, result: TestResult, task: BenchmarkTask):
+        """完了した結果を統計に反映し、結果ストアがあれば追記"""
+        self.metrics.record(result)
+        if self.store:
+            self.store.append(result, task)
+    
+    def _run_concurrent(self, model: str, tasks: List[BenchmarkTask], max_tokens: int,
+                        concurrency: int) -> List[TestResult]:
+        """
+        スレッドプールで常にconcurrency個のリクエストを並行させて評価を実行
+        
+        Returns:
+            テスト結果のリスト（完了順）
+        """
+        total_tests = len(tasks)
+        results = []
+        
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(self.evaluate_single_prompt, task.prompt, model,
+                                task.max_tokens or max_tokens): task
+                for task in tasks
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                task = futures[future]
+                label = f"[{done}/{total_tests}] {task.label}"
+                try:
+                    result = future.result()
                     results.append(result)
-                    print(f"    ✓ {result.completion_tokens} tokens in {result.response_time:.2f}s "
+                    self._record_result(result, task)
+                    print(f"  ✓ {label}: {result.completion_tokens} tokens in {result.response_time:.2f}s "
                           f"({result.tokens_per_second:.2f} tokens/sec)")
-                    
-                    # APIレート制限を考慮して少し待機
-                    time.sleep(0.5)
-                    
                 except Exception as e:
-                    print(f"    ✗ Error: {str(e)}")
+                    print(f"  ✗ {label}: Error: {str(e)}")
+        
+        return results
+    
+    def _arrival_offsets(self, count: int, rate: float, arrival: str) -> List[float]:
+        """開始時刻からの各リクエストの予定送信時刻（秒）を生成"""
+        if arrival == "poisson":
+            offsets = []
+            elapsed = 0.0
+            for _ in range(count):
+                offsets.append(elapsed)
+                elapsed += random.expovariate(rate)
+            return offsets
+        return [k / rate for k in range(count)]
+    
+    def _run_open_loop(self, model: str, tasks: List[BenchmarkTask], max_tokens: int,
+                       rate: Optional[float], arrival: str, max_in_flight: int) -> List[TestResult]:
+        """
+        サーバーの応答を待たずに予定時刻どおり送信するオープンループで評価を実行
+        
+        サーバーが遅くなっても送信ペースは落とさない。処理中のリクエストが上限に
+        達して送信が遅れた分も、予定送信時刻から測ったレイテンシ（corrected_latency）
+        に含めることで、coordinated omissionによるテールレイテンシの過小評価を防ぐ。
+        
+        タスクにoffsetがある場合（トレース再生）はその時刻どおりに送信し、
+        ない場合はrateとarrivalから送信時刻を生成する。
+        
+        Returns:
+            テスト結果のリスト（完了順）
+        """
+        total_tests = len(tasks)
+        if tasks and all(task.offset is not None for task in tasks):
+            # 再開時に残りのタスクの先頭から始まるよう、最初の送信時刻を0に揃える
+            first = min(task.offset for task in tasks)
+            offsets = [task.offset - first for task in tasks]
+        else:
+            offsets = self._arrival_offsets(total_tests, rate, arrival)
+        results = []
+        completed = []
+        lock = threading.Lock()
+        
+        def run_task(task: BenchmarkTask, scheduled_time: float) -> TestResult:
+            result = self.evaluate_single_prompt(task.prompt, model, task.max_tokens or max_tokens)
+            result.scheduled_time = scheduled_time
+            result.corrected_latency = result.end_time - scheduled_time
+            return result
+        
+        def report(future, task: BenchmarkTask):
+            with lock:
+                completed.append(future)
+                done = len(completed)
+            try:
+                result = future.result()
+                results.append(result)
+                self._record_result(result, task)
+                print(f"  ✓ [{done}/{total_tests}] {task.label}: {result.completion_tokens} tokens, "
+                      f"latency {result.corrected_latency:.2f}s "
+                      f"(queued {result.start_time - result.scheduled_time:.2f}s)")
+            except Exception as e:
+                print(f"  ✗ [{done}/{total_tests}] {task.label}: Error: {str(e)}")
+        
+        start_wall = time.time()
+        start_mono = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for task, offset in zip(tasks, offsets):
+                delay = offset - (time.perf_counter() - start_mono)
+                if delay > 0:
+                    time.sleep(delay)
+                future = executor.submit(run_task, task, start_wall + offset)
+                future.add_done_callback(lambda f, task=task: report(f, task))
         
         return results
     
+    def load_trace(self, filename: str, time_scale: float = 1.0,
+                   model: Optional[str] = None) -> List[BenchmarkTask]:
+        """
+        本番トラフィックのトレース（JSONL）を読み込み、再生用のタスクに変換
+        
+        各行は到着時刻（timestamp / arrival_time / time、エポック秒または相対秒）、
+        入力トークン数（prompt_tokens / input_tokens）、出力トークン数
+        （max_tokens / output_tokens / completion_tokens）を持つ。入力トークン数に
+        合わせた合成プロンプトを作り、到着間隔はtime_scale倍速に縮める。
+        """
+        def first_of(record: Dict[str, Any], names: List[str]) -> Optional[float]:
+            for name in names:
+                if record.get(name) is not None:
+                    return record[name]
+            return None
+        
+        entries = []
+        for number, record in enumerate(load_records(filename), start=1):
+            arrival = first_of(record, ['timestamp', 'arrival_time', 'time'])
+            prompt_tokens = first_of(record, ['prompt_tokens', 'input_tokens'])
+            if arrival is None or prompt_tokens is None:
+                print(f"⚠ Skipping trace line {number}: arrival time or prompt length missing")
+                continue
+            output_tokens = first_of(record, ['max_tokens', 'output_tokens', 'completion_tokens'])
+            entries.append((float(arrival), int(prompt_tokens), int(output_tokens) if output_tokens else None))
+        
+        if not entries:
+            return []
+        start = min(arrival for arrival, _, _ in entries)
+        entries.sort(key=lambda entry: entry[0])
+        return [
+            BenchmarkTask(i, 0, self.generate_prompt(prompt_tokens, model), max_tokens=output_tokens,
+                          offset=(arrival - start) / time_scale)
+            for i, (arrival, prompt_tokens, output_tokens) in enumerate(entries)
+        ]
+    
+    def run_trace(self, model: str, tasks: List[BenchmarkTask], max_tokens: int = 500,
+                  max_in_flight: int = DEFAULT_OPEN_LOOP_MAX_IN_FLIGHT) -> List[TestResult]:
+        """
+        トレースのタスクを記録された到着時刻どおりにオープンループで再生
+        
+        Args:
+            model: モデル名
+            tasks: load_traceで作成したタスク
+            max_tokens: トレースに出力トークン数が無いリクエストの最大トークン数
+            max_in_flight: 同時に処理中にできるリクエスト数の上限
+        
+        Returns:
+            テスト結果のリスト（完了順）
+        """
+        duration = max((task.offset for task in tasks), default=0.0)
+        print(f"Replaying trace for model: {model}")
+        print(f"Requests: {len(tasks)} over {duration:.1f}s (max in flight: {max_in_flight})")
+        results, tasks = self._resume_tasks(tasks)
+        print("-" * 50)
+        return results + self._run_open_loop(model, tasks, max_tokens, None, "constant", max_in_flight)
+    
     def get_default_prompts(self) -> List[str]:
         """デフォルトのテストプロンプトを取得（Gemini向けに最適化）"""
         return [
@@ -336,74 +1742,916 @@ class LLMSpeedEvaluator:
             "Create a detailed explanation of how the internet works. Include information about protocols, routers, DNS, web servers, and how data travels across networks."
         ]
     
-    def print_statistics(self, results: List[TestResult]):
-        """統計情報を出力"""
-        if not results:
+    def generate_prompt(self, input_tokens: int, model: Optional[str] = None) -> str:
+        """
+        モデルのトークナイザーで数えてinput_tokensになる合成プロンプトを生成
+        
+        同じ長さのプロンプトは同じ文字列オブジェクトを使い回す。
+        """
+        tokenizer = self.tokenizer_for(model) if model else self.tokenizer
+        key = (tokenizer.name, input_tokens)
+        if key not in self._prompt_cache:
+            self._prompt_cache[key] = self._build_prompt(input_tokens, tokenizer)
+        return self._prompt_cache[key]
+    
+    def _build_prompt(self, input_tokens: int, tokenizer: Tokenizer, variant: int = 0,
+                      header: str = "") -> str:
+        """
+        合成プロンプトを組み立てる
+        
+        encode/decodeできるトークナイザーではトークン列から直接組み立ててちょうどの長さにし、
+        推定しかできない場合は推定値がinput_tokensに達する最小の単語数にする。
+        variantを変えると本文の開始位置がずれ、同じ長さでも先頭以外が異なるプロンプトになる。
+        headerは先頭に置かれ、長さにも含めて数える（先頭から別のプロンプトにしたい場合に使う）。
+        """
+        instruction = header + PROMPT_INSTRUCTION
+        if tokenizer.exact:
+            filler_ids = tokenizer.encode(" " + FILLER_TEXT.strip())
+            body_tokens = max(1, input_tokens - len(tokenizer.encode(instruction)))
+            start = variant % len(filler_ids)
+            # 境界でトークンが結合・分割されて数がずれることがあるので、差分だけ本文を伸縮する
+            for _ in range(4):
+                repeats = (start + body_tokens) // len(filler_ids) + 1
+                ids = (filler_ids * repeats)[start:start + body_tokens]
+                prompt = instruction + tokenizer.decode(ids).lstrip()
+                diff = input_tokens - len(tokenizer.encode(prompt))
+                if diff == 0 or body_tokens + diff < 1:
+                    break
+                body_tokens += diff
+            return prompt
+        
+        # count_tokens_estimateと同じく「単語数の約1.3倍」で必要な単語数を逆算する
+        instruction_words = len(instruction.split())
+        target_words = max(1, round(input_tokens / 1.3) - instruction_words)
+        while int((instruction_words + target_words) * 1.3) < input_tokens:
+            target_words += 1
+        filler_words = FILLER_TEXT.split()
+        words = [filler_words[(variant + k) % len(filler_words)] for k in range(target_words)]
+        return instruction + " ".join(words)
+    
+    def _print_distribution(self, title: str, hist: LogHistogram, scale: float = 1.0,
+                            digits: int = 2):
+        """ヒストグラムの平均・パーセンタイル・最小/最大を出力"""
+        print(f"\n{title}:")
+        print(f"  Average: {hist.mean * scale:.{digits}f}")
+        for percent in REPORT_PERCENTILES:
+            label = f"p{percent:g}:"
+            print(f"  {label:<8} {hist.percentile(percent) * scale:.{digits}f}")
+        print(f"  Min:     {hist.min * scale:.{digits}f}")
+        print(f"  Max:     {hist.max * scale:.{digits}f}")
+        if hist.count > 1:
+            print(f"  Std Dev: {hist.stdev * scale:.{digits}f}")
+    
+    def print_statistics(self, results: List[TestResult],
+                         metrics: Optional[MetricsCollector] = None):
+        """
+        統計情報を出力
+        
+        Args:
+            results: テスト結果のリスト（詳細表示に使用）
+            metrics: 集計済みの指標（省略時は実行中に更新してきたself.metrics）
+        """
+        metrics = metrics or self.metrics
+        if not metrics.count:
             print("No results to analyze.")
+            self._print_reliability(metrics)
             return
         
-        tokens_per_sec = [r.tokens_per_second for r in results]
-        response_times = [r.response_time for r in results]
-        completion_tokens = [r.completion_tokens for r in results]
+        tokens_per_sec = metrics.get('tokens_per_second')
         
         print("\n" + "="*60)
         print("EVALUATION RESULTS")
         print("="*60)
         
-        print(f"Model: {results[0].model}")
-        print(f"Total tests: {len(results)}")
-        print(f"Successful tests: {len([r for r in results if r.tokens_per_second > 0])}")
-        
-        print("\nTokens per Second:")
-        print(f"  Average: {statistics.mean(tokens_per_sec):.2f}")
-        print(f"  Median:  {statistics.median(tokens_per_sec):.2f}")
-        print(f"  Min:     {min(tokens_per_sec):.2f}")
-        print(f"  Max:     {max(tokens_per_sec):.2f}")
-        if len(tokens_per_sec) > 1:
-            print(f"  Std Dev: {statistics.stdev(tokens_per_sec):.2f}")
-        
-        print("\nResponse Time (seconds):")
-        print(f"  Average: {statistics.mean(response_times):.2f}")
-        print(f"  Median:  {statistics.median(response_times):.2f}")
-        print(f"  Min:     {min(response_times):.2f}")
-        print(f"  Max:     {max(response_times):.2f}")
-        
-        print("\nCompletion Tokens:")
-        print(f"  Average: {statistics.mean(completion_tokens):.0f}")
-        print(f"  Median:  {statistics.median(completion_tokens):.0f}")
-        print(f"  Min:     {min(completion_tokens)}")
-        print(f"  Max:     {max(completion_tokens)}")
+        if results:
+            print(f"Model: {', '.join(sorted({result.model for result in results}))}")
+        print(f"Total tests: {metrics.count}")
+        print(f"Successful tests: {tokens_per_sec.count - tokens_per_sec.zero_count}")
+        
+        self._print_distribution("Tokens per Second (per request)", tokens_per_sec)
+        
+        # 全ストリーム合計のスループット（最初の送信から最後の受信までの実時間基準）
+        wall_time = metrics.last_end - metrics.first_start
+        if wall_time > 0:
+            print("\nAggregate Throughput (all streams):")
+            print(f"  Wall time:   {wall_time:.2f}s")
+            print(f"  Tokens/sec:  {metrics.total_completion_tokens / wall_time:.2f}")
+            print(f"  Requests/sec: {metrics.count / wall_time:.2f}")
+        
+        self._print_distribution("Response Time (seconds)", metrics.get('response_time'))
+        
+        # ストリーミングモードの指標
+        if metrics.get('ttft'):
+            self._print_distribution("Time to First Token (seconds)", metrics.get('ttft'), digits=3)
+        if metrics.get('inter_token_latency'):
+            self._print_distribution("Inter-Token Latency (ms)", metrics.get('inter_token_latency'),
+                                     scale=1000, digits=1)
+        if metrics.get('prefill_tokens_per_second'):
+            self._print_distribution("Prefill Tokens per Second (prompt processing)",
+                                     metrics.get('prefill_tokens_per_second'))
+        if metrics.get('decode_tokens_per_second'):
+            self._print_distribution("Decode Tokens per Second (excluding prefill)",
+                                     metrics.get('decode_tokens_per_second'))
+        
+        # Ollamaのサーバー側タイマー（ロード時間の外れ値を生成速度と切り分ける）
+        if metrics.get('eval_duration'):
+            print("\nOllama Server Timers (average / max seconds):")
+            for label, name in [('Load', 'load_duration'), ('Prompt eval', 'prompt_eval_duration'),
+                                ('Eval', 'eval_duration')]:
+                hist = metrics.get(name)
+                if hist:
+                    print(f"  {label + ':':<13}{hist.mean:.3f} / {hist.max:.3f}")
+        
+        # オープンループの指標（予定送信時刻基準のレイテンシ）
+        if metrics.get('corrected_latency'):
+            self._print_distribution("Latency from Intended Send Time (seconds)",
+                                     metrics.get('corrected_latency'))
+            queue_delay = metrics.get('queue_delay')
+            print(f"  Queue delay avg/max: {queue_delay.mean:.2f}/{queue_delay.max:.2f}")
+        
+        # 通信フェーズ別の内訳（モデル速度とネットワークのオーバーヘッドを切り分ける）
+        print("\nNetwork Phases (average ms):")
+        print(f"  DNS:      {metrics.get('dns_time').mean * 1000:.1f}")
+        print(f"  Connect:  {metrics.get('connect_time').mean * 1000:.1f}")
+        print(f"  TLS:      {metrics.get('tls_time').mean * 1000:.1f}")
+        print(f"  TTFB:     {metrics.get('ttfb').mean * 1000:.1f}")
+        print(f"  Transfer: {metrics.get('transfer_time').mean * 1000:.1f}")
+        print(f"  New connections: {metrics.new_connections}/{metrics.count}")
+        
+        self._print_distribution("Completion Tokens", metrics.get('completion_tokens'), digits=0)
+        self._print_reliability(metrics)
+        
+        if not results:
+            return
         
         print("\nDetailed Results:")
         print("-" * 60)
         for i, result in enumerate(results):
-            print(f"Test {i+1:2d}: {result.completion_tokens:3d} tokens, "
-                  f"{result.response_time:5.2f}s, {result.tokens_per_second:6.2f} tok/sec")
+            line = (f"Test {i+1:2d}: {result.completion_tokens:3d} tokens, "
+                    f"{result.response_time:5.2f}s, {result.tokens_per_second:6.2f} tok/sec")
+            if result.ttft is not None:
+                line += f", TTFT {result.ttft:5.3f}s"
+            if result.prefill_tokens_per_second > 0:
+                line += f", prefill {result.prefill_tokens_per_second:7.1f} tok/sec"
+            if result.decode_tokens_per_second > 0:
+                line += f", decode {result.decode_tokens_per_second:6.2f} tok/sec"
+            if result.load_duration:
+                line += f", load {result.load_duration:5.2f}s"
+            print(line)
+    
+    def _print_reliability(self, metrics: MetricsCollector):
+        """レート制限による待機・再送・失敗の件数を出力（どれかがあった場合のみ）"""
+        counters = metrics.counters
+        if not any(counters.values()):
+            return
+        print("\nRate Limiting and Errors:")
+        print(f"  Throttled by client limiter: {counters['throttled']:.0f} "
+              f"(total wait {counters['throttle_wait']:.1f}s)")
+        print(f"  429/503 responses:           {counters['rate_limited']:.0f}")
+        print(f"  Retried:                     {counters['retried']:.0f}")
+        print(f"  Failed:                      {counters['failed']:.0f}")
+    
+    def save_histograms(self, filename: str):
+        """集計済みのヒストグラムをJSONファイルに保存（後で他の実行結果と合算できる）"""
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.metrics.to_dict(), f, ensure_ascii=False)
+        
+        print(f"Histograms saved to: {filename}")
+    
+    @staticmethod
+    def load_histograms(filenames: List[str]) -> MetricsCollector:
+        """保存済みのヒストグラムを読み込んで合算"""
+        merged = MetricsCollector()
+        for filename in filenames:
+            with open(filename, 'r', encoding='utf-8') as f:
+                merged.merge(MetricsCollector.from_dict(json.load(f)))
+        return merged
     
     def save_results(self, results: List[TestResult], filename: str):
         """結果をJSONファイルに保存"""
-        data = []
-        for result in results:
-            data.append({
-                'model': result.model,
-                'prompt_tokens': result.prompt_tokens,
-                'completion_tokens': result.completion_tokens,
-                'total_tokens': result.total_tokens,
-                'response_time': result.response_time,
-                'tokens_per_second': result.tokens_per_second,
-                'prompt_length': result.prompt_length,
-                'timestamp': time.time()
-            })
+        data = [result_to_dict(result) for result in results]
         
         with open(filename, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2, ensure_ascii=False)
         
         print(f"\nResults saved to: {filename}")
+    
+    def compare_runs(self, baseline: List[Dict[str, Any]], candidate: List[Dict[str, Any]],
+                     threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> bool:
+        """
+        新しい実行結果をベースラインと比較
+        
+        平均トークン/秒の低下、またはp99レスポンス時間（両方にある場合はp99 TTFTも）の
+        悪化がthresholdの比率を超えたものを回帰とみなす。
+        
+        Args:
+            baseline: ベースラインの結果レコード
+            candidate: 比較対象の結果レコード
+            threshold: 回帰とみなす変化率（0.1なら10%）
+        
+        Returns:
+            回帰がなければTrue
+        """
+        def summarize(records: List[Dict[str, Any]]) -> Dict[str, Optional[float]]:
+            tps = LogHistogram()
+            latency = LogHistogram()
+            ttft = LogHistogram()
+            for record in records:
+                tps.record(record['tokens_per_second'])
+                latency.record(record['response_time'])
+                if record.get('ttft') is not None:
+                    ttft.record(record['ttft'])
+            return {
+                'mean_tokens_per_second': tps.mean,
+                'p99_response_time': latency.percentile(99),
+                'p99_ttft': ttft.percentile(99) if ttft.count else None
+            }
+        
+        base = summarize(baseline)
+        cand = summarize(candidate)
+        # (指標名, 大きい方が良いか)
+        checks = [('mean_tokens_per_second', True), ('p99_response_time', False), ('p99_ttft', False)]
+        
+        print("\n" + "="*60)
+        print("BASELINE COMPARISON")
+        print("="*60)
+        print(f"Baseline: {len(baseline)} results, candidate: {len(candidate)} results, "
+              f"threshold: {threshold:.0%}")
+        print(f"{'metric':<24} {'baseline':>10} {'candidate':>10} {'change':>8}")
+        
+        passed = True
+        for name, higher_is_better in checks:
+            if base[name] is None or cand[name] is None or base[name] <= 0:
+                continue
+            change = cand[name] / base[name] - 1
+            regressed = -change > threshold if higher_is_better else change > threshold
+            status = "✗ REGRESSION" if regressed else "✓"
+            print(f"{name:<24} {base[name]:>10.3f} {cand[name]:>10.3f} {change:>+8.1%} {status}")
+            passed &= not regressed
+        
+        print("\nResult: " + ("PASS" if passed else "FAIL"))
+        return passed
+    
+    def run_sweep(self, model: str, concurrencies: List[int], max_tokens_list: List[int],
+                  input_tokens_list: List[Optional[int]], test_prompts: Optional[List[str]] = None,
+                  requests_per_cell: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        同時実行数 × 最大トークン数 × 入力長の全組み合わせで評価を実行
+        
+        Args:
+            model: モデル名
+            concurrencies: 同時実行数のリスト
+            max_tokens_list: 最大トークン数のリスト
+            input_tokens_list: 入力トークン数のリスト（Noneの場合はtest_promptsを使用）
+            test_prompts: 入力長を指定しない場合のプロンプト
+            requests_per_cell: 1つの組み合わせで送るリクエスト数
+                （省略時は同時実行数の4倍とプロンプト数の大きい方）
+            
+        Returns:
+            組み合わせごとの集計結果のリスト
+        """
+        if test_prompts is None:
+            test_prompts = self.get_default_prompts()
+        
+        rows = []
+        cells = [(c, m, n) for n in input_tokens_list for m in max_tokens_list for c in sorted(concurrencies)]
+        for cell, (concurrency, max_tokens, input_tokens) in enumerate(cells, start=1):
+            prompts = [self.generate_prompt(input_tokens, model)] if input_tokens else test_prompts
+            count = requests_per_cell or max(concurrency * 4, len(prompts))
+            tasks = [BenchmarkTask(k % len(prompts), k // len(prompts), prompts[k % len(prompts)])
+                     for k in range(count)]
+            
+            print(f"\n=== Sweep {cell}/{len(cells)}: concurrency={concurrency}, "
+                  f"max_tokens={max_tokens}, input_tokens={input_tokens or 'default'} ===")
+            # 組み合わせごとに統計を取り直す。逐次実行時の待機を入れないよう常にスレッドプールで送る
+            self.metrics = MetricsCollector()
+            self._run_concurrent(model, tasks, max_tokens, concurrency)
+            rows.append(self._sweep_row(concurrency, max_tokens, input_tokens, count))
+        
+        return rows
+    
+    def _sweep_row(self, concurrency: int, max_tokens: int, input_tokens: Optional[int],
+                   requests_sent: int) -> Dict[str, Any]:
+        """現在のself.metricsからスイープ1組み合わせ分の集計結果を作成"""
+        metrics = self.metrics
+        row = {
+            'concurrency': concurrency,
+            'max_tokens': max_tokens,
+            'input_tokens': input_tokens,
+            'requests': requests_sent,
+            'succeeded': metrics.count,
+            'aggregate_tokens_per_second': 0.0,
+            'requests_per_second': 0.0,
+            'mean_tokens_per_second': 0.0,
+            'p50_latency': None,
+            'p99_latency': None,
+            'p99_ttft': None
+        }
+        if not metrics.count:
+            return row
+        
+        wall_time = metrics.last_end - metrics.first_start
+        latency = metrics.get('response_time')
+        if wall_time > 0:
+            row['aggregate_tokens_per_second'] = metrics.total_completion_tokens / wall_time
+            row['requests_per_second'] = metrics.count / wall_time
+        row['mean_tokens_per_second'] = metrics.get('tokens_per_second').mean
+        row['p50_latency'] = latency.percentile(50)
+        row['p99_latency'] = latency.percentile(99)
+        if metrics.get('ttft'):
+            row['p99_ttft'] = metrics.get('ttft').percentile(99)
+        return row
+    
+    def find_knees(self, rows: List[Dict[str, Any]],
+                   efficiency_threshold: float = DEFAULT_KNEE_EFFICIENCY) -> List[Dict[str, Any]]:
+        """
+        最大トークン数・入力長の組み合わせごとに、同時実行数に対する飽和点（ニー）を探す
+        
+        同時実行数を増やしたときの合計トークン/秒の伸びが、同時実行数の伸びに対して
+        efficiency_threshold未満に落ち、かつp99レイテンシが悪化し始めた直前の点をニーとする。
+        
+        Returns:
+            ニーとなった行のリスト（'saturated' が False なら最後まで飽和しなかった）
+        """
+        groups: Dict[tuple, List[Dict[str, Any]]] = {}
+        for row in rows:
+            if row['p99_latency'] is not None:
+                groups.setdefault((row['max_tokens'], row['input_tokens']), []).append(row)
+        
+        knees = []
+        for group in groups.values():
+            group.sort(key=lambda r: r['concurrency'])
+            knee = dict(group[-1], saturated=False)
+            for prev, cur in zip(group, group[1:]):
+                concurrency_gain = cur['concurrency'] / prev['concurrency'] - 1
+                throughput_gain = (cur['aggregate_tokens_per_second'] / prev['aggregate_tokens_per_second'] - 1
+                                   if prev['aggregate_tokens_per_second'] > 0 else 0)
+                latency_growth = cur['p99_latency'] / prev['p99_latency'] - 1 if prev['p99_latency'] > 0 else 0
+                if (concurrency_gain > 0 and throughput_gain / concurrency_gain < efficiency_threshold
+                        and latency_growth > KNEE_LATENCY_GROWTH):
+                    knee = dict(prev, saturated=True)
+                    break
+            knees.append(knee)
+        return knees
+    
+    def print_sweep(self, rows: List[Dict[str, Any]], knees: List[Dict[str, Any]]):
+        """スイープ結果のスループット対レイテンシ表とニーを出力"""
+        print("\n" + "="*60)
+        print("SWEEP RESULTS")
+        print("="*60)
+        print(f"{'conc':>5} {'max_tok':>8} {'input':>7} {'ok/req':>8} "
+              f"{'agg tok/s':>10} {'req/s':>7} {'p50 lat':>8} {'p99 lat':>8} {'p99 TTFT':>9}")
+        for row in rows:
+            def fmt(value, width, digits=2):
+                return f"{value:>{width}.{digits}f}" if value is not None else f"{'-':>{width}}"
+            print(f"{row['concurrency']:>5} {row['max_tokens']:>8} {str(row['input_tokens'] or '-'):>7} "
+                  f"{str(row['succeeded']) + '/' + str(row['requests']):>8} "
+                  f"{fmt(row['aggregate_tokens_per_second'], 10)} {fmt(row['requests_per_second'], 7)} "
+                  f"{fmt(row['p50_latency'], 8)} {fmt(row['p99_latency'], 8)} {fmt(row['p99_ttft'], 9, 3)}")
+        
+        print("\nSaturation Knee:")
+        for knee in knees:
+            label = f"max_tokens={knee['max_tokens']}, input_tokens={knee['input_tokens'] or 'default'}"
+            status = "" if knee['saturated'] else " (not saturated within the sweep)"
+            print(f"  {label}: concurrency {knee['concurrency']} - "
+                  f"{knee['aggregate_tokens_per_second']:.2f} tok/s, p99 {knee['p99_latency']:.2f}s{status}")
+    
+    def run_context_scaling(self, model: str, lengths: List[int], max_tokens: int,
+                            iterations: int) -> List[Dict[str, Any]]:
+        """
+        入力トークン数を変えながら1件ずつ送信し、TTFTとプレフィル速度の伸び方を計測
+        
+        同時実行による待ち時間が混ざらないよう逐次実行する。サーバーのプレフィックス
+        キャッシュに当たらないよう、実行・入力長・繰り返しごとに異なる識別子を先頭に置いた
+        プロンプトを送信時に組み立てる（短いプロンプトが長いプロンプトの先頭と一致しない。
+        保持はしないので長いプロンプトでもメモリは増えない）。
+        
+        Args:
+            model: モデル名
+            lengths: 入力トークン数のリスト
+            max_tokens: 最大トークン数（プレフィルを見るので小さい値でよい）
+            iterations: 入力長ごとの繰り返し回数
+        
+        Returns:
+            入力長ごとの集計結果のリスト
+        """
+        tokenizer = self.tokenizer_for(model)
+        print(f"Context scaling for model: {model} (tokenizer: {tokenizer.name})")
+        # モデルのロード時間が最初の入力長に混ざらないよう、結果に含めないリクエストを1件送る
+        print("Warming up...")
+        try:
+            self.evaluate_single_prompt(self.get_default_prompts()[0], model, 1)
+        except Exception as e:
+            print(f"  ✗ Warm-up failed: {str(e)}")
+        
+        run_id = f"{random.getrandbits(32):08x}"
+        rows = []
+        for length in sorted(lengths):
+            print(f"\n=== Input tokens: {length} ===")
+            self.metrics = MetricsCollector()
+            prompt_tokens = []
+            for iteration in range(iterations):
+                prompt = self._build_prompt(length, tokenizer, variant=iteration,
+                                            header=f"Request {run_id}-{length}-{iteration}:\n")
+                try:
+                    result = self.evaluate_single_prompt(prompt, model, max_tokens)
+                    self.metrics.record(result)
+                    prompt_tokens.append(result.prompt_tokens)
+                    ttft = f"{result.ttft:.3f}s" if result.ttft is not None else "-"
+                    print(f"  ✓ Iteration {iteration+1}/{iterations}: {result.prompt_tokens} prompt tokens, "
+                          f"TTFT {ttft}, prefill {result.prefill_tokens_per_second:.1f} tok/sec")
+                except Exception as e:
+                    print(f"  ✗ Iteration {iteration+1}/{iterations}: Error: {str(e)}")
+            rows.append(self._context_row(length, iterations, prompt_tokens))
+        
+        return rows
+    
+    def _context_row(self, input_tokens: int, requests_sent: int,
+                     prompt_tokens: List[int]) -> Dict[str, Any]:
+        """現在のself.metricsからコンテキスト長1件分の集計結果を作成"""
+        metrics = self.metrics
+        ttft = metrics.get('ttft')
+        prefill = metrics.get('prefill_tokens_per_second')
+        decode = metrics.get('decode_tokens_per_second')
+        return {
+            'input_tokens': input_tokens,
+            'prompt_tokens': round(sum(prompt_tokens) / len(prompt_tokens)) if prompt_tokens else None,
+            'requests': requests_sent,
+            'succeeded': metrics.count,
+            'p50_ttft': ttft.percentile(50) if ttft else None,
+            'p95_ttft': ttft.percentile(95) if ttft else None,
+            'mean_prefill_tokens_per_second': prefill.mean if prefill else None,
+            'mean_decode_tokens_per_second': decode.mean if decode else None
+        }
+    
+    def print_context_scaling(self, rows: List[Dict[str, Any]]):
+        """入力長ごとのTTFTとプレフィル速度の表を、TTFTの棒グラフ付きで出力"""
+        print("\n" + "="*60)
+        print("CONTEXT SCALING RESULTS")
+        print("="*60)
+        print(f"{'input':>7} {'prompt':>7} {'ok/req':>7} {'p50 TTFT':>9} {'p95 TTFT':>9} "
+              f"{'prefill/s':>10} {'decode/s':>9}  TTFT")
+        max_ttft = max((row['p50_ttft'] or 0 for row in rows), default=0)
+        for row in rows:
+            def fmt(value, width, digits=2):
+                return f"{value:>{width}.{digits}f}" if value is not None else f"{'-':>{width}}"
+            bar = "#" * round(30 * row['p50_ttft'] / max_ttft) if row['p50_ttft'] and max_ttft > 0 else ""
+            print(f"{row['input_tokens']:>7} {str(row['prompt_tokens'] or '-'):>7} "
+                  f"{str(row['succeeded']) + '/' + str(row['requests']):>7} "
+                  f"{fmt(row['p50_ttft'], 9, 3)} {fmt(row['p95_ttft'], 9, 3)} "
+                  f"{fmt(row['mean_prefill_tokens_per_second'], 10, 1)} "
+                  f"{fmt(row['mean_decode_tokens_per_second'], 9)}  {bar}")
+        
+        # 入力長が伸びたときのTTFTの伸び（1より大きく伸びるほど入力長に対して超線形）
+        measured = [row for row in rows if row['p50_ttft']]
+        if len(measured) >= 2:
+            first, last = measured[0], measured[-1]
+            print(f"\nTTFT grew {last['p50_ttft'] / first['p50_ttft']:.1f}x for "
+                  f"{last['input_tokens'] / first['input_tokens']:.1f}x input tokens "
+                  f"({first['input_tokens']} -> {last['input_tokens']})")
+    
+    def run_prefix_cache(self, model: str, prefix_tokens: int, families: int,
+                         requests_per_family: int, turns: int,
+                         max_tokens: int) -> List[Dict[str, Any]]:
+        """
+        共通プレフィックスを持つプロンプト群を送り、プレフィックスキャッシュの効果を計測
+        
+        プレフィックスごとに最初の1件（cold）を送ったあと、同じプレフィックスに別の質問を
+        付けたリクエスト（warm）をプレフィックスを順に切り替えながら送る。さらに会話ごとに
+        turnsターン分、伸びていく会話履歴をmessagesとして送り直す。過去の実行のキャッシュに
+        当たらないよう、プレフィックスの先頭には実行ごとに異なるIDを入れる。
+        待ち時間が混ざらないよう1件ずつ送信する。
+        
+        Args:
+            model: モデル名
+            prefix_tokens: 共通プレフィックスのトークン数
+            families: プレフィックスの種類数（会話の数も同じ）
+            requests_per_family: プレフィックスごとのリクエスト数（1件目がcold）
+            turns: 会話のターン数（0なら会話は計測しない）
+            max_tokens: 最大トークン数
+        
+        Returns:
+            グループ（cold / warm / 各ターン）ごとの集計結果のリスト
+        """
+        tokenizer = self.tokenizer_for(model)
+        run_id = f"{random.getrandbits(32):08x}"
+        documents = [f"Document {run_id}-{f}:\n" + self._build_prompt(prefix_tokens, tokenizer, variant=f)
+                     for f in range(families)]
+        print(f"Prefix cache benchmark for model: {model} "
+              f"({families} prefixes x {prefix_tokens} tokens, {requests_per_family} requests each, "
+              f"{turns} conversation turns)")
+        print("Warming up...")
+        try:
+            self.evaluate_single_prompt(self.get_default_prompts()[0], model, 1)
+        except Exception as e:
+            print(f"  ✗ Warm-up failed: {str(e)}")
+        
+        groups: Dict[str, Dict[str, LogHistogram]] = {}
+        
+        def measure(group: str, label: str, prompt: str,
+                    messages: Optional[List[Dict[str, str]]] = None) -> Optional[str]:
+            try:
+                result, content = self._evaluate(prompt, model, max_tokens, messages)
+            except Exception as e:
+                print(f"  ✗ {label}: Error: {str(e)}")
+                return None
+            self.metrics.record(result)
+            if result.ttft is None:
+                return content
+            # キャッシュの有無で数え方が変わるサーバーもあるので、送った全体のトークン数で速度を求める
+            sent_tokens = self.count_tokens(prompt, model)
+            hists = groups.setdefault(group, {name: LogHistogram() for name in
+                                              ('ttft', 'prefill', 'prompt_tokens', 'cached_tokens')})
+            hists['ttft'].record(result.ttft)
+            hists['prefill'].record(sent_tokens / result.ttft)
+            hists['prompt_tokens'].record(sent_tokens)
+            if result.cached_tokens is not None:
+                hists['cached_tokens'].record(result.cached_tokens)
+            cached = f", cached {result.cached_tokens}" if result.cached_tokens is not None else ""
+            print(f"  ✓ {label}: {sent_tokens} prompt tokens, TTFT {result.ttft:.3f}s{cached}")
+            return content
+        
+        def question(index: int) -> str:
+            return PREFIX_QUESTIONS[index % len(PREFIX_QUESTIONS)]
+        
+        print("\n=== Cold: first request for each prefix ===")
+        for f, document in enumerate(documents):
+            measure('cold', f"Prefix {f+1}", f"{document}\n\n{question(0)}")
+        
+        print("\n=== Warm: same prefixes with different questions ===")
+        for i in range(1, requests_per_family):
+            for f, document in enumerate(documents):
+                measure('warm', f"Prefix {f+1} question {i+1}", f"{document}\n\n{question(i)}")
+        
+        if turns > 0:
+            print("\n=== Multi-turn: growing history re-sent each turn ===")
+        for c in range(families if turns > 0 else 0):
+            document = f"Conversation {run_id}-{c}:\n" + self._build_prompt(prefix_tokens, tokenizer,
+                                                                           variant=families + c)
+            history: List[Dict[str, str]] = []
+            for t in range(turns):
+                content = f"{document}\n\n{question(t)}" if t == 0 else question(t)
+                history.append({"role": "user", "content": content})
+                prompt = "\n".join(message['content'] for message in history)
+                reply = measure(f"turn {t+1}", f"Conversation {c+1} turn {t+1}", prompt, list(history))
+                if reply is None:
+                    break
+                history.append({"role": "assistant", "content": reply})
+        
+        rows = []
+        for group, hists in groups.items():
+            rows.append({
+                'group': group,
+                'requests': hists['ttft'].count,
+                'mean_prompt_tokens': round(hists['prompt_tokens'].mean),
+                'p50_ttft': hists['ttft'].percentile(50),
+                'mean_ttft': hists['ttft'].mean,
+                'mean_prefill_tokens_per_second': hists['prefill'].mean,
+                'mean_cached_tokens': round(hists['cached_tokens'].mean) if hists['cached_tokens'].count else None
+            })
+        return rows
+    
+    def print_prefix_cache(self, rows: List[Dict[str, Any]]):
+        """cold / warm / 各ターンのTTFTとプレフィル速度、キャッシュによる高速化率を出力"""
+        print("\n" + "="*60)
+        print("PREFIX CACHE RESULTS")
+        print("="*60)
+        if not rows:
+            print("No streaming results to analyze.")
+            return
+        
+        by_group = {row['group']: row for row in rows}
+        cold = by_group.get('cold')
+        print(f"{'group':<8} {'req':>4} {'prompt':>7} {'p50 TTFT':>9} {'mean TTFT':>10} "
+              f"{'prefill/s':>10} {'cached':>7} {'speedup':>8}")
+        for row in rows:
+            # 同じ長さをcoldで処理した場合のTTFT（coldのプレフィル速度から推定）との比
+            speedup = ""
+            if cold and row is not cold and row['p50_ttft'] > 0:
+                expected = row['mean_prompt_tokens'] / cold['mean_prefill_tokens_per_second']
+                speedup = f"{expected / row['p50_ttft']:.2f}x"
+            cached = str(row['mean_cached_tokens']) if row['mean_cached_tokens'] is not None else "-"
+            print(f"{row['group']:<8} {row['requests']:>4} {row['mean_prompt_tokens']:>7} "
+                  f"{row['p50_ttft']:>9.3f} {row['mean_ttft']:>10.3f} "
+                  f"{row['mean_prefill_tokens_per_second']:>10.1f} {cached:>7} {speedup:>8}")
+        
+        warm = by_group.get('warm')
+        if cold and warm and warm['p50_ttft'] > 0:
+            print(f"\nWarm vs cold: TTFT {cold['p50_ttft'] / warm['p50_ttft']:.2f}x faster, "
+                  f"prefill {warm['mean_prefill_tokens_per_second'] / cold['mean_prefill_tokens_per_second']:.2f}x "
+                  "tokens/sec")
+            if cold['p50_ttft'] / warm['p50_ttft'] < 1.1:
+                print("  ⚠ Little or no speedup: the prefix cache may be disabled or too small")
+    
+    def save_sweep_csv(self, rows: List[Dict[str, Any]], filename: str):
+        """スイープ結果をCSVファイルに保存"""
+        with open(filename, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        
+        print(f"\nSweep results saved to: {filename}")
+
+def run_targets(targets: List[Tuple[Target, LLMSpeedEvaluator]], test_prompts: Optional[List[str]],
+                max_tokens: int, iterations: int, order: str = "interleaved",
+                concurrency: int = 1, rate: Optional[float] = None,
+                arrival: str = "constant") -> List[TestResult]:
+    """
+    同じワークロードを複数のターゲットに送る
+    
+    interleavedでは1件ずつ、タスクごとにターゲットを順番に切り替えて送る（送る順番も
+    タスクごとにずらし、先に送ったターゲットが有利にならないようにする）。
+    concurrentでは全ターゲットを同時に、それぞれ同じ同時実行数・送信レートで実行する。
+    
+    Returns:
+        全ターゲットの結果のリスト（TestResult.targetでターゲットを区別する）
+    """
+    evaluators = [evaluator for _, evaluator in targets]
+    test_prompts = test_prompts or evaluators[0].get_default_prompts()
+    print(f"Comparing {len(targets)} targets ({order}):")
+    for target, _ in targets:
+        print(f"  - {target.name}: {target.model} ({target.api_type}, {target.base_url})")
+    
+    if order == "concurrent":
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            futures = [
+                executor.submit(evaluator.run_evaluation, target.model, test_prompts, max_tokens,
+                                iterations, concurrency, rate, arrival)
+                for target, evaluator in targets
+            ]
+            return [result for future in futures for result in future.result()]
+    
+    tasks = [BenchmarkTask(i, iteration, prompt)
+             for i, prompt in enumerate(test_prompts)
+             for iteration in range(iterations)]
+    results = []
+    for n, task in enumerate(tasks):
+        print(f"\n[{n+1}/{len(tasks)}] {task.label}")
+        shift = n % len(targets)
+        for target, evaluator in targets[shift:] + targets[:shift]:
+            try:
+                result = evaluator.evaluate_single_prompt(task.prompt, target.model, max_tokens)
+                results.append(result)
+                evaluator.metrics.record(result)
+                print(f"    ✓ {target.name}: {result.completion_tokens} tokens in {result.response_time:.2f}s "
+                      f"({result.tokens_per_second:.2f} tokens/sec)")
+            except Exception as e:
+                print(f"    ✗ {target.name}: Error: {str(e)}")
+    return results
+
+def print_comparison(targets: List[Tuple[Target, LLMSpeedEvaluator]], order: str = "interleaved"):
+    """
+    ターゲットごとの主要指標と、最初のターゲットに対する速度比を横並びで出力
+    
+    集計トークン/秒は、concurrentでは最初の送信から最後の受信までの時間で、
+    interleavedでは他のターゲットの順番を待つ時間を除くため、そのターゲットの
+    レスポンス時間の合計で割る。
+    """
+    print("\n" + "="*60)
+    print("TARGET COMPARISON")
+    print("="*60)
+    
+    rows = []
+    for target, evaluator in targets:
+        metrics = evaluator.metrics
+        tps = metrics.get('tokens_per_second')
+        latency = metrics.get('response_time')
+        ttft = metrics.get('ttft')
+        if not metrics.count:
+            wall_time = 0
+        elif order == "concurrent":
+            wall_time = metrics.last_end - metrics.first_start
+        else:
+            wall_time = latency.mean * latency.count
+        rows.append({
+            'name': target.name,
+            'ok': metrics.count,
+            'failed': int(metrics.counters['failed']),
+            'tps': tps.mean if tps else None,
+            'p50': latency.percentile(50) if latency else None,
+            'p99': latency.percentile(99) if latency else None,
+            'ttft': ttft.percentile(50) if ttft else None,
+            'aggregate': metrics.total_completion_tokens / wall_time if wall_time > 0 else None
+        })
+    
+    def fmt(value, width, digits=2):
+        return f"{value:>{width}.{digits}f}" if value is not None else f"{'-':>{width}}"
+    
+    width = max(len('target'), *(len(row['name']) for row in rows))
+    print(f"{'target':<{width}} {'ok/fail':>8} {'tok/s':>8} {'p50 lat':>8} {'p99 lat':>8} "
+          f"{'p50 TTFT':>9} {'agg tok/s':>10} {'speedup':>8} {'latency':>8}")
+    base = rows[0]
+    for row in rows:
+        # 速度比は平均トークン/秒、レイテンシ比はp50レスポンス時間で、最初のターゲットと比べる
+        speedup = f"{row['tps'] / base['tps']:.2f}x" if row['tps'] and base['tps'] else "-"
+        latency_ratio = f"{base['p50'] / row['p50']:.2f}x" if row['p50'] and base['p50'] else "-"
+        print(f"{row['name']:<{width}} {str(row['ok']) + '/' + str(row['failed']):>8} "
+              f"{fmt(row['tps'], 8)} {fmt(row['p50'], 8)} {fmt(row['p99'], 8)} {fmt(row['ttft'], 9, 3)} "
+              f"{fmt(row['aggregate'], 10)} {speedup:>8} {latency_ratio:>8}")
+    print(f"\nspeedup = mean tokens/sec relative to {base['name']}; "
+          f"latency = how many times faster its p50 response time is")
+
+class LiveDashboard:
+    """
+    実行中の状況（直近のトークン/秒、送信中の件数、エラー率、レイテンシ）を一定間隔で表示
+    
+    出力先が端末なら同じ位置に再描画し、そうでなければLIVE_LOG_INTERVALごとに1行ずつ追記する。
+    """
+    
+    def __init__(self, sources: List[Tuple[str, LLMSpeedEvaluator]], output=None,
+                 interval: float = LIVE_REFRESH_INTERVAL):
+        self.sources = sources
+        self.output = output or sys.stdout
+        self.interval = interval
+        self.redraw = self.output.isatty()
+        self.started = time.monotonic()
+        self._lines = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        """表示を止め、最後の状態を描画する"""
+        self._stop.set()
+        self._thread.join()
+        self.render()
+    
+    def _loop(self):
+        last_log = time.monotonic()
+        while not self._stop.wait(self.interval):
+            if self.redraw:
+                self.render()
+            elif time.monotonic() - last_log >= LIVE_LOG_INTERVAL:
+                self.render()
+                last_log = time.monotonic()
+    
+    def _lines_for(self, name: str, evaluator: LLMSpeedEvaluator) -> List[str]:
+        def ms(value: Optional[float]) -> str:
+            return f"{value * 1000:.0f}ms" if value is not None else "-"
+        
+        live = evaluator.live.summary()
+        metrics = evaluator.metrics
+        lines = [
+            f"{name}: {metrics.count} done, {metrics.counters['failed']:.0f} failed, "
+            f"{evaluator.in_flight} in flight",
+            f"  last {evaluator.live.window:.0f}s: {live['tokens_per_second']:.1f} tokens/sec, "
+            f"{live['requests_per_second']:.2f} req/sec, errors {live['error_rate']:.1%}",
+            f"  latency p50 {ms(live['p50'])} p95 {ms(live['p95'])} p99 {ms(live['p99'])}"
+            f" | TTFT p50 {ms(live['ttft_p50'])} p99 {ms(live['ttft_p99'])}",
+        ]
+        if evaluator.live.last_error:
+            lines.append(f"  last error: {evaluator.live.last_error[:100]}")
+        return lines
+    
+    def render(self):
+        elapsed = time.monotonic() - self.started
+        lines = [f"[live] elapsed {elapsed:.0f}s"]
+        for name, evaluator in self.sources:
+            lines.extend(self._lines_for(name, evaluator))
+        if self.redraw:
+            # 前回描画した行まで戻り、そこから下を消してから書き直す
+            prefix = f"\x1b[{self._lines}F\x1b[J" if self._lines else ""
+            self.output.write(prefix + "\n".join(lines) + "\n")
+            self._lines = len(lines)
+        else:
+            self.output.write(" | ".join(line.strip() for line in lines) + "\n")
+        self.output.flush()
+
+class MetricsExporter:
+    """
+    実行中の統計をPrometheus/OpenMetricsのテキスト形式で公開するHTTPエンドポイント
+    
+    /metrics を読むたびに各評価器のMetricsCollectorの複製から値を作るため、
+    スクレイプが実行中の計測を止めることはない。
+    """
+    
+    def __init__(self, sources: List[Tuple[str, LLMSpeedEvaluator]], host: str, port: int):
+        self.sources = sources
+        exporter = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def render(self) -> str:
+        """全ターゲットの現在値をテキスト形式で返す"""
+        def labels(**values) -> str:
+            def escape(value: Any) -> str:
+                return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in values.items()) + "}"
+        
+        def number(value: float) -> str:
+            return repr(float(value)) if isinstance(value, float) else str(value)
+        
+        snapshots = [(name, evaluator, evaluator.metrics.snapshot()) for name, evaluator in self.sources]
+        lines = []
+        
+        def family(name: str, kind: str, help_text: str, samples: List[Tuple[str, Dict[str, Any], float]]):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, sample_labels, value in samples:
+                lines.append(f"{name}{suffix}{labels(**sample_labels)} {number(value)}")
+        
+        family('llm_eval_requests_total', 'counter', 'Finished requests by outcome.',
+               [('', {'target': name, 'outcome': outcome}, value)
+                for name, _, metrics in snapshots
+                for outcome, value in [('success', metrics.count), ('failure', int(metrics.counters['failed']))]])
+        family('llm_eval_completion_tokens_total', 'counter', 'Generated completion tokens.',
+               [('', {'target': name}, metrics.total_completion_tokens) for name, _, metrics in snapshots])
+        family('llm_eval_rate_limited_total', 'counter', 'HTTP 429/503 responses received.',
+               [('', {'target': name}, int(metrics.counters['rate_limited'])) for name, _, metrics in snapshots])
+        family('llm_eval_retries_total', 'counter', 'Requests resent after HTTP 429/503.',
+               [('', {'target': name}, int(metrics.counters['retried'])) for name, _, metrics in snapshots])
+        family('llm_eval_throttled_total', 'counter', 'Requests delayed by the client-side rate limiter.',
+               [('', {'target': name}, int(metrics.counters['throttled'])) for name, _, metrics in snapshots])
+        family('llm_eval_throttle_wait_seconds_total', 'counter', 'Time spent waiting for the client-side rate limiter.',
+               [('', {'target': name}, float(metrics.counters['throttle_wait'])) for name, _, metrics in snapshots])
+        family('llm_eval_in_flight_requests', 'gauge', 'Requests currently being sent or received.',
+               [('', {'target': name}, evaluator.in_flight) for name, evaluator, _ in snapshots])
+        
+        for hist_name, bounds in PROMETHEUS_BUCKETS.items():
+            unit = '' if hist_name == 'tokens_per_second' else '_seconds'
+            samples = []
+            for name, _, metrics in snapshots:
+                hist = metrics.histograms.get(hist_name) or LogHistogram()
+                for bound, seen in zip(bounds, hist.cumulative_counts(bounds)):
+                    samples.append(('_bucket', {'target': name, 'le': number(float(bound))}, seen))
+                samples.append(('_bucket', {'target': name, 'le': '+Inf'}, hist.count))
+                samples.append(('_sum', {'target': name}, float(hist.total)))
+                samples.append(('_count', {'target': name}, hist.count))
+            family(f"llm_eval_{hist_name}{unit}", 'histogram', HISTOGRAM_HELP[hist_name], samples)
+        return "\n".join(lines) + "\n"
+
+@contextlib.contextmanager
+def live_dashboard(sources: List[Tuple[str, LLMSpeedEvaluator]], enabled: bool):
+    """
+    enabledなら実行中はダッシュボードを表示し、リクエストごとの進捗表示は捨てる
+    
+    終了時に最後の状態を描画してから標準出力を元に戻すので、その後の統計は通常どおり表示される。
+    """
+    if not enabled:
+        yield
+        return
+    dashboard = LiveDashboard(sources, output=sys.stdout)
+    dashboard.start()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        dashboard.stop()
+
+def parse_int_list(value: str) -> List[int]:
+    """カンマ区切りの整数リストを解析（argparseのtype用）"""
+    try:
+        return [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid comma-separated integer list: {value}")
+
+def parse_token_count(value: str) -> int:
+    """トークン数を解析（"4k" は4096、argparseのtype用）"""
+    value = value.strip()
+    try:
+        return int(value[:-1]) * 1024 if value.lower().endswith('k') else int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid token count: {value}")
+
+def parse_token_list(value: str) -> List[int]:
+    """カンマ区切りのトークン数リストを解析（argparseのtype用）"""
+    return [parse_token_count(v) for v in value.split(',') if v.strip()]
 
 def main():
     """メイン関数"""
     parser = argparse.ArgumentParser(description='Evaluate LLM token generation speed')
-    parser.add_argument('--api-key', required=True, help='API key')
+    parser.add_argument('--api-key', help='API key (required unless --merge-histograms or --compare)')
     parser.add_argument('--model', default='gpt-3.5-turbo', help='Model name (default: gpt-3.5-turbo)')
     parser.add_argument('--base-url', default='https://api.openai.com/v1', 
                        help='API base URL (default: OpenAI)')
@@ -413,11 +2661,167 @@ def main():
                        help='Maximum tokens per response (default: 500)')
     parser.add_argument('--iterations', type=int, default=1, 
                        help='Number of iterations per prompt (default: 1)')
+    parser.add_argument('--concurrency', type=int,
+                       help='Number of requests kept in flight simultaneously (default: 1). '
+                            f'With --rate, the maximum in flight (default: {DEFAULT_OPEN_LOOP_MAX_IN_FLIGHT})')
+    parser.add_argument('--target-ci', type=float, metavar='REL',
+                       help='Adaptive mode: repeat each prompt until the 95%% CI of mean tokens/sec is within '
+                            '±REL of the mean (e.g. 0.05); --iterations becomes the minimum per prompt '
+                            f'(at least {MIN_CI_SAMPLES})')
+    parser.add_argument('--warmup', type=int, default=1,
+                       help='Adaptive mode: discarded warm-up requests per prompt (default: 1)')
+    parser.add_argument('--max-requests', type=int,
+                       help='Adaptive mode: request budget excluding warm-up (default: unlimited)')
+    parser.add_argument('--max-time', type=float, metavar='SECONDS',
+                       help='Adaptive mode: time budget in seconds (default: unlimited)')
+    parser.add_argument('--rate', type=float,
+                       help='Open-loop mode: send requests at this rate (req/s) regardless of response times')
+    parser.add_argument('--arrival', default='constant', choices=['constant', 'poisson'],
+                       help='Inter-arrival distribution for --rate (default: constant)')
+    parser.add_argument('--rpm', type=float,
+                       help='Client-side limit of requests per minute (token bucket)')
+    parser.add_argument('--tpm', type=float,
+                       help='Client-side limit of tokens per minute, counting prompt tokens plus --max-tokens')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES,
+                       help='Retries after HTTP 429/503, honoring Retry-After or backing off with jitter '
+                            f'(default: {DEFAULT_MAX_RETRIES})')
+    parser.add_argument('--live', action='store_true',
+                       help='Show a live view of rolling tokens/sec, in-flight requests, error rate and latency '
+                            'instead of per-request output')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                       help='Serve Prometheus/OpenMetrics counters and histograms at http://HOST:PORT/metrics '
+                            'while the run is in progress')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                       help='Address for --metrics-port to listen on (default: 127.0.0.1)')
+    parser.add_argument('--pool-size', type=int,
+                       help='Maximum keep-alive connections in the HTTP pool (default: same as --concurrency)')
+    parser.add_argument('--stream', action='store_true',
+                       help='Use streaming responses to measure TTFT and inter-token latency')
+    parser.add_argument('--tokenizer', default='heuristic', metavar='SPEC',
+                       help='Tokenizer for counting tokens when the server returns no usage: heuristic, '
+                            'tiktoken:ENCODING_OR_MODEL or hf:PATH/tokenizer.json (default: heuristic)')
+    parser.add_argument('--tokenizer-map', action='append', default=[], metavar='MODEL=SPEC',
+                       help='Tokenizer for a specific model or glob pattern (repeatable), '
+                            'e.g. "gpt-4o*=tiktoken:o200k_base"')
+    parser.add_argument('--targets', metavar='FILE',
+                       help='JSON list of targets (name, base_url, api_type, model, api_key or api_key_env) '
+                            'to run the same workload against and compare side by side')
+    parser.add_argument('--target-order', default='interleaved', choices=['interleaved', 'concurrent'],
+                       help='With --targets: alternate targets one request at a time, or run all targets '
+                            'at once with the same --concurrency/--rate (default: interleaved)')
     parser.add_argument('--output', help='Output JSON file for results')
     parser.add_argument('--prompts-file', help='JSON file containing custom prompts')
+    parser.add_argument('--sweep-concurrency', type=parse_int_list, metavar='N,N,...',
+                       help='Sweep mode: comma-separated concurrency levels')
+    parser.add_argument('--sweep-max-tokens', type=parse_int_list, metavar='N,N,...',
+                       help='Sweep mode: comma-separated max_tokens values (default: --max-tokens)')
+    parser.add_argument('--sweep-input-tokens', type=parse_token_list, metavar='N,N,...',
+                       help='Sweep mode: comma-separated synthetic prompt lengths in tokens, e.g. 256,2k '
+                            '(default: test prompts)')
+    parser.add_argument('--sweep-requests', type=int,
+                       help='Sweep mode: requests per grid cell (default: 4x concurrency)')
+    parser.add_argument('--sweep-context', type=parse_token_list, nargs='?', metavar='N,N,...',
+                       const=DEFAULT_CONTEXT_LENGTHS,
+                       help='Context scaling mode: measure TTFT and prefill tokens/sec at these input lengths '
+                            '(default: 1k,4k,16k,64k,128k), one request at a time with --iterations each')
+    parser.add_argument('--sweep-output', help='Sweep mode: output CSV file for the results table')
+    parser.add_argument('--prefix-cache', action='store_true',
+                       help='Prefix cache mode: compare TTFT of cold and warm requests sharing a long prefix, '
+                            'plus multi-turn conversations')
+    parser.add_argument('--prefix-tokens', type=parse_token_count, default=4096, metavar='N',
+                       help='Prefix cache mode: shared prefix length in tokens (default: 4k)')
+    parser.add_argument('--prefix-families', type=int, default=4,
+                       help='Prefix cache mode: number of distinct prefixes and conversations (default: 4)')
+    parser.add_argument('--prefix-requests', type=int, default=4,
+                       help='Prefix cache mode: requests per prefix, the first one cold (default: 4)')
+    parser.add_argument('--turns', type=int, default=4,
+                       help='Prefix cache mode: turns per conversation, 0 to skip (default: 4)')
+    parser.add_argument('--knee-threshold', type=float, default=DEFAULT_KNEE_EFFICIENCY,
+                       help='Sweep mode: scaling efficiency below which throughput is considered saturated '
+                            f'(default: {DEFAULT_KNEE_EFFICIENCY})')
+    parser.add_argument('--trace', metavar='FILE',
+                       help='Replay a JSONL traffic trace (arrival time, prompt tokens, max tokens per line)')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                       help='Speed-up factor for --trace replay, e.g. 2 or 10 (default: 1)')
+    parser.add_argument('--store', metavar='FILE',
+                       help='Append each result to this JSONL file as soon as it completes')
+    parser.add_argument('--resume', action='store_true',
+                       help='Continue an interrupted run from --store, skipping completed tests')
+    parser.add_argument('--baseline', metavar='FILE',
+                       help='After the run, compare against this saved run and exit non-zero on regression')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'),
+                       help='Compare two saved runs (JSON or JSONL) without running tests')
+    parser.add_argument('--regression-threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                       help='Relative change treated as a regression for --baseline/--compare '
+                            f'(default: {DEFAULT_REGRESSION_THRESHOLD})')
+    parser.add_argument('--histogram-output',
+                       help='Save percentile histograms to this JSON file (can be merged later)')
+    parser.add_argument('--merge-histograms', nargs='+', metavar='FILE',
+                       help='Merge saved histogram files and print combined statistics without running tests')
     
     args = parser.parse_args()
     
+    # 保存済みヒストグラムの合算のみ
+    if args.merge_histograms:
+        merged = LLMSpeedEvaluator.load_histograms(args.merge_histograms)
+        print(f"Merged {len(args.merge_histograms)} histogram files")
+        evaluator = LLMSpeedEvaluator(args.api_key or '', args.base_url, args.api_type)
+        evaluator.print_statistics([], merged)
+        if args.histogram_output:
+            evaluator.metrics = merged
+            evaluator.save_histograms(args.histogram_output)
+        return
+    
+    # 保存済みの実行結果同士の比較のみ
+    if args.compare:
+        evaluator = LLMSpeedEvaluator(args.api_key or '', args.base_url, args.api_type)
+        passed = evaluator.compare_runs(load_records(args.compare[0]), load_records(args.compare[1]),
+                                        args.regression_threshold)
+        return 0 if passed else 1
+    
+    if not args.api_key and not args.targets:
+        parser.error('--api-key is required')
+    if args.targets and (args.store or args.trace or args.target_ci is not None or args.prefix_cache
+                         or args.sweep_context or args.sweep_concurrency or args.sweep_max_tokens
+                         or args.sweep_input_tokens or args.histogram_output or args.baseline):
+        parser.error('--targets only supports the standard evaluation (--iterations, --concurrency, --rate) '
+                     'and --output')
+    if args.targets and args.target_order == 'interleaved' and (args.rate or (args.concurrency or 1) > 1):
+        parser.error('--target-order interleaved sends one request at a time; '
+                     'use --target-order concurrent with --concurrency or --rate')
+    if args.resume and not args.store:
+        parser.error('--resume requires --store')
+    if args.live and (args.prefix_cache or args.sweep_context or args.sweep_concurrency
+                      or args.sweep_max_tokens or args.sweep_input_tokens):
+        parser.error('--live cannot be combined with sweep mode, --sweep-context or --prefix-cache')
+    sweep_mode = bool(args.sweep_concurrency or args.sweep_max_tokens or args.sweep_input_tokens)
+    if args.store and (sweep_mode or args.sweep_context or args.prefix_cache):
+        parser.error('--store cannot be combined with sweep mode')
+    if sum([sweep_mode, bool(args.sweep_context), args.prefix_cache]) > 1:
+        parser.error('sweep mode, --sweep-context and --prefix-cache cannot be combined')
+    if args.target_ci is not None:
+        if args.target_ci <= 0:
+            parser.error('--target-ci must be positive')
+        if args.rate or args.trace or (args.concurrency or 1) > 1:
+            parser.error('--target-ci runs requests one at a time and cannot be combined with '
+                         '--rate, --trace or --concurrency')
+        if not (args.max_requests or args.max_time):
+            print("Warning: --target-ci without --max-requests or --max-time may run for a long time "
+                  "on noisy endpoints")
+    concurrency = args.concurrency or (DEFAULT_OPEN_LOOP_MAX_IN_FLIGHT if args.rate or args.trace else 1)
+    
+    # トークナイザーの読み込み（オプションのライブラリが無い場合はここでエラーにする）
+    try:
+        tokenizer = load_tokenizer(args.tokenizer)
+        model_tokenizers = {}
+        for mapping in args.tokenizer_map:
+            model, sep, spec = mapping.partition('=')
+            if not sep or not model or not spec:
+                parser.error(f'--tokenizer-map expects MODEL=SPEC: {mapping}')
+            model_tokenizers[model] = load_tokenizer(spec)
+    except Exception as e:
+        parser.error(f'Failed to load tokenizer: {e}')
+    
     # カスタムプロンプトの読み込み
     test_prompts = None
     if args.prompts_file:
@@ -427,29 +2831,176 @@ def main():
             print(f"Loaded {len(test_prompts)} custom prompts from {args.prompts_file}")
         except Exception as e:
             print(f"Error loading prompts file: {e}")
-            return
+            return 1
 
+    def make_evaluator(api_key: str, base_url: str, api_type: str) -> LLMSpeedEvaluator:
+        evaluator = LLMSpeedEvaluator(api_key, base_url, api_type,
+                                      stream=args.stream,
+                                      pool_size=args.pool_size or max(args.sweep_concurrency or [concurrency]))
+        evaluator.tokenizer = tokenizer
+        evaluator.model_tokenizers = model_tokenizers
+        evaluator.max_retries = args.max_retries
+        if args.rpm or args.tpm:
+            # 上限はエンドポイントごとにかかるので、リミッターもターゲットごとに持つ
+            evaluator.rate_limiter = RateLimiter(args.rpm, args.tpm)
+        if args.live:
+            evaluator.live = RollingWindow()
+        return evaluator
+    
+    def start_exporter(sources: List[Tuple[str, LLMSpeedEvaluator]]) -> Optional[MetricsExporter]:
+        if args.metrics_port is None:
+            return None
+        try:
+            exporter = MetricsExporter(sources, args.metrics_host, args.metrics_port)
+        except OSError as e:
+            parser.error(f'Cannot listen on {args.metrics_host}:{args.metrics_port}: {e}')
+        exporter.start()
+        print(f"Serving metrics at {exporter.url}")
+        return exporter
+    
+    if args.rpm or args.tpm:
+        print(f"Rate limit: {args.rpm or 'unlimited'} requests/min, {args.tpm or 'unlimited'} tokens/min")
+    
+    # 複数ターゲットの比較
+    if args.targets:
+        try:
+            targets = load_targets(args.targets, Target('', args.base_url, args.api_type, args.model,
+                                                        args.api_key or ''))
+        except (OSError, ValueError) as e:
+            print(f"Error loading targets: {e}")
+            return 1
+        pairs = []
+        for target in targets:
+            evaluator = make_evaluator(target.api_key, target.base_url, target.api_type)
+            evaluator.target = target.name
+            pairs.append((target, evaluator))
+        sources = [(target.name, evaluator) for target, evaluator in pairs]
+        exporter = start_exporter(sources)
+        try:
+            with live_dashboard(sources, args.live):
+                results = run_targets(pairs, test_prompts, args.max_tokens, args.iterations, args.target_order,
+                                      concurrency, args.rate, args.arrival)
+        except KeyboardInterrupt:
+            print("\nEvaluation interrupted by user.")
+            return 1
+        finally:
+            if exporter:
+                exporter.stop()
+        for target, evaluator in pairs:
+            print(f"\n### {target.name}")
+            evaluator.print_statistics([result for result in results if result.target == target.name])
+        print_comparison(pairs, args.target_order)
+        if args.output:
+            pairs[0][1].save_results(results, args.output)
+        return
+    
     # 評価の実行
-    evaluator = LLMSpeedEvaluator(args.api_key, args.base_url, args.api_type)
+    evaluator = make_evaluator(args.api_key, args.base_url, args.api_type)
+    print(f"Tokenizer for {args.model}: {evaluator.tokenizer_for(args.model).name}")
+    
+    if args.store:
+        try:
+            evaluator.store = ResultStore(args.store, resume=args.resume)
+        except FileExistsError as e:
+            print(f"Error: {e}")
+            return 1
+        print(f"Streaming results to: {args.store}")
+    
+    sources = [(args.model, evaluator)]
+    exporter = start_exporter(sources)
+    
+    # TTFTはストリーミングでしか計測できない
+    if (args.sweep_context or args.prefix_cache) and not evaluator.stream:
+        print("Enabling --stream to measure TTFT")
+        evaluator.stream = True
     
     try:
-        results = evaluator.run_evaluation(
-            model=args.model,
-            test_prompts=test_prompts,
-            max_tokens=args.max_tokens,
-            iterations=args.iterations
-        )
+        if args.prefix_cache:
+            rows = evaluator.run_prefix_cache(args.model, args.prefix_tokens, args.prefix_families,
+                                              args.prefix_requests, args.turns, args.max_tokens)
+            evaluator.print_prefix_cache(rows)
+            if args.sweep_output and rows:
+                evaluator.save_sweep_csv(rows, args.sweep_output)
+            return
+        
+        if args.sweep_context:
+            rows = evaluator.run_context_scaling(args.model, args.sweep_context, args.max_tokens,
+                                                 args.iterations)
+            evaluator.print_context_scaling(rows)
+            if args.sweep_output:
+                evaluator.save_sweep_csv(rows, args.sweep_output)
+            return
+        
+        if sweep_mode:
+            rows = evaluator.run_sweep(
+                model=args.model,
+                concurrencies=args.sweep_concurrency or [concurrency],
+                max_tokens_list=args.sweep_max_tokens or [args.max_tokens],
+                input_tokens_list=args.sweep_input_tokens or [None],
+                test_prompts=test_prompts,
+                requests_per_cell=args.sweep_requests
+            )
+            evaluator.print_sweep(rows, evaluator.find_knees(rows, args.knee_threshold))
+            if args.sweep_output:
+                evaluator.save_sweep_csv(rows, args.sweep_output)
+            return
+        
+        if args.trace:
+            tasks = evaluator.load_trace(args.trace, args.time_scale, args.model)
+        with live_dashboard(sources, args.live):
+            if args.trace:
+                results = evaluator.run_trace(args.model, tasks, args.max_tokens, concurrency)
+            elif args.target_ci is not None:
+                results = evaluator.run_adaptive(
+                    model=args.model,
+                    test_prompts=test_prompts,
+                    max_tokens=args.max_tokens,
+                    target_ci=args.target_ci,
+                    warmup=args.warmup,
+                    min_iterations=max(args.iterations, MIN_CI_SAMPLES),
+                    max_requests=args.max_requests,
+                    max_time=args.max_time
+                )
+            else:
+                results = evaluator.run_evaluation(
+                    model=args.model,
+                    test_prompts=test_prompts,
+                    max_tokens=args.max_tokens,
+                    iterations=args.iterations,
+                    concurrency=concurrency,
+                    rate=args.rate,
+                    arrival=args.arrival
+                )
         
         evaluator.print_statistics(results)
         
         # 結果の保存
         if args.output:
             evaluator.save_results(results, args.output)
+        if args.histogram_output:
+            evaluator.save_histograms(args.histogram_output)
         
+        # ベースラインとの比較
+        if args.baseline:
+            passed = evaluator.compare_runs(load_records(args.baseline),
+                                            [result_to_dict(r) for r in results],
+                                            args.regression_threshold)
+            if not passed:
+                return 1
+    
     except KeyboardInterrupt:
         print("\nEvaluation interrupted by user.")
+        if args.store:
+            print(f"Completed results are kept in {args.store}; rerun with --resume to continue.")
+        return 130
     except Exception as e:
         print(f"Error during evaluation: {e}")
+        return 1
+    finally:
+        if evaluator.store:
+            evaluator.store.close()
+        if exporter:
+            exporter.stop()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""llm-evaluator.py の動作確認・自己ベンチマーク用のOpenAI/Ollama互換モックサーバー
+
+実際のモデルは動かさず、設定したTTFT・プロンプト処理速度（プレフィックスキャッシュ付き）・
+トークン生成速度・揺らぎ・エラー率・同時処理スロット数に従って決まった形のレスポンスを返す。
+ライブのエンドポイントが無い環境での動作確認や、TTFTと生成時間を0にして
+クライアント側（ハーネス）のオーバーヘッドを計測するのに使う。
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_PORT = 8000
+DEFAULT_COMPLETION_TOKENS = 128
+TOKEN_TEXT = "lorem "
+# プレフィックスキャッシュとして覚えておくプロンプトの件数
+PREFIX_CACHE_SIZE = 64
+
+
+class MockConfig:
+    """モックサーバーの応答特性"""
+
+    def __init__(self, token_rate: float, ttft: float, jitter: float,
+                 error_rate: float, max_slots: int, prefill_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: Optional[float] = None):
+        self.token_rate = token_rate
+        self.ttft = ttft
+        self.prefill_rate = prefill_rate
+        self.prefix_cache: List[str] = []
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.slots = threading.BoundedSemaphore(max_slots) if max_slots > 0 else None
+        self.lock = threading.Lock()
+        self.served = 0
+        self.failed = 0
+        self.throttled = 0
+
+    def delay(self, seconds: float) -> None:
+        """揺らぎを加えて待機"""
+        if seconds <= 0:
+            return
+        if self.jitter > 0:
+            seconds *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(max(0.0, seconds))
+
+    def token_interval(self) -> float:
+        return 1 / self.token_rate if self.token_rate > 0 else 0.0
+    
+    def prefill(self, prompt: str) -> Tuple[float, int]:
+        """
+        プロンプト処理にかかる時間とキャッシュに当たったトークン数を返す
+        
+        直近のプロンプトとの最長共通プレフィックスをキャッシュ済みとみなし、
+        残りのトークンだけをprefill_rateで処理する。
+        """
+        if self.prefill_rate <= 0:
+            return 0.0, 0
+        with self.lock:
+            cached_chars = max((len(os.path.commonprefix([prompt, past])) for past in self.prefix_cache),
+                               default=0)
+            self.prefix_cache.append(prompt)
+            del self.prefix_cache[:-PREFIX_CACHE_SIZE]
+        cached = estimate_tokens(prompt[:cached_chars])
+        return max(0, estimate_tokens(prompt) - cached) / self.prefill_rate, cached
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 大量の同時接続でも接続待ちキューがあふれないようにする
+    request_queue_size = 1024
+
+
+def estimate_tokens(text: str) -> int:
+    """llm-evaluator.py の推定と同じく単語数の約1.3倍をトークン数とする"""
+    return int(len(text.split()) * 1.3)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: MockConfig
+    quiet = False
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def do_POST(self) -> None:
+        path = self.path.split("?", 1)[0]
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": "invalid JSON body"})
+            return
+
+        if path.endswith("/chat/completions"):
+            handler = self._handle_openai
+        elif path in ("/api/generate", "/api/chat"):
+            handler = self._handle_ollama
+        else:
+            self._send_json(404, {"error": f"unknown endpoint: {path}"})
+            return
+
+        if random.random() < self.config.throttle_rate:
+            with self.config.lock:
+                self.config.throttled += 1
+            headers = {}
+            if self.config.retry_after is not None:
+                headers["Retry-After"] = f"{self.config.retry_after:g}"
+            self._send_json(429, {"error": "rate limit exceeded"}, headers)
+            return
+        
+        if random.random() < self.config.error_rate:
+            with self.config.lock:
+                self.config.failed += 1
+            self._send_json(500, {"error": "injected failure"})
+            return
+
+        # スロットが埋まっている間は待たせる（実サーバーのキューイングを模擬）
+        if self.config.slots:
+            self.config.slots.acquire()
+        try:
+            handler(body)
+        finally:
+            if self.config.slots:
+                self.config.slots.release()
+        with self.config.lock:
+            self.config.served += 1
+
+    def _send_json(self, status: int, data: Dict[str, Any],
+                   headers: Optional[Dict[str, str]] = None) -> None:
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _start_chunked(self, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _end_chunked(self) -> None:
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _generate(self, count: int, prefill_time: float = 0.0) -> Iterator[str]:
+        """TTFT（とプロンプト処理時間）待機のあと、設定した速度でトークンを1つずつ生成"""
+        self.config.delay(self.config.ttft + prefill_time)
+        interval = self.config.token_interval()
+        for i in range(count):
+            if i > 0:
+                self.config.delay(interval)
+            yield TOKEN_TEXT
+
+    def _handle_openai(self, body: Dict[str, Any]) -> None:
+        count = int(body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        prefill_time, cached = self.config.prefill(prompt)
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_tokens": count,
+            "total_tokens": estimate_tokens(prompt) + count,
+        }
+        if self.config.prefill_rate > 0:
+            usage["prompt_tokens_details"] = {"cached_tokens": cached}
+        model = body.get("model", "mock")
+        
+        if not body.get("stream"):
+            content = "".join(self._generate(count, prefill_time))
+            self._send_json(200, {
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "length",
+                }],
+                "usage": usage,
+            })
+            return
+
+        self._start_chunked("text/event-stream")
+        for token in self._generate(count, prefill_time):
+            chunk = {"object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": token}}]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        final = {"object": "chat.completion.chunk", "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "length"}]}
+        self._write_chunk(f"data: {json.dumps(final)}\n\n".encode())
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._end_chunked()
+
+    def _handle_ollama(self, body: Dict[str, Any]) -> None:
+        options = body.get("options") or {}
+        count = int(options.get("num_predict") or DEFAULT_COMPLETION_TOKENS)
+        # /api/chat は会話履歴をmessagesで受け取り、応答もmessageに入れて返す
+        chat = "messages" in body
+        if chat:
+            prompt = "\n".join(str(m.get("content", "")) for m in body["messages"])
+        else:
+            prompt = str(body.get("prompt", ""))
+        prompt_tokens = estimate_tokens(prompt)
+        prefill_time, cached = self.config.prefill(prompt)
+        start = time.perf_counter()
+        first_token: Optional[float] = None
+        parts = []
+
+        def stats() -> Dict[str, Any]:
+            end = time.perf_counter()
+            prefill = (first_token or end) - start
+            return {
+                "model": body.get("model", "mock"),
+                "done": True,
+                "total_duration": int((end - start) * 1e9),
+                "load_duration": 0,
+                # Ollamaと同じく、キャッシュに当たったトークンは処理数に含めない
+                "prompt_eval_count": max(1, prompt_tokens - cached),
+                "prompt_eval_duration": int(prefill * 1e9),
+                "eval_count": count,
+                "eval_duration": int((end - (first_token or end)) * 1e9),
+            }
+
+        stream = body.get("stream", True)  # Ollamaの既定はストリーミング
+        if stream:
+            self._start_chunked("application/x-ndjson")
+        def text(value: str) -> Dict[str, Any]:
+            return {"message": {"role": "assistant", "content": value}} if chat else {"response": value}
+        
+        for token in self._generate(count, prefill_time):
+            if first_token is None:
+                first_token = time.perf_counter()
+            if stream:
+                line = {"model": body.get("model", "mock"), **text(token), "done": False}
+                self._write_chunk((json.dumps(line) + "\n").encode())
+            else:
+                parts.append(token)
+        
+        if stream:
+            self._write_chunk((json.dumps({**stats(), **text("")}) + "\n").encode())
+            self._end_chunked()
+        else:
+            self._send_json(200, {**stats(), **text("".join(parts))})
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="OpenAI (/chat/completions) / Ollama (/api/generate, /api/chat) compatible mock server "
+                    "for llm-evaluator.py"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help=f"Listen port (default: {DEFAULT_PORT})")
+    parser.add_argument("--token-rate", type=float, default=50.0,
+                        help="Tokens per second per request; 0 returns all tokens immediately (default: 50)")
+    parser.add_argument("--ttft", type=float, default=0.2,
+                        help="Time to first token in seconds (default: 0.2)")
+    parser.add_argument("--prefill-rate", type=float, default=0.0,
+                        help="Prompt tokens processed per second, added to TTFT; prefixes shared with "
+                             "recent prompts count as cached (default: 0 = no prefill cost)")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Random relative variation applied to every delay, 0-1 (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with HTTP 500, 0-1 (default: 0)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with HTTP 429, 0-1 (default: 0)")
+    parser.add_argument("--retry-after", type=float,
+                        help="Retry-After seconds sent with HTTP 429 (default: no header)")
+    parser.add_argument("--max-slots", type=int, default=0,
+                        help="Concurrent generation slots; extra requests queue (default: 0 = unlimited)")
+    parser.add_argument("--quiet", action="store_true", help="Do not log each request")
+    args = parser.parse_args()
+
+    config = MockConfig(args.token_rate, args.ttft, args.jitter, args.error_rate, args.max_slots,
+                        args.prefill_rate, args.throttle_rate, args.retry_after)
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config, "quiet": args.quiet})
+    server = MockServer((args.host, args.port), handler)
+
+    print(f"Mock LLM server listening on http://{args.host}:{args.port} "
+          f"(token rate: {args.token_rate}/s, TTFT: {args.ttft}s, jitter: {args.jitter}, "
+          f"error rate: {args.error_rate}, throttle rate: {args.throttle_rate}, slots: {args.max_slots or 'unlimited'})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"\nServed {config.served} requests ({config.failed} injected failures, "
+              f"{config.throttled} throttled)")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+#!/Users/junya/Scripts/.venv/bin/python3
+"""pdf-shrink.py のベンチマーク。
+
+合成したPDF(多ページ・共有画像・大きなスキャン・白黒2値・透過画像)をオフラインで生成して
+pdf-shrink.py で縮小し、ページ/秒・画像/秒・MB/秒・ピークRSSと処理段階ごとの時間を表示する。
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw, ImageFilter
+
+# ファイル名にハイフンを含むため importlib で読み込む。
+# ワーカープロセスが関数を pdf_shrink モジュールから引けるよう sys.modules に登録する。
+_spec = importlib.util.spec_from_file_location(
+    "pdf_shrink", Path(__file__).resolve().with_name("pdf-shrink.py")
+)
+pdf_shrink = importlib.util.module_from_spec(_spec)
+sys.modules["pdf_shrink"] = pdf_shrink
+_spec.loader.exec_module(pdf_shrink)
+
+SCENARIOS = ["pages", "shared", "scans", "bilevel", "alpha"]
+A4 = fitz.paper_rect("a4")
+
+
+def image_bytes(image: Image.Image, fmt: str = "PNG", **params) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def photo(rng: random.Random, size: tuple[int, int]) -> Image.Image:
+    """写真の代わりに、ぼかしたノイズとグラデーションを重ねたカラー画像を作る。"""
+    noise = Image.effect_noise(size, rng.randint(30, 60)).filter(ImageFilter.GaussianBlur(3))
+    gradient = Image.linear_gradient("L").resize(size)
+    return Image.merge("RGB", [noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+
+
+def scan_page(rng: random.Random, size: tuple[int, int], mode: str) -> Image.Image:
+    """文字の代わりに黒い矩形を並べたスキャン画像を作る。"""
+    image = Image.new(mode, size, "white")
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    for y in range(height // 30, height - height // 30, height // 70):
+        for x in range(width // 20, width - width // 20, width // 80):
+            if rng.random() < 0.8:
+                draw.rectangle(
+                    [x, y, x + rng.randrange(width // 300 + 1, width // 100 + 2), y + height // 120],
+                    fill="black",
+                )
+    return image
+
+
+def build_pdf(scenario: str, scale: float, path: Path) -> None:
+    """scenarioの合成PDFを作る。同じ引数なら毎回同じ内容になる。"""
+    rng = random.Random(scenario)
+    count = max(1, round(scale * {"pages": 200, "shared": 50, "scans": 20, "bilevel": 20, "alpha": 20}[scenario]))
+    doc = fitz.open()
+
+    if scenario == "pages":
+        # テキスト主体の多ページ文書。ロゴは全ページで共有し、数ページごとに写真が入る
+        logo = image_bytes(photo(rng, (600, 200)))
+        for i in range(count):
+            page = doc.new_page(width=A4.width, height=A4.height)
+            page.insert_image(fitz.Rect(40, 20, 160, 60), stream=logo)
+            page.insert_textbox(fitz.Rect(40, 80, 555, 800), f"Page {i + 1}\n" + "lorem ipsum " * 300)
+            if i % 5 == 0:
+                page.insert_image(fitz.Rect(40, 500, 400, 770), stream=image_bytes(photo(rng, (1200, 900)), "JPEG", quality=95))
+    elif scenario == "shared":
+        # 同じ数枚の大きな画像が、ページによって大きさや向きを変えて繰り返し配置される
+        images = [image_bytes(photo(rng, (2000, 1500))) for _ in range(4)]
+        for i in range(count):
+            page = doc.new_page(width=A4.width, height=A4.height)
+            width = 200 + 300 * rng.random()
+            page.insert_image(fitz.Rect(40, 40, 40 + width, 40 + width * 0.75), stream=images[i % len(images)],
+                              rotate=90 * (i % 4))
+    elif scenario == "scans":
+        # 300dpiのカラー/グレーのJPEGスキャン
+        for i in range(count):
+            page = doc.new_page(width=A4.width, height=A4.height)
+            mode = "RGB" if i % 2 else "L"
+            page.insert_image(page.rect, stream=image_bytes(scan_page(rng, (2480, 3508), mode), "JPEG", quality=92))
+    elif scenario == "bilevel":
+        # 8bitグレーで保存された白黒2値のスキャン
+        for _ in range(count):
+            page = doc.new_page(width=A4.width, height=A4.height)
+            page.insert_image(page.rect, stream=image_bytes(scan_page(rng, (2480, 3508), "L")))
+    elif scenario == "alpha":
+        # 透過(SMask)付きの画像
+        for _ in range(count):
+            page = doc.new_page(width=A4.width, height=A4.height)
+            image = photo(rng, (1200, 1200)).convert("RGBA")
+            mask = Image.new("L", image.size, 0)
+            ImageDraw.Draw(mask).ellipse([100, 100, 1100, 1100], fill=rng.randint(150, 255))
+            image.putalpha(mask)
+            page.insert_image(fitz.Rect(60, 60, 460, 460), stream=image_bytes(image))
+
+    doc.save(path, garbage=4, deflate=True)
+    doc.close()
+
+
+def run_scenario(src: Path, max_dpi: int, quality: int, jobs: int) -> dict:
+    """子プロセスで1回縮小し、計測結果を返す。ピークRSSを他の計測と混ぜないよう毎回新しいプロセスで実行する。"""
+    with fitz.open(src) as doc:
+        pages = doc.page_count
+    dst = src.with_name(f"{src.stem}_shrunk.pdf")
+    start = time.perf_counter()
+    result = pdf_shrink.shrink_pdf(src, dst, max_dpi, quality, jobs)
+    elapsed = time.perf_counter() - start
+    main_rss, worker_rss = pdf_shrink.peak_rss()
+    return {
+        "pages": pages,
+        "images": len(result.reports),
+        "input_size": src.stat().st_size,
+        "output_size": dst.stat().st_size,
+        "seconds": elapsed,
+        "timings": result.timings,
+        "peak_rss": main_rss,
+        "worker_peak_rss": worker_rss,
+    }
+
+
+def measure(src: Path, max_dpi: int, quality: int, jobs: int, repeat: int) -> dict:
+    """repeat回実行し、最も速かった回の結果を返す。"""
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            runs.append(executor.submit(run_scenario, src, max_dpi, quality, jobs).result())
+    best = min(runs, key=lambda run: run["seconds"])
+    best["peak_rss"] = max(run["peak_rss"] for run in runs)
+    best["worker_peak_rss"] = max(run["worker_peak_rss"] for run in runs)
+    seconds = best["seconds"] or 1e-9
+    best["pages_per_sec"] = best["pages"] / seconds
+    best["images_per_sec"] = best["images"] / seconds
+    best["mb_per_sec"] = best["input_size"] / 1024 / 1024 / seconds
+    return best
+
+
+def print_result(scenario: str, result: dict) -> None:
+    format_size = pdf_shrink.format_size
+    print(
+        f"{scenario}: {result['pages']}ページ・画像{result['images']}件 "
+        f"{format_size(result['input_size'])} -> {format_size(result['output_size'])} "
+        f"{result['seconds']:.2f}s"
+    )
+    print(
+        f"  {result['pages_per_sec']:.1f} ページ/秒  {result['images_per_sec']:.1f} 画像/秒  "
+        f"{result['mb_per_sec']:.1f} MB/秒  ピークRSS {format_size(result['peak_rss'])}"
+        f"(ワーカーの最大 {format_size(result['worker_peak_rss'])})"
+    )
+    total = sum(result["timings"].values())
+    print("  " + "  ".join(
+        f"{name} {result['timings'][name]:.2f}s({result['timings'][name] / total * 100 if total else 0:.0f}%)"
+        for name in pdf_shrink.STAGES
+    ))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="合成したPDFで pdf-shrink.py の処理速度とメモリ使用量を計測する。"
+    )
+    parser.add_argument(
+        "--scenario", choices=SCENARIOS, action="append",
+        help="計測するシナリオ(複数指定可、既定: すべて)",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0,
+        help="合成PDFのページ数の倍率(既定: 1.0。0.1 で手早く確認)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="画像の再圧縮に使うプロセス数(既定: CPUコア数)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="各シナリオの実行回数。最も速かった回を表示する(既定: 3)",
+    )
+    parser.add_argument(
+        "--max-dpi", type=int, default=pdf_shrink.DEFAULT_MAX_DPI,
+        help=f"画像の最大解像度(既定: {pdf_shrink.DEFAULT_MAX_DPI})",
+    )
+    parser.add_argument(
+        "--quality", type=int, default=pdf_shrink.DEFAULT_JPEG_QUALITY,
+        help=f"JPEG品質 1-95(既定: {pdf_shrink.DEFAULT_JPEG_QUALITY})",
+    )
+    parser.add_argument(
+        "--keep", type=Path, metavar="DIR",
+        help="合成したPDFと縮小結果をこのディレクトリに残す(既定: 一時ディレクトリに作って削除)",
+    )
+    parser.add_argument(
+        "--json", action="store_true",
+        help="結果を1シナリオ1行のJSONで出力する",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.keep or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        for scenario in args.scenario or SCENARIOS:
+            src = workdir / f"bench-{scenario}.pdf"
+            build_pdf(scenario, args.scale, src)
+            result = measure(src, args.max_dpi, args.quality, args.jobs, max(1, args.repeat))
+            if args.json:
+                print(json.dumps({"scenario": scenario, "jobs": args.jobs, **result}, ensure_ascii=False))
+            else:
+                print_result(scenario, result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,66 +5,1035 @@
 """
 
 import argparse
+import glob
+import hashlib
 import io
+import json
+import math
+import os
+import shutil
 import sys
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
 import fitz  # PyMuPDF
-from PIL import Image
+from PIL import Image, ImageChops
 
 DEFAULT_MAX_DPI = 150
 DEFAULT_JPEG_QUALITY = 70
+# この色数以下の画像(図・グラフなど)はJPEGにせずパレット+Flateで可逆圧縮する
+PALETTE_MAX_COLORS = 64
+# RGBの各チャンネルの差がこれ以下ならグレースケールとみなす(スキャンのノイズを許容)
+GRAY_TOLERANCE = 8
+# --target-size で試す設定。まずJPEG品質をこの値まで下げ、それでも大きければDPIを下げる
+TARGET_SIZE_QUALITIES = [60, 50, 40]
+TARGET_SIZE_DPI_FACTORS = [1.0, 0.8, 0.65, 0.5, 0.4]
+TARGET_SIZE_MIN_DPI = 36
+# 推定サイズと実際の保存サイズがずれた場合に設定を選び直して保存し直す回数
+TARGET_SIZE_SAVE_ATTEMPTS = 3
+# extract_imageがストリームをそのまま返す(デコードしない)形式
+PASSTHROUGH_FILTERS = ["DCTDecode", "JPXDecode", "JBIG2Decode"]
+# --profile で時間を計測する処理段階
+STAGES = ["extract", "decode", "resize", "encode", "replace", "save"]
+# --analyze で試しにエンコードする領域(大きい画像はこの大きさのタイルを数か所だけ圧縮して推定する)
+SAMPLE_TILE = 256
+SAMPLE_TILES = 4
+# バッチモードのキャッシュ。処理内容を変えたら上げて、古い結果を使わないようにする
+CACHE_VERSION = 1
+DEFAULT_CACHE = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "pdf-shrink" / "cache.json"
+# バッチモードでキャッシュを書き出す間隔(処理したファイル数)
+CACHE_SAVE_INTERVAL = 20
 
 
-def shrink_pdf(src: Path, dst: Path, max_dpi: int, quality: int) -> None:
-    doc = fitz.open(src)
+class StageTimer:
+    """処理段階(STAGES)ごとの所要時間を積算する。"""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def add(self, seconds: dict[str, float]) -> None:
+        """ワーカーで計測した時間を合算する。"""
+        for name, value in seconds.items():
+            self.seconds[name] += value
+
+
+@dataclass
+class Placement:
+    """ページ上に画像が1回描画される位置。"""
+    page: int
+    bbox: fitz.Rect
+    transform: fitz.Matrix
 
+    @property
+    def width_pt(self) -> float:
+        """画像の横方向(ピクセルの幅の向き)の表示サイズ。回転・傾きがあっても実際の長さを返す。"""
+        return math.hypot(self.transform.a, self.transform.b)
+
+    @property
+    def height_pt(self) -> float:
+        return math.hypot(self.transform.c, self.transform.d)
+
+
+def index_placements(doc: fitz.Document) -> dict[int, list[Placement]]:
+    """画像のxrefから、文書全体でのすべての描画位置への索引を作る。
+
+    各ページを1回だけ走査する。ロゴやレターヘッドのように複数ページで共有される画像も
+    1つのxrefにまとまるので、1回だけ処理すればよい。インライン画像(xrefが0)は対象外。
+
+    get_image_info(xrefs=True) はxrefを特定するためにページ上の全画像をデコードしてハッシュを
+    取るので、共有画像はページ数だけデコードされる。そこで描画された画像とページが参照する
+    画像XObjectを (幅, 高さ, ビット数, マスクの有無) で突き合わせ、それで1つに決まらない
+    ページ(同じ特徴の画像が複数ある、インライン画像があるなど)だけハッシュで特定する。
+    """
+    has_mask: dict[int, bool] = {}
+    placements: dict[int, list[Placement]] = {}
     for page in doc:
-        for img in page.get_images(full=True):
-            xref = img[0]
-            try:
-                base = doc.extract_image(xref)
-            except RuntimeError:
+        candidates: dict[tuple, set[int]] = {}
+        for xref, smask, width, height, bpc, *_ in page.get_images(full=True):
+            if xref not in has_mask:
+                has_mask[xref] = smask != 0 or doc.xref_get_key(xref, "Mask")[0] != "null"
+            candidates.setdefault((width, height, bpc, has_mask[xref]), set()).add(xref)
+
+        infos = page.get_image_info()
+        keys = [(i["width"], i["height"], i["bpc"], i["has-mask"]) for i in infos]
+        if all(len(candidates.get(key, ())) == 1 for key in keys):
+            xrefs = [next(iter(candidates[key])) for key in keys]
+        else:
+            xrefs = [info["xref"] for info in page.get_image_info(xrefs=True)]
+
+        for info, xref in zip(infos, xrefs):
+            if xref <= 0:
                 continue
+            placements.setdefault(xref, []).append(
+                Placement(page.number, fitz.Rect(info["bbox"]), fitz.Matrix(info["transform"]))
+            )
+    return placements
+
+
+def effective_dpi(width_px: int, height_px: int, placements: list[Placement]) -> float | None:
+    """最も大きく表示される配置での実効DPIを返す。表示サイズのある配置がなければNone。
+
+    縦横で拡大率が違う配置では解像度の低い方の軸を採るので、縮小してもどの配置の
+    どちらの軸もmax_dpiを下回らない。
+    """
+    dpis = [
+        min(width_px / (p.width_pt / 72), height_px / (p.height_pt / 72))
+        for p in placements
+        if p.width_pt > 0 and p.height_pt > 0
+    ]
+    return min(dpis) if dpis else None
+
+
+@dataclass
+class Encoded:
+    """再エンコードした画像ストリームと、画像XObjectに書き込む属性。"""
+    stream: bytes
+    encoder: str
+    width: int
+    height: int
+    colorspace: str
+    bits: int
+    filter: str
+    decode_parms: str | None = None
+
+
+@dataclass
+class Decoded:
+    """デコード済みの画像と、再エンコードの方式。"""
+    image: Image.Image
+    kind: str
+    palette: Image.Image | None = None
+
+
+@dataclass
+class ImageReport:
+    """画像1つの処理結果。"""
+    xref: int
+    page: int
+    original_size: int
+    new_size: int | None = None
+    encoder: str | None = None
+    replaced: bool = False
+
+    @property
+    def saved(self) -> int:
+        return self.original_size - self.new_size if self.replaced else 0
+
+
+def classify_image(image: Image.Image) -> str:
+    """色空間と内容から、再エンコードの方式を決める。
+
+    Returns:
+        "bilevel"(白黒2値) / "palette"(色数の少ない図) / "gray" / "color"
+    """
+    if image.mode == "1":
+        return "bilevel"
+    colors = image.getcolors(PALETTE_MAX_COLORS)
+    gray = image.mode == "L" or is_grayscale(image)
+    if colors is not None:
+        values = {value if image.mode == "L" else value[0] for _, value in colors}
+        if gray and values <= {0, 255}:
+            return "bilevel"
+        return "palette"
+    return "gray" if gray else "color"
+
+
+def is_grayscale(image: Image.Image) -> bool:
+    r, g, b = image.split()
+    return all(
+        ImageChops.difference(x, y).getextrema()[1] <= GRAY_TOLERANCE
+        for x, y in ((r, g), (g, b))
+    )
+
+
+def encode_jpeg(image: Image.Image, quality: int, gray: bool) -> Encoded:
+    image = image.convert("L" if gray else "RGB")
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=quality, optimize=True)
+    return Encoded(
+        buf.getvalue(), "gray-jpeg" if gray else "jpeg", image.width, image.height,
+        "/DeviceGray" if gray else "/DeviceRGB", 8, "/DCTDecode",
+    )
+
+
+def encode_palette(image: Image.Image) -> Encoded:
+    """パレット(Indexed)画像をビット数を詰めてFlateで圧縮する。"""
+    palette = image.getpalette()[: 3 * (image.getextrema()[1] + 1)]
+    count = len(palette) // 3
+    bits = next(b for b in (1, 2, 4, 8) if count <= 1 << b)
+    data = image.tobytes() if bits == 8 else image.tobytes("raw", f"P;{bits}")
+    return Encoded(
+        zlib.compress(data, 9), "palette", image.width, image.height,
+        f"[/Indexed /DeviceRGB {count - 1} <{bytes(palette).hex()}>]", bits, "/FlateDecode",
+    )
+
+
+def encode_bilevel(image: Image.Image) -> Encoded:
+    """2値画像をCCITT G4とFlate(1ビット)の両方で圧縮し、小さい方を返す。"""
+    flate = Encoded(
+        zlib.compress(image.tobytes(), 9), "bilevel-flate", image.width, image.height,
+        "/DeviceGray", 1, "/FlateDecode",
+    )
+    g4 = encode_ccitt(image)
+    return g4 if g4 is not None and len(g4.stream) < len(flate.stream) else flate
+
+
+def encode_ccitt(image: Image.Image) -> Encoded | None:
+    """PillowのlibtiffでCCITT G4に圧縮する。1ストリップに収まらない場合はNone。"""
+    buf = io.BytesIO()
+    try:
+        image.save(buf, format="TIFF", compression="group4", tiffinfo={278: image.height})
+    except (OSError, ValueError):
+        return None
+    tiff = Image.open(buf)
+    offsets, counts = tiff.tag_v2.get(273), tiff.tag_v2.get(279)
+    if not offsets or len(offsets) != 1:
+        return None
+    data = buf.getvalue()[offsets[0]:offsets[0] + counts[0]]
+    # PillowはMinIsBlack(0が黒)で書き出すため、PDFでは1を黒として符号化されている
+    parms = f"<< /K -1 /Columns {image.width} /Rows {image.height} /BlackIs1 true >>"
+    return Encoded(
+        data, "bilevel-g4", image.width, image.height, "/DeviceGray", 1, "/CCITTFaxDecode", parms,
+    )
+
+
+def raw_decode_array(doc: fitz.Document, xref: int, base: dict) -> list[float] | None:
+    """extract_imageがストリームをそのまま返した(JPEGなど)画像の /Decode 配列を返す。
+
+    それ以外の形式ではextract_imageが /Decode を適用した画素を返すのでNone。
+    """
+    if base["ext"] == "png":
+        return None
+    kind, value = doc.xref_get_key(xref, "Decode")
+    if kind != "array":
+        return None
+    return [float(v) for v in value.strip("[] ").split()]
+
+
+def apply_decode(image: Image.Image, decode: list[float]) -> Image.Image | None:
+    """/Decode 配列を画素に適用する。成分数が合わないなど適用できない場合はNone。"""
+    bands = image.getbands()
+    if image.mode not in ("L", "RGB", "CMYK") or len(decode) != 2 * len(bands):
+        return None
+    ranges = list(zip(decode[::2], decode[1::2]))
+    if all(r == (0.0, 1.0) for r in ranges):
+        return image
+    channels = [
+        band.point(lambda v, lo=lo, hi=hi: min(255, max(0, round(255 * (lo + v / 255 * (hi - lo))))))
+        for band, (lo, hi) in zip(image.split(), ranges)
+    ]
+    return Image.merge(image.mode, channels)
+
+
+def decode_image(
+    data: bytes, draft_size: tuple[int, int] | None = None, decode: list[float] | None = None,
+) -> Decoded | None:
+    """画像をデコードして方式を決める。デコードできない形式(JBIG2など)はNone。
+
+    draft_sizeを指定すると、JPEGはその大きさ以上の範囲で縮小しながらデコードする(速いが粗い)。
+    decodeには、まだ画素に適用されていない /Decode 配列を渡す(raw_decode_arrayを参照)。
+    適用できない場合は、見た目が変わらないようNoneを返して置き換えない。
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        if draft_size is not None:
+            image.draft(image.mode, draft_size)
+        image.load()
+    except (OSError, ValueError):
+        return None
+    if decode is not None:
+        image = apply_decode(image, decode)
+        if image is None:
+            return None
+    if image.mode not in ("1", "L", "RGB"):
+        image = image.convert("RGB")
+
+    kind = classify_image(image)
+    if kind == "palette":
+        # 縮小しても色を増やさないよう、元の色で作ったパレットへ割り当て直す
+        image = image.convert("RGB")
+        return Decoded(image, kind, image.quantize(colors=PALETTE_MAX_COLORS, dither=Image.Dither.NONE))
+    if kind == "bilevel":
+        image = image.convert("L")
+    return Decoded(image, kind)
+
+
+def resize_image(decoded: Decoded, scale: float) -> Image.Image:
+    """scale < 1 なら縮小し、方式に合ったモードの画像を返す。"""
+    image = decoded.image
+    if scale < 1:
+        new_size = (
+            max(1, round(image.width * scale)),
+            max(1, round(image.height * scale)),
+        )
+        image = image.resize(new_size, Image.LANCZOS)
+
+    if decoded.kind == "palette":
+        if scale < 1:
+            return image.quantize(palette=decoded.palette, dither=Image.Dither.NONE)
+        return decoded.palette
+    if decoded.kind == "bilevel":
+        return image.point(lambda v: 255 if v >= 128 else 0).convert("1")
+    return image
+
+
+def encode_image(kind: str, image: Image.Image, quality: int) -> Encoded:
+    """白黒2値はCCITT G4かFlate、色数の少ない図はパレット+Flate、
+    グレースケールはグレーのJPEG、それ以外はRGBのJPEGにする。"""
+    if kind == "bilevel":
+        return encode_bilevel(image)
+    if kind == "palette":
+        return encode_palette(image)
+    return encode_jpeg(image, quality, gray=kind == "gray")
+
+
+# ワーカーで開いた文書。同じ文書の画像が続くので、プロセスごとに直前の1件を使い回す
+_source: tuple[tuple, fitz.Document] | None = None
+
+
+def open_source(src: Path) -> fitz.Document:
+    """ワーカーで画像を取り出すために文書を開く(同じファイルなら開き直さない)。"""
+    global _source
+    stat = src.stat()
+    key = (str(src), stat.st_mtime_ns, stat.st_size)
+    if _source is None or _source[0] != key:
+        if _source is not None:
+            _source[1].close()
+        _source = (key, fitz.open(src))
+    return _source[1]
+
+
+def extract_source_image(src: Path, xref: int) -> tuple[bytes, list[float] | None, str] | None:
+    """srcのxrefの画像を取り出し、(画像データ, 未適用の /Decode 配列, 色空間名) を返す。
+
+    JPEGなどPASSTHROUGH_FILTERSの画像はストリームをそのまま返す。それ以外はPixmapで
+    デコードし(/Decode も適用される)、extract_imageのようにPNGへ詰め直さずに
+    無圧縮のPNMで返す。取り出せない場合はNone。
+    """
+    doc = open_source(src)
+    if not any(f in doc.xref_get_key(xref, "Filter")[1] for f in PASSTHROUGH_FILTERS):
+        try:
+            pix = fitz.Pixmap(doc, xref)
+        except RuntimeError:
+            return None
+        colorspace = pix.colorspace.name if pix.colorspace else "-"
+        if pix.alpha:
+            pix = fitz.Pixmap(pix, 0)
+        if pix.n not in (1, 3):
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        return pix.tobytes("pnm"), None, colorspace
+
+    try:
+        base = doc.extract_image(xref)
+    except RuntimeError:
+        return None
+    colorspace = base.get("cs-name") or doc.xref_get_key(xref, "ColorSpace")[1]
+    return base["image"], raw_decode_array(doc, xref, base), colorspace
+
+
+def image_size(doc: fitz.Document, xref: int) -> tuple[int, int] | None:
+    """画像XObjectの /Width と /Height を、ストリームをデコードせずに読む。"""
+    size = []
+    for key in ("Width", "Height"):
+        kind, value = doc.xref_get_key(xref, key)
+        if kind == "xref":
+            value = doc.xref_object(int(value.split()[0]))
+        try:
+            size.append(int(value))
+        except ValueError:
+            return None
+    return size[0], size[1]
+
+
+def recompress_levels(
+    data: bytes, levels: list[tuple[float, int]], decode: list[float] | None = None,
+) -> tuple[list[Encoded | None], dict[str, float]]:
+    """画像を1回だけデコードし、(縮小率, JPEG品質) の各設定で再エンコードする。
+
+    縮小した画像は縮小率ごと、エンコード結果は設定ごとに使い回すので、
+    設定を何通り試してもデコードは1回、縮小は縮小率の種類数だけで済む。
+    ワーカープロセスで実行するため、fitzのオブジェクトには触れない。
+
+    Returns:
+        (設定ごとの結果, デコード・縮小・エンコードにかかった秒数)
+    """
+    timer = StageTimer()
+    with timer.stage("decode"):
+        decoded = decode_image(data, decode=decode)
+    if decoded is None:
+        return [None] * len(levels), timer.seconds
+
+    resized: dict[float, Image.Image] = {}
+    encoded: dict[tuple, Encoded] = {}
+    results = []
+    for scale, quality in levels:
+        if scale not in resized:
+            with timer.stage("resize"):
+                resized[scale] = resize_image(decoded, scale)
+        # JPEG以外は品質に関係なく同じ結果になる
+        key = (scale, quality if decoded.kind in ("gray", "color") else None)
+        if key not in encoded:
+            with timer.stage("encode"):
+                encoded[key] = encode_image(decoded.kind, resized[scale], quality)
+        results.append(encoded[key])
+    return results, timer.seconds
+
+
+def recompress_xref(
+    src: Path, xref: int, levels: list[tuple[float, int]],
+) -> tuple[list[Encoded | None], dict[str, float]]:
+    """ワーカーでsrcのxrefの画像を取り出し、recompress_levelsで再エンコードする。"""
+    timer = StageTimer()
+    with timer.stage("extract"):
+        extracted = extract_source_image(src, xref)
+    if extracted is None:
+        return [None] * len(levels), timer.seconds
+    data, decode, _ = extracted
+    results, seconds = recompress_levels(data, levels, decode)
+    timer.add(seconds)
+    return results, timer.seconds
+
+
+def recompress_image(data: bytes, scale: float, quality: int) -> Encoded | None:
+    """画像をデコードし、scale < 1 なら縮小して、内容に合った形式で再エンコードする。"""
+    return recompress_levels(data, [(scale, quality)])[0][0]
+
+
+def write_image(doc: fitz.Document, xref: int, encoded: Encoded) -> None:
+    """画像XObjectの辞書とストリームを置き換える。
+
+    画素や形式に関係しない属性(透過・オプショナルコンテンツ・レンダリングインテントなど)は
+    引き継ぐ。/Decode は再エンコード前の画素に適用済みなので引き継がない(decode_imageを参照)。
+    """
+    keep = ""
+    for key in ("SMask", "Mask", "OC", "Intent", "Interpolate", "Metadata"):
+        kind, value = doc.xref_get_key(xref, key)
+        if kind != "null":
+            keep += f" /{key} {value}"
+    doc.update_object(
+        xref,
+        f"<< /Type /XObject /Subtype /Image /Width {encoded.width} /Height {encoded.height}"
+        f" /ColorSpace {encoded.colorspace} /BitsPerComponent {encoded.bits}{keep} >>",
+    )
+    # update_streamはFilterを消すので、ストリームを書いてから設定する
+    doc.update_stream(xref, encoded.stream, compress=False)
+    doc.xref_set_key(xref, "Filter", encoded.filter)
+    if encoded.decode_parms:
+        doc.xref_set_key(xref, "DecodeParms", encoded.decode_parms)
+
+
+def is_replaceable(doc: fitz.Document, xref: int) -> bool:
+    """置き換えると見た目が変わる画像(ステンシルマスク、色キーマスク付き)を除く。"""
+    if doc.xref_get_key(xref, "ImageMask")[1] == "true":
+        return False
+    return doc.xref_get_key(xref, "Mask")[0] != "array"
+
+
+def run_parallel(func: Callable, tasks: Iterable[tuple], jobs: int) -> Iterator[tuple]:
+    """(key, args) のタスクを func(*args) で並列に処理し、終わった順に (key, 結果) を返す。
+
+    抽出済みの画像データを一度にすべてメモリへ載せないよう、投入中のタスクはjobsの2倍までに抑える。
+    jobsが1ならプロセスを起動せずに順に処理する。
+    """
+    if jobs <= 1:
+        for key, args in tasks:
+            yield key, func(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = {}
+        for key, args in tasks:
+            pending[executor.submit(func, *args)] = key
+            if len(pending) >= jobs * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        for future in wait(pending).done:
+            yield pending[future], future.result()
+
+
+@dataclass
+class ShrinkResult:
+    """shrink_pdfの結果。max_dpiとqualityは実際に使った設定。
+
+    timingsは処理段階ごとの秒数。decode・resize・encodeはワーカーでの時間の合計なので、
+    並列に処理した場合は経過時間より長くなる。
+    """
+    reports: list[ImageReport]
+    max_dpi: int
+    quality: int
+    estimated_size: int | None = None
+    timings: dict[str, float] = field(default_factory=dict)
+
+
+def target_levels(max_dpi: int, quality: int) -> list[tuple[int, int]]:
+    """--target-size で試す (DPI, JPEG品質) を、画質の良い順に返す。"""
+    qualities = [quality] + [q for q in TARGET_SIZE_QUALITIES if q < quality]
+    dpis = []
+    for factor in TARGET_SIZE_DPI_FACTORS:
+        dpi = max(TARGET_SIZE_MIN_DPI, round(max_dpi * factor))
+        if dpi not in dpis:
+            dpis.append(dpi)
+    return [(dpis[0], q) for q in qualities] + [(dpi, qualities[-1]) for dpi in dpis[1:]]
+
+
+def shrink_pdf(
+    src: Path, dst: Path, max_dpi: int, quality: int, jobs: int = 1,
+    target_size: int | None = None,
+) -> ShrinkResult:
+    """画像を再圧縮してdstに保存する。
+
+    再エンコードしたストリームが元より小さい画像だけを置き換える。
+    target_sizeを指定すると、target_levelsの設定を画質の良い順に試し、
+    出力がtarget_size以下になる最初の設定を使う。各画像は1回だけデコードして
+    全設定の結果を作り、出力サイズは画像ストリームの合計から推定するので、
+    文書の保存は選んだ設定で1回(推定が外れた場合のみ数回)で済む。
+    """
+    levels = [(max_dpi, quality)] if target_size is None else target_levels(max_dpi, quality)
+    timer = StageTimer()
+    with timer.stage("extract"):
+        doc = fitz.open(src)
+        placements = index_placements(doc)
+    original_sizes = {}
+    encodings: dict[int, list[Encoded | None]] = {}
+
+    def tasks() -> Iterator[tuple]:
+        for xref, image_placements in placements.items():
+            with timer.stage("extract"):
+                size = image_size(doc, xref) if is_replaceable(doc, xref) else None
+                dpi = effective_dpi(*size, image_placements) if size else None
+                if dpi is None:
+                    continue
+                original_sizes[xref] = len(doc.xref_stream_raw(xref))
+            yield xref, (src, xref, [(min(1.0, d / dpi), q) for d, q in levels])
+
+    # 画像の取り出し・デコード・縮小・エンコードはワーカーで並列に行い(ワーカーには
+    # ファイル名とxrefだけを渡す)、置き換えはこのプロセスで順に行う。
+    for xref, (results, seconds) in run_parallel(recompress_xref, tasks(), jobs):
+        encodings[xref] = results
+        timer.add(seconds)
 
-            image = Image.open(io.BytesIO(base["image"]))
-            if image.mode != "RGB":
-                image = image.convert("RGB")
+    estimates = []
+    if target_size is not None:
+        # 画像を置き換えずに圧縮だけした大きさを1回測り、画像以外(テキスト・フォント・
+        # SMaskなど)の大きさと、置き換えない場合の各画像の大きさとして使う
+        # (garbage=1 ならxrefの番号は変わらない)
+        with timer.stage("save"):
+            data = doc.tobytes(garbage=1, deflate=True)
+        baseline = fitz.open("pdf", data)
+        kept_sizes = {xref: len(baseline.xref_stream_raw(xref)) for xref in encodings}
+        baseline.close()
+        other = max(0, len(data) - sum(kept_sizes.values()))
 
-            rects = page.get_image_rects(xref)
-            if not rects:
+        def new_size(xref: int, level: int) -> int:
+            encoded = encodings[xref][level]
+            if encoded is None or len(encoded.stream) >= original_sizes[xref]:
+                return kept_sizes[xref]
+            return len(encoded.stream)
+
+        estimates = [other + sum(new_size(xref, i) for xref in encodings) for i in range(len(levels))]
+    doc.close()
+
+    budget = target_size
+    level = 0
+    for _ in range(TARGET_SIZE_SAVE_ATTEMPTS):
+        if budget is not None:
+            level = next((i for i, e in enumerate(estimates) if e <= budget), len(levels) - 1)
+        reports = write_level(src, dst, encodings, original_sizes, placements, level, timer)
+        actual = dst.stat().st_size
+        if target_size is None or actual <= target_size or level == len(levels) - 1:
+            break
+        # 推定との差の分だけ予算を減らして選び直す
+        budget -= max(actual - estimates[level], actual - target_size)
+
+    return ShrinkResult(
+        reports, levels[level][0], levels[level][1],
+        estimates[level] if estimates else None, timer.seconds,
+    )
+
+
+def write_level(
+    src: Path, dst: Path, encodings: dict[int, list[Encoded | None]],
+    original_sizes: dict[int, int], placements: dict[int, list[Placement]], level: int,
+    timer: StageTimer,
+) -> list[ImageReport]:
+    """level番目の設定で再エンコードした画像を元の文書に書き込んでdstに保存する。
+
+    置き換えはxrefの中身を差し替えるので、共有画像もすべてのページに反映される。
+    """
+    doc = fitz.open(src)
+    reports = []
+    for xref, results in encodings.items():
+        encoded = results[level]
+        report = ImageReport(xref, placements[xref][0].page + 1, original_sizes[xref])
+        if encoded is not None:
+            report.encoder = encoded.encoder
+            report.new_size = len(encoded.stream)
+            if report.new_size < report.original_size:
+                with timer.stage("replace"):
+                    write_image(doc, xref, encoded)
+                report.replaced = True
+        reports.append(report)
+
+    with timer.stage("save"):
+        doc.save(dst, garbage=4, deflate=True)
+    doc.close()
+    return sorted(reports, key=lambda r: (r.page, r.xref))
+
+
+def estimate_xref(
+    src: Path, xref: int, scale: float, quality: int,
+) -> tuple[str | None, tuple[str, int, int, int] | None]:
+    """ワーカーでsrcのxrefの画像を取り出し、(色空間名, estimate_imageの結果) を返す。"""
+    extracted = extract_source_image(src, xref)
+    if extracted is None:
+        return None, None
+    data, decode, colorspace = extracted
+    return colorspace, estimate_image(data, scale, quality, decode)
+
+
+def estimate_image(
+    data: bytes, scale: float, quality: int, decode: list[float] | None = None,
+) -> tuple[str, int, int, int] | None:
+    """再エンコード後の大きさを、縮小後の画像の一部だけを試しにエンコードして推定する。
+
+    JPEGは縮小デコードを使い、縮小後の画像が大きい場合はSAMPLE_TILE四方のタイルを
+    SAMPLE_TILES か所だけエンコードして、1ピクセルあたりのバイト数から全体を見積もる。
+
+    Returns:
+        (方式, 縮小後の幅, 縮小後の高さ, 推定バイト数)。デコードできない場合はNone。
+    """
+    # 縮小デコードの大きさを決めるため、先にヘッダーだけ読んで元の大きさを得る
+    try:
+        probe = Image.open(io.BytesIO(data))
+    except (OSError, ValueError):  # JBIG2などPillowが読めない形式
+        return None
+    width, height = (max(1, round(n * min(scale, 1.0))) for n in probe.size)
+    decoded = decode_image(data, draft_size=(width, height), decode=decode)
+    if decoded is None:
+        return None
+    image = resize_image(decoded, width / decoded.image.width)
+    if image.size != (width, height):
+        width, height = image.size
+
+    if width * height <= SAMPLE_TILE * SAMPLE_TILE * SAMPLE_TILES:
+        encoded = encode_image(decoded.kind, image, quality)
+        return encoded.encoder, width, height, len(encoded.stream)
+
+    # 2x2に分けた各領域の中央のタイルを圧縮し、ヘッダーの分を除いて面積比で拡大する
+    header = len(encode_image(decoded.kind, image.crop((0, 0, 1, 1)), quality).stream)
+    tile = min(SAMPLE_TILE, width // 2, height // 2)
+    sample_bytes = sample_pixels = 0
+    for fx, fy in ((0.25, 0.25), (0.75, 0.25), (0.25, 0.75), (0.75, 0.75))[:SAMPLE_TILES]:
+        left = round(width * fx - tile / 2)
+        top = round(height * fy - tile / 2)
+        encoded = encode_image(decoded.kind, image.crop((left, top, left + tile, top + tile)), quality)
+        sample_bytes += max(0, len(encoded.stream) - header)
+        sample_pixels += tile * tile
+    return encoded.encoder, width, height, header + round(sample_bytes / sample_pixels * width * height)
+
+
+def analyze_pdf(src: Path, max_dpi: int, quality: int, jobs: int = 1) -> dict:
+    """shrink_pdfが処理する画像ごとに、現在の大きさ・実効DPI・色空間と削減量の推定を返す。
+
+    文書は書き換えず保存もしない。バッチモードのワーカーとしても使うため、
+    失敗した場合は例外を投げずに "error" を入れて返す。
+    """
+    result: dict = {"file": str(src), "size": 0, "images": []}
+    try:
+        result["size"] = src.stat().st_size
+        doc = fitz.open(src)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    placements = index_placements(doc)
+    images = {}
+
+    def tasks() -> Iterator[tuple]:
+        for xref, image_placements in placements.items():
+            size = image_size(doc, xref) if is_replaceable(doc, xref) else None
+            dpi = effective_dpi(*size, image_placements) if size else None
+            if dpi is None:
                 continue
-            rect = rects[0]
-            width_in = rect.width / 72
-            height_in = rect.height / 72
-            if width_in <= 0 or height_in <= 0:
+            images[xref] = {
+                "page": image_placements[0].page + 1,
+                "xref": xref,
+                "placements": len(image_placements),
+                "width": size[0],
+                "height": size[1],
+                "dpi": round(dpi, 1),
+                "colorspace": doc.xref_get_key(xref, "ColorSpace")[1],
+                "filter": doc.xref_get_key(xref, "Filter")[1],
+                "size": len(doc.xref_stream_raw(xref)),
+            }
+            yield xref, (src, xref, max_dpi / dpi if dpi > max_dpi else 1.0, quality)
+
+    for xref, (colorspace, estimate) in run_parallel(estimate_xref, tasks(), jobs):
+        info = images[xref]
+        if colorspace is not None:
+            info["colorspace"] = colorspace
+        if estimate is None:
+            info.update(encoder=None, predicted_size=info["size"], saving=0)
+            continue
+        encoder, width, height, size = estimate
+        # 元より大きくなる画像は置き換えないので、削減量は0になる
+        info.update(
+            encoder=encoder, new_width=width, new_height=height,
+            predicted_size=min(size, info["size"]), saving=max(0, info["size"] - size),
+        )
+    doc.close()
+
+    result["images"] = sorted(images.values(), key=lambda i: (i["page"], i["xref"]))
+    result["image_bytes"] = sum(i["size"] for i in result["images"])
+    result["predicted_saving"] = sum(i["saving"] for i in result["images"])
+    return result
+
+
+def print_analysis(analysis: dict, verbose: bool = True) -> None:
+    """analyze_pdfの結果を表で表示する。verboseがFalseなら1行の要約だけ。"""
+    if "error" in analysis:
+        print(f"{analysis['file']}: 失敗: {analysis['error']}", file=sys.stderr)
+        return
+    if verbose:
+        print(f"{'page':>5} {'xref':>6} {'size':>9} {'pixels':>11} {'dpi':>6} {'colorspace':<16} "
+              f"{'encoder':<14} {'predicted':>9} {'saving':>9}")
+        for i in analysis["images"]:
+            pixels = f"{i['width']}x{i['height']}"
+            print(
+                f"{i['page']:>5} {i['xref']:>6} {format_size(i['size']):>9} "
+                f"{pixels:>11} {i['dpi']:>6.0f} "
+                f"{str(i['colorspace'])[:16]:<16} {i['encoder'] or '-':<14} "
+                f"{format_size(i['predicted_size']):>9} {format_size(i['saving']):>9}"
+            )
+    size = analysis["size"]
+    saving = analysis["predicted_saving"]
+    ratio = saving / size * 100 if size else 0
+    print(
+        f"{analysis['file']}: {format_size(size)}、画像 {len(analysis['images'])} 件 "
+        f"{format_size(analysis['image_bytes'])}、推定削減量 {format_size(saving)} ({ratio:.0f}%)"
+    )
+
+
+def output_path(src: Path, base: Path, output_dir: Path | None) -> Path:
+    """出力先。output_dirがあれば、baseからの相対パスをその下に再現する。"""
+    name = f"{src.stem}_shrunk.pdf"
+    if output_dir is None:
+        return src.with_name(name)
+    return output_dir / src.relative_to(base).parent / name
+
+
+def expand_inputs(patterns: list[str]) -> list[tuple[Path, Path]]:
+    """ファイル・ディレクトリ・globを (入力PDF, 相対パスの基準) のリストに展開する。
+
+    ディレクトリとglobでは、以前の出力(*_shrunk.pdf)は入力にしない。
+    """
+    found: dict[Path, tuple[Path, Path]] = {}
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            candidates = [
+                (f, path) for f in sorted(path.rglob("*"))
+                if f.is_file() and f.suffix.lower() == ".pdf" and not f.stem.endswith("_shrunk")
+            ]
+        elif path.is_file():
+            candidates = [(path, path.parent)]
+        else:
+            # globの特殊文字を含まない先頭の部分を相対パスの基準にする
+            prefix = []
+            for part in path.parts:
+                if any(c in part for c in "*?["):
+                    break
+                prefix.append(part)
+            base = Path(*prefix) if prefix else Path(".")
+            candidates = [
+                (Path(m), base) for m in sorted(glob.glob(pattern, recursive=True))
+                if Path(m).is_file() and m.lower().endswith(".pdf") and not Path(m).stem.endswith("_shrunk")
+            ]
+        for src, base in candidates:
+            found.setdefault(src.resolve(), (src, base))
+    return list(found.values())
+
+
+class ShrinkCache:
+    """入力の内容のハッシュと設定をキーに、処理済みのファイルを記録する永続キャッシュ。
+
+    同じ内容のファイルが複数の場所にある場合に備え、キーごとに出力先とサイズを記録する。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: dict[str, dict[str, int]] = {}
+        try:
+            self.entries = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"警告: キャッシュを読み込めないため作り直します: {path}: {e}", file=sys.stderr)
+
+    @staticmethod
+    def key(digest: str, max_dpi: int, quality: int, target_size: int | None) -> str:
+        return f"{digest}:{max_dpi}:{quality}:{target_size}:{CACHE_VERSION}"
+
+    def find_output(self, key: str, dst: Path) -> Path | None:
+        """同じ内容・設定で作った出力のうち、書き換えられずに残っているものを返す(dstを優先)。"""
+        outputs = self.entries.get(key, {})
+        for output in sorted(outputs, key=lambda o: o != str(dst.resolve())):
+            path = Path(output)
+            if path.is_file() and path.stat().st_size == outputs[output]:
+                return path
+        return None
+
+    def put(self, key: str, dst: Path) -> None:
+        self.entries.setdefault(key, {})[str(dst.resolve())] = dst.stat().st_size
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.entries, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+def file_digest(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def shrink_file(
+    src: Path, dst: Path, max_dpi: int, quality: int, target_size: int | None,
+) -> tuple[int, str | None, dict[str, float]]:
+    """バッチモードのワーカー。1ファイルを処理し、(出力サイズ, エラーメッセージ, 段階ごとの秒数) を返す。"""
+    try:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        result = shrink_pdf(src, dst, max_dpi, quality, 1, target_size)
+    except Exception as e:  # 1ファイルの失敗でバッチ全体を止めない
+        return 0, f"{type(e).__name__}: {e}", {}
+    return dst.stat().st_size, None, result.timings
+
+
+def run_batch(
+    files: list[tuple[Path, Path]], output_dir: Path | None, max_dpi: int, quality: int,
+    target_size: int | None, jobs: int, cache: ShrinkCache | None, profile: bool = False,
+) -> int:
+    """複数のPDFをプロセスプールで1ファイルずつ並列に処理する。
+
+    各ワーカーは起動とPyMuPDF/Pillowの読み込みを1回だけ行い、複数のファイルを処理する。
+    cacheがあれば、内容と設定が前回と同じで出力も残っているファイルは飛ばす。
+    """
+    total = len(files)
+    done = skipped = failed = 0
+    total_before = total_after = 0
+    keys = {}
+    timer = StageTimer()
+    start = time.perf_counter()
+    if cache is not None:
+        # ファイル全体を読むハッシュの計算もワーカーで並列に行う
+        digests = run_parallel(file_digest, ((src, (src,)) for src, _ in files), jobs)
+        keys = {src: cache.key(digest, max_dpi, quality, target_size) for src, digest in digests}
+
+    def tasks() -> Iterator[tuple]:
+        nonlocal done, skipped
+        for src, base in files:
+            dst = output_path(src, base, output_dir)
+            if cache is not None:
+                previous = cache.find_output(keys[src], dst)
+                if previous is not None:
+                    done += 1
+                    skipped += 1
+                    if previous.resolve() == dst.resolve():
+                        print(f"[{done}/{total}] {src}: スキップ(前回から変更なし)")
+                        continue
+                    # 同じ内容のファイルを別の場所で処理済みなら、その出力をコピーする
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copyfile(previous, dst)
+                    cache.put(keys[src], dst)
+                    print(f"[{done}/{total}] {src}: 同じ内容の {previous} をコピー")
+                    continue
+            yield (src, dst), (src, dst, max_dpi, quality, target_size)
+
+    try:
+        for (src, dst), (after, error, seconds) in run_parallel(shrink_file, tasks(), jobs):
+            done += 1
+            timer.add(seconds)
+            if error is not None:
+                failed += 1
+                print(f"[{done}/{total}] {src}: 失敗: {error}", file=sys.stderr)
                 continue
+            before = src.stat().st_size
+            total_before += before
+            total_after += after
+            ratio = after / before * 100 if before else 0
+            print(f"[{done}/{total}] {src}: {format_size(before)} -> {format_size(after)} ({ratio:.0f}%)")
+            if cache is not None:
+                cache.put(keys[src], dst)
+                if (done - skipped) % CACHE_SAVE_INTERVAL == 0:
+                    cache.save()
+    finally:
+        if cache is not None:
+            cache.save()
 
-            effective_dpi = image.width / width_in
-            if effective_dpi > max_dpi:
-                scale = max_dpi / effective_dpi
-                new_size = (
-                    max(1, round(image.width * scale)),
-                    max(1, round(image.height * scale)),
-                )
-                image = image.resize(new_size, Image.LANCZOS)
+    print(
+        f"処理 {done - skipped - failed} 件、スキップ {skipped} 件、失敗 {failed} 件: "
+        f"{format_size(total_before)} -> {format_size(total_after)}"
+    )
+    if profile:
+        print_timings(timer.seconds, time.perf_counter() - start)
+    return 1 if failed else 0
 
-            buf = io.BytesIO()
-            image.save(buf, format="JPEG", quality=quality, optimize=True)
-            page.replace_image(xref, stream=buf.getvalue())
 
-    doc.save(dst, garbage=4, deflate=True)
-    doc.close()
+def run_analyze(patterns: list[str], max_dpi: int, quality: int, jobs: int, as_json: bool) -> int:
+    """--analyze。1ファイルなら画像を並列に、複数ならファイルを並列に調べる。"""
+    files = expand_inputs(patterns)
+    if not files:
+        print(f"エラー: 入力ファイルが見つかりません: {' '.join(patterns)}", file=sys.stderr)
+        return 1
+
+    if len(files) == 1:
+        results = iter([(files[0][0], analyze_pdf(files[0][0], max_dpi, quality, jobs))])
+    else:
+        results = run_parallel(
+            analyze_pdf, ((src, (src, max_dpi, quality, 1)) for src, _ in files), jobs,
+        )
+
+    failed = 0
+    for _, analysis in results:
+        failed += "error" in analysis
+        if as_json:
+            print(json.dumps(analysis, ensure_ascii=False), flush=True)
+        else:
+            print_analysis(analysis, verbose=len(files) == 1)
+    return 1 if failed else 0
+
+
+def parse_size(value: str) -> int:
+    """"10MB" "500KB" "1.5M" のようなサイズ指定をバイト数に変換する(argparseのtype用)。"""
+    units = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2, "G": 1024 ** 3, "GB": 1024 ** 3}
+    text = value.strip().upper()
+    number = text.rstrip("KMGB")
+    unit = text[len(number):]
+    try:
+        size = float(number) * units[unit]
+    except (ValueError, KeyError):
+        raise argparse.ArgumentTypeError(f"サイズの形式が不正です: {value}") from None
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"サイズは正の値を指定してください: {value}")
+    return int(size)
+
+
+def format_size(size: int) -> str:
+    if abs(size) >= 1024 * 1024:
+        return f"{size / 1024 / 1024:.1f}MB"
+    return f"{size / 1024:.1f}KB"
+
+
+def print_timings(seconds: dict[str, float], elapsed: float) -> None:
+    """--profile。処理段階ごとの時間とピークRSSを表示する。"""
+    print(f"処理時間(経過 {elapsed:.2f}s。ワーカーでの処理は全プロセスの合計):")
+    total = sum(seconds.values())
+    for name in STAGES:
+        share = seconds.get(name, 0.0) / total * 100 if total else 0
+        print(f"  {name:<8} {seconds.get(name, 0.0):8.2f}s {share:5.1f}%")
+    main_rss, worker_rss = peak_rss()
+    print(f"ピークRSS: {format_size(main_rss)}(ワーカーの最大 {format_size(worker_rss)})")
+
+
+def peak_rss() -> tuple[int, int]:
+    """(このプロセス, 終了した子プロセスの中で最大) のピークRSSをバイト数で返す。"""
+    import resource
+
+    # ru_maxrssはLinuxではKB、macOSではバイト
+    unit = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    )
+
+
+def print_reports(reports: list[ImageReport]) -> None:
+    """画像ごとの削減量を表示する。"""
+    for r in reports:
+        if r.new_size is None:
+            status = "デコードできないため維持"
+        elif r.replaced:
+            status = f"{format_size(r.new_size)} (-{format_size(r.saved)})"
+        else:
+            status = f"{format_size(r.new_size)} (元より大きいため維持)"
+        print(f"  p.{r.page} xref {r.xref} [{r.encoder or '-'}]: {format_size(r.original_size)} -> {status}")
+    replaced = [r for r in reports if r.replaced]
+    print(
+        f"画像 {len(replaced)}/{len(reports)} 件を置き換え、"
+        f"画像ストリームを {format_size(sum(r.saved for r in replaced))} 削減"
+    )
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(
         description="PDF内の埋め込み画像を再圧縮・ダウンサンプリングしてファイルサイズを縮小する。"
     )
-    parser.add_argument("input", type=Path, help="入力PDFファイル")
+    parser.add_argument(
+        "inputs", nargs="+", metavar="input",
+        help="入力PDFファイル。ディレクトリやglob(例: 'archive/**/*.pdf')を指定するとバッチモード",
+    )
     parser.add_argument(
         "-o", "--output", type=Path,
-        help="出力PDFファイル(省略時は <input>_shrunk.pdf)",
+        help="出力PDFファイル(省略時は <input>_shrunk.pdf)。1ファイルのときのみ",
+    )
+    parser.add_argument(
+        "--output-dir", type=Path,
+        help="バッチモードの出力先ディレクトリ(省略時は各入力と同じ場所)",
     )
     parser.add_argument(
         "--max-dpi", type=int, default=DEFAULT_MAX_DPI,
@@ -74,24 +1043,91 @@ def main() -> int:
         "--quality", type=int, default=DEFAULT_JPEG_QUALITY,
         help=f"JPEG圧縮品質 1-100(デフォルト: {DEFAULT_JPEG_QUALITY})",
     )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="画像の再圧縮(バッチモードではファイルの処理)に使うプロセス数(デフォルト: CPUコア数)",
+    )
+    parser.add_argument(
+        "--target-size", type=parse_size, metavar="SIZE",
+        help="出力をこのサイズ以下にする(例: 10MB)。--quality と --max-dpi を上限に、"
+             "品質・DPIを下げながら収まる設定を探す",
+    )
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="抽出・デコード・縮小・エンコード・置き換え・保存の段階ごとの処理時間とピークRSSを表示する",
+    )
+    parser.add_argument(
+        "--analyze", action="store_true",
+        help="PDFを書き換えずに、画像ごとの大きさ・実効DPI・色空間と推定削減量を表示する",
+    )
+    parser.add_argument(
+        "--json", action="store_true",
+        help="--analyze の結果を1ファイル1行のJSON(JSON Lines)で出力する",
+    )
+    parser.add_argument(
+        "--cache", type=Path, default=DEFAULT_CACHE,
+        help=f"バッチモードで処理済みのファイルを記録するキャッシュ(デフォルト: {DEFAULT_CACHE})",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="バッチモードでキャッシュを使わず、すべてのファイルを処理する",
+    )
     args = parser.parse_args()
+    if args.json and not args.analyze:
+        parser.error("--json は --analyze と一緒に指定してください")
+    if args.analyze and (args.output or args.target_size):
+        parser.error("--analyze は -o/--output・--target-size と一緒に指定できません")
+
+    if args.analyze:
+        return run_analyze(args.inputs, args.max_dpi, args.quality, args.jobs, args.json)
 
-    if not args.input.is_file():
-        print(f"エラー: 入力ファイルが見つかりません: {args.input}", file=sys.stderr)
+    if len(args.inputs) > 1 or Path(args.inputs[0]).is_dir() or not Path(args.inputs[0]).exists():
+        if args.output:
+            parser.error("-o/--output は1ファイルのときのみ指定できます(バッチモードでは --output-dir)")
+        files = expand_inputs(args.inputs)
+        if not files:
+            print(f"エラー: 入力ファイルが見つかりません: {' '.join(args.inputs)}", file=sys.stderr)
+            return 1
+        cache = None if args.no_cache else ShrinkCache(args.cache)
+        return run_batch(
+            files, args.output_dir, args.max_dpi, args.quality, args.target_size, args.jobs, cache,
+            args.profile,
+        )
+
+    src = Path(args.inputs[0])
+    if not src.is_file():
+        print(f"エラー: 入力ファイルが見つかりません: {src}", file=sys.stderr)
         return 1
 
-    output = args.output or args.input.with_name(f"{args.input.stem}_shrunk.pdf")
+    output = args.output or output_path(src, src.parent, args.output_dir)
+    output.parent.mkdir(parents=True, exist_ok=True)
 
-    shrink_pdf(args.input, output, args.max_dpi, args.quality)
+    start = time.perf_counter()
+    result = shrink_pdf(src, output, args.max_dpi, args.quality, args.jobs, args.target_size)
+    elapsed = time.perf_counter() - start
+    print_reports(result.reports)
+    if args.target_size:
+        print(
+            f"目標 {format_size(args.target_size)}: DPI {result.max_dpi}, 品質 {result.quality} を使用"
+            f"(推定 {format_size(result.estimated_size)})"
+        )
 
-    before = args.input.stat().st_size
+    before = src.stat().st_size
     after = output.stat().st_size
     ratio = after / before * 100 if before else 0
     print(
-        f"{args.input.name}: {before / 1024 / 1024:.1f}MB -> "
+        f"{src.name}: {before / 1024 / 1024:.1f}MB -> "
         f"{output.name}: {after / 1024 / 1024:.1f}MB ({ratio:.0f}%)"
     )
+    if args.profile:
+        print_timings(result.timings, elapsed)
 
+    if args.target_size and after > args.target_size:
+        print(
+            f"警告: 最も小さい設定でも目標サイズ {format_size(args.target_size)} に収まりませんでした",
+            file=sys.stderr,
+        )
+        return 1
     return 0
 
 